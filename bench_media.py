@@ -0,0 +1,291 @@
+# Benchmark harness for tag_media.py: builds a synthetic corpus and times each pipeline stage
+
+import os
+import sys
+import json
+import math
+import time
+import shutil
+import logging
+import platform
+import argparse
+import subprocess
+from pathlib import Path
+
+BENCH_DIR = Path(os.getenv("BENCH_DIR", ".cache/bench"))
+RESOLUTIONS = [(640, 360), (1280, 720), (1920, 1080)]
+DURATIONS = [6, 20]
+SOURCES = ["testsrc2", "smptehdbars", "mandelbrot"]
+FORMATS = {
+    "mp4": ["-c:v", "libx264", "-preset", "veryfast", "-pix_fmt", "yuv420p"],
+    "webm": ["-c:v", "libvpx", "-deadline", "realtime", "-cpu-used", "8", "-b:v", "1M", "-pix_fmt", "yuv420p"],
+}
+STAGES = ["scan", "probe", "jpeg", "animation", "tag", "csv_write", "cleanup", "pipeline"]
+STUB_TAGS = ["pattern", "bars", "fractal", "color", "gradient", "noise", "text", "grid", "circle", "stripes"]
+ORPHANS = 50
+MIN_REGRESSION_MS = float(os.getenv("BENCH_MIN_REGRESSION_MS", "5"))
+
+logger = logging.getLogger("bench_media")
+
+
+def corpus_spec() -> list:
+    """Every (name, source, width, height, duration, extension) in the synthetic corpus."""
+    spec = []
+    for n, ((width, height), duration, extension) in enumerate(
+            (r, d, e) for r in RESOLUTIONS for d in DURATIONS for e in FORMATS):
+        source = SOURCES[n % len(SOURCES)]
+        spec.append((f"{source}_{width}x{height}_{duration}s", source, width, height, duration, extension))
+    return spec
+
+
+def build_corpus(video_dir: Path, rebuild: bool = False) -> list:
+    """Render the corpus from ffmpeg lavfi test sources, reusing files already built."""
+    video_dir.mkdir(parents=True, exist_ok=True)
+    files = []
+    for name, source, width, height, duration, extension in corpus_spec():
+        path = video_dir / f"{name}.{extension}"
+        files.append(path)
+        if path.exists() and not rebuild:
+            continue
+        logger.info(f"Rendering {path.name}...")
+        part = path.with_name(f"{path.name}.part")
+        subprocess.run(
+            ["ffmpeg", "-y", "-hide_banner", "-loglevel", "error",
+             "-f", "lavfi", "-t", str(duration), "-i", f"{source}=size={width}x{height}:rate=30",
+             *FORMATS[extension], "-fflags", "+bitexact", "-f", extension, str(part)],
+            check=True
+        )
+        part.replace(path)
+    return files
+
+
+def write_stub_tags(path: Path):
+    """Write STUB_TAGS in the selected_tags.csv layout that load_candidate_tags expects."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    rows = [f"{n},{tag},0,{1000 - n}" for n, tag in enumerate(STUB_TAGS)]
+    path.write_text("\n".join(["tag_id,name,category,count", *rows]) + "\n")
+
+
+def percentile(values: list, pct: float) -> float:
+    """Nearest-rank percentile of a list of numbers."""
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]
+
+
+class StageTimer:
+    """Collect per-sample latencies and file counts for each stage."""
+
+    def __init__(self):
+        self.samples = {stage: [] for stage in STAGES}
+        self.files = {stage: 0 for stage in STAGES}
+
+    def time(self, stage: str, fn, *args, files: int = 1):
+        start = time.perf_counter()
+        result = fn(*args)
+        self.samples[stage].append(time.perf_counter() - start)
+        self.files[stage] += files
+        return result
+
+    def summary(self) -> dict:
+        stages = {}
+        for stage, samples in self.samples.items():
+            if not samples:
+                continue
+            total = sum(samples)
+            stages[stage] = {
+                "samples": len(samples),
+                "files": self.files[stage],
+                "seconds": round(total, 4),
+                "files_per_sec": round(self.files[stage] / total, 2) if total > 0 else None,
+                "p50_ms": round(percentile(samples, 50) * 1000, 2),
+                "p95_ms": round(percentile(samples, 95) * 1000, 2),
+            }
+        return stages
+
+
+def make_stub_tagger(tm, candidate_tags: list):
+    """Offline stand-in for the CLIP tagger: a fixed random projection of 32x32 thumbnails.
+
+    It runs through ClipTagger's real scoring code, so the tag stage still
+    measures image loading, batching, softmax and top-k.
+    """
+    import numpy as np
+
+    class StubTagger(tm.ClipTagger):
+        engine = "stub"
+
+        def __init__(self, labels: list):
+            rng = np.random.default_rng(0)
+            self.model_name = "stub"
+            self.labels = list(labels)
+            self.logit_scale = 100.0
+            self.projection = rng.standard_normal((32 * 32 * 3, 64)).astype(np.float32)
+            self.text_embeddings = self.encode_texts(self.labels)
+
+        def encode_texts(self, texts: list, chunk_size: int = 256) -> np.ndarray:
+            embeddings = np.stack([
+                np.random.default_rng(sum(text.encode())).standard_normal(64).astype(np.float32) for text in texts])
+            return embeddings / np.linalg.norm(embeddings, axis=-1, keepdims=True)
+
+        def encode_images(self, images: list) -> np.ndarray:
+            pixels = np.stack([np.asarray(image.resize((32, 32)), dtype=np.float32).reshape(-1) / 255
+                               for image in images])
+            embeddings = pixels @ self.projection
+            return embeddings / np.linalg.norm(embeddings, axis=-1, keepdims=True)
+
+    return StubTagger(candidate_tags)
+
+
+def reset_outputs(tm):
+    """Remove previews, tags and manifest left by a previous stage or repeat."""
+    shutil.rmtree(tm.get_path(tm.THUMBS_DIR), ignore_errors=True)
+    shutil.rmtree(tm.get_path(tm.EMBEDDINGS_DIR), ignore_errors=True)
+    for path in (tm.TAGS_CSV, f"{tm.TAGS_CSV}.journal", f"{tm.TAGS_CSV}.journal.checkpoint",
+                 tm.MANIFEST_DB, f"{tm.MANIFEST_DB}-wal", f"{tm.MANIFEST_DB}-shm"):
+        Path(path).unlink(missing_ok=True)
+
+
+def run_stages(tm, timer: StageTimer, engine: str, repeat: int):
+    """Time each stage over the corpus, repeat times."""
+    tagger = None
+    for run in range(repeat):
+        logger.info(f"Run {run + 1}/{repeat}")
+        reset_outputs(tm)
+        video_files = timer.time("scan", tm.get_video_files, files=0)
+        timer.files["scan"] += len(video_files)
+        paths = [str(tm.get_path(tm.VIDEO_DIR, rel_path)) for rel_path in video_files]
+        durations = [timer.time("probe", tm.get_video_duration, path) for path in paths]
+        for rel_path, path, duration in zip(video_files, paths, durations):
+            timer.time("jpeg", tm.generate_jpeg, path, Path(rel_path).stem, duration)
+        for rel_path, path, duration in zip(video_files, paths, durations):
+            timer.time("animation", tm.generate_animation, path, Path(rel_path).stem, duration)
+
+        if tagger is None:
+            candidate_tags = tm.load_candidate_tags()
+            tagger = (make_stub_tagger(tm, candidate_tags) if engine == "stub"
+                      else tm.load_tagger(candidate_tags, engine))
+            if tagger is None:
+                raise RuntimeError(f"Failed to load the {engine} tagger")
+        thumbs = [str(tm.get_path(tm.THUMBS_DIR, "preview", f"{Path(v).stem}_thumb.jpg")) for v in video_files]
+        tag_lists = []
+        for start in range(0, len(thumbs), tm.TAG_BATCH_SIZE):
+            batch = thumbs[start:start + tm.TAG_BATCH_SIZE]
+            tag_lists += timer.time("tag", tm.tag_images, batch, tagger, files=len(batch))
+
+        updates = {Path(v).stem: tm.tag_row(Path(v).stem, tags) for v, tags in zip(video_files, tag_lists)}
+        timer.time("csv_write", tm.merge_tags_csv, updates, files=len(updates))
+
+        preview_dir = tm.get_path(tm.THUMBS_DIR, "preview")
+        for n in range(ORPHANS):
+            (preview_dir / f"orphan{n}_thumb.jpg").write_bytes(b"")
+        timer.time("cleanup", tm.clean_thumbnails, video_files, files=len(video_files) * 2 + ORPHANS)
+
+        # The whole pipeline end to end, from an empty output directory
+        reset_outputs(tm)
+        original_load_tagger = tm.load_tagger
+        tm.load_tagger = lambda candidate_tags, engine_name=None: tagger
+        try:
+            timer.time("pipeline", tm.process_media, (True, True, False), files=len(video_files))
+        finally:
+            tm.load_tagger = original_load_tagger
+
+
+def environment() -> dict:
+    """Machine and tool versions, so results can be compared like for like."""
+    try:
+        ffmpeg_version = subprocess.run(["ffmpeg", "-version"], capture_output=True, text=True).stdout.split("\n")[0]
+    except OSError:
+        ffmpeg_version = None
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "ffmpeg": ffmpeg_version,
+    }
+
+
+def compare_to_baseline(stages: dict, baseline: dict, tolerance: float) -> list:
+    """Log each stage against the baseline, return the stages whose p50 regressed beyond tolerance.
+
+    Slowdowns smaller than MIN_REGRESSION_MS are ignored, sub-millisecond stages are mostly noise.
+    """
+    regressions = []
+    for stage, result in stages.items():
+        base = baseline.get("stages", {}).get(stage)
+        if not base:
+            logger.info(f"{stage:>10}: no baseline")
+            continue
+        change = result["p50_ms"] / base["p50_ms"] - 1 if base["p50_ms"] else 0.0
+        line = (f"{stage:>10}: p50 {result['p50_ms']:.1f} ms vs {base['p50_ms']:.1f} ms ({change:+.1%}), "
+                f"{result['files_per_sec']} vs {base['files_per_sec']} files/sec")
+        if change > tolerance and result["p50_ms"] - base["p50_ms"] > MIN_REGRESSION_MS:
+            regressions.append(stage)
+            logger.error(f"{line} REGRESSION")
+        else:
+            logger.info(line)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark tag_media.py stage by stage on a synthetic corpus.")
+    parser.add_argument("--engine", default="stub",
+                        help="tagging engine: stub (offline stand-in), torch, onnx, or onnx-int8 (default: stub)")
+    parser.add_argument("--repeat", type=int, default=3, help="times to run every stage (default: 3)")
+    parser.add_argument("--rebuild", action="store_true", help="re-render the corpus even if it exists")
+    parser.add_argument("--output", metavar="FILE", help="write the results as JSON to FILE")
+    parser.add_argument("--baseline", metavar="FILE", help="compare against results saved earlier with --output")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed p50 slowdown against the baseline before failing (default: 0.2)")
+    parser.add_argument("--verbose", action="store_true", help="show tag_media's own log output")
+    args = parser.parse_args()
+
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] %(message)s", datefmt="%Y-%m-%d %H:%M:%S"))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+
+    # tag_media reads its paths from the environment at import time
+    work_dir = BENCH_DIR.resolve()
+    os.environ.update({
+        "VIDEO_DIR_PY": str(work_dir / "videos"),
+        "THUMBS_DIR": str(work_dir / "thumbnails"),
+        "TAGS_CSV": str(work_dir / "tags.csv"),
+        "MANIFEST_DB": str(work_dir / "media_manifest.db"),
+        "EMBEDDINGS_DIR": str(work_dir / "embeddings"),
+        "METRICS_JSON": str(work_dir / "media_metrics.json"),
+        "FINGERPRINT_MODE": os.getenv("FINGERPRINT_MODE", "fast"),
+    })
+    if args.engine == "stub":
+        write_stub_tags(work_dir / "selected_tags.csv")
+        os.environ["INPUT_TAGS"] = str(work_dir / "selected_tags.csv")
+    if not args.verbose:
+        os.environ["TQDM_DISABLE"] = "1"
+    files = build_corpus(work_dir / "videos", args.rebuild)
+    import tag_media as tm
+    if not args.verbose:
+        tm.console_handler.setLevel(logging.WARNING)
+
+    timer = StageTimer()
+    run_stages(tm, timer, args.engine, max(1, args.repeat))
+    results = {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "environment": environment(),
+        "corpus": {"videos": len(files), "bytes": sum(path.stat().st_size for path in files)},
+        "settings": {"engine": args.engine, "repeat": args.repeat, "tag_batch_size": tm.TAG_BATCH_SIZE,
+                     "ffmpeg_workers": tm.FFMPEG_WORKERS, "ffmpeg_threads": tm.FFMPEG_THREADS},
+        "stages": timer.summary(),
+    }
+    for stage, result in results["stages"].items():
+        logger.info(f"{stage:>10}: {result['files_per_sec']} files/sec, "
+                    f"p50 {result['p50_ms']} ms, p95 {result['p95_ms']} ms over {result['samples']} samples")
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2))
+        logger.info(f"Wrote results to {args.output}")
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text())
+        if compare_to_baseline(results["stages"], baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
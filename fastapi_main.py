@@ -1,10 +1,29 @@
 import uvicorn
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Query, Request, Response
+from fastapi.responses import FileResponse
+import asyncio
+import base64
+import csv
+import glob
+import hashlib
 import logging
 import os
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from pathlib import Path
+import numpy as np
 from dotenv import load_dotenv
 from colorama import init, Fore, Style
-from typing import Union
+from pydantic import BaseModel
+from typing import List, Optional
+import tag_media
 
 # Initialize colorama for colored console output
 init(autoreset=True)
@@ -12,12 +31,24 @@ init(autoreset=True)
 # Load environment variables
 load_dotenv()
 
-# Configure logging
-logging.basicConfig(
-    level=logging.DEBUG,
-    format="%(asctime)s [%(levelname)s] %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S",
-)
+TAGS_CSV = os.getenv("TAGS_CSV", "../public/tags.csv")
+SEARCH_PAGE_SIZE = int(os.getenv("SEARCH_PAGE_SIZE", 100))
+SEARCH_MAX_PAGE_SIZE = int(os.getenv("SEARCH_MAX_PAGE_SIZE", 1000))
+SEARCH_CACHE_MAX_AGE = int(os.getenv("SEARCH_CACHE_MAX_AGE", 10))
+TAG_JOBS = os.getenv("TAG_JOBS", "1") != "0"  # 0 serves search only, without loading the model
+JOB_BATCH_WINDOW = float(os.getenv("JOB_BATCH_WINDOW", 0.02))
+JOB_MERGE_DELAY = float(os.getenv("JOB_MERGE_DELAY", 2))
+JOB_HISTORY = int(os.getenv("JOB_HISTORY", 1000))
+PREVIEW_CACHE_MAX_MB = int(os.getenv("PREVIEW_CACHE_MAX_MB", 0))  # 0 never evicts previews
+PREVIEW_CACHE_MAX_AGE = int(os.getenv("PREVIEW_CACHE_MAX_AGE", 7 * 24 * 3600))
+PREVIEW_TOUCH_INTERVAL = 3600  # seconds between atime updates of a preview that keeps being served
+PREVIEW_RESCAN_INTERVAL = 300  # seconds between rescans picking up previews written by tag_media.py and jobs
+
+# Configure logging, written from a listener thread so requests never wait on console I/O
+console_handler = logging.StreamHandler()
+console_handler.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] %(message)s", datefmt="%Y-%m-%d %H:%M:%S"))
+logging.getLogger().setLevel(tag_media.LOG_LEVEL)
+log_listener = tag_media.queue_logging(logging.getLogger(), [console_handler])
 logger = logging.getLogger(__name__)
 
 class ColoredFormatter(logging.Formatter):
@@ -38,17 +69,822 @@ for handler in logger.handlers:
     if isinstance(handler, logging.StreamHandler) and not isinstance(handler, logging.FileHandler):
         handler.setFormatter(ColoredFormatter("%(asctime)s [%(levelname)s] %(message)s", datefmt="%Y-%m-%d %H:%M:%S"))
 
+class TagIndex:
+    """In-memory inverted index over tags.csv.
+
+    Media get compact integer ids in file order. Each tag maps to a sorted
+    int32 array of media ids (a slice of `postings`), and each media id maps
+    back to its tag ids (a slice of `row_tags`).
+    """
+
+    def __init__(self, version="", media_ids=None, media_types=None, tag_names=None, row_offsets=None, row_tags=None):
+        self.version = version
+        self.media_ids = media_ids or []
+        self.media_types = media_types or []
+        self.tag_names = tag_names or []
+        self.tag_ids = {name: tag_id for tag_id, name in enumerate(self.tag_names)}
+        self.row_offsets = np.zeros(1, dtype=np.int64) if row_offsets is None else row_offsets
+        self.row_tags = np.zeros(0, dtype=np.int32) if row_tags is None else row_tags
+        self.size = len(self.media_ids)
+
+        # Group (media id, tag id) pairs by tag; a stable sort keeps media ids ascending
+        row_of = np.repeat(np.arange(self.size, dtype=np.int32), np.diff(self.row_offsets))
+        self.postings = row_of[np.argsort(self.row_tags, kind="stable")]
+        self.tag_counts = np.bincount(self.row_tags, minlength=len(self.tag_names))
+        self.tag_offsets = np.concatenate(([0], np.cumsum(self.tag_counts)))
+
+    @classmethod
+    def load(cls, path: str, version: str) -> "TagIndex":
+        """Build an index from a tags.csv file."""
+        media_ids, media_types, tag_names, tag_ids = [], [], [], {}
+        row_offsets, row_tags = [0], []
+        with open(path, "r", newline="", encoding="utf-8") as f:
+            reader = csv.reader(f)
+            header = next(reader, [])
+            id_col = header.index("media_id") if "media_id" in header else 0
+            type_col = header.index("media_type") if "media_type" in header else None
+            tag_cols = [i for i, name in enumerate(header) if name.startswith("tag")]
+            for row in reader:
+                if len(row) <= id_col or not row[id_col]:
+                    continue
+                media_ids.append(row[id_col])
+                media_types.append(row[type_col] if type_col is not None and type_col < len(row) else "")
+                seen = set()
+                for i in tag_cols:
+                    tag = row[i].strip() if i < len(row) else ""
+                    if tag and tag not in seen:
+                        seen.add(tag)
+                        row_tags.append(tag_ids.setdefault(tag, len(tag_ids)))
+                row_offsets.append(len(row_tags))
+        tag_names = list(tag_ids)
+        return cls(
+            version, media_ids, media_types, tag_names,
+            np.array(row_offsets, dtype=np.int64), np.array(row_tags, dtype=np.int32)
+        )
+
+    def posting(self, tag: str) -> Optional[np.ndarray]:
+        """Sorted media ids carrying a tag, or None if the tag is unknown."""
+        tag_id = self.tag_ids.get(tag)
+        if tag_id is None:
+            return None
+        return self.postings[self.tag_offsets[tag_id]:self.tag_offsets[tag_id + 1]]
+
+    def contains(self, ids: np.ndarray, posting: np.ndarray) -> np.ndarray:
+        """Boolean mask of which sorted ids appear in a posting."""
+        if not len(ids) or not len(posting):
+            return np.zeros(len(ids), dtype=bool)
+        if len(ids) * 32 > self.size:
+            # Dense: scatter into a bitmap over all media
+            mask = np.zeros(self.size, dtype=bool)
+            mask[posting] = True
+            return mask[ids]
+        positions = np.minimum(np.searchsorted(posting, ids), len(posting) - 1)
+        return posting[positions] == ids
+
+    def search(self, all_tags: List[str], any_tags: List[str], not_tags: List[str]) -> np.ndarray:
+        """Sorted media ids matching every `all` tag, at least one `any` tag and no `not` tag."""
+        required = [self.posting(tag) for tag in all_tags]
+        if any(posting is None for posting in required):
+            return np.zeros(0, dtype=np.int32)
+        optional = [posting for posting in map(self.posting, any_tags) if posting is not None]
+        if any_tags and not optional:
+            return np.zeros(0, dtype=np.int32)
+
+        # Intersect starting from the rarest tag so each step stays small
+        required.sort(key=len)
+        if required:
+            ids = required[0]
+            for posting in required[1:]:
+                ids = ids[self.contains(ids, posting)]
+        elif optional:
+            if sum(map(len, optional)) * 32 > self.size:
+                mask = np.zeros(self.size, dtype=bool)
+                for posting in optional:
+                    mask[posting] = True
+                ids = np.flatnonzero(mask).astype(np.int32)
+            else:
+                ids = np.unique(np.concatenate(optional))
+            optional = []
+        else:
+            ids = np.arange(self.size, dtype=np.int32)
+
+        if optional:
+            keep = np.zeros(len(ids), dtype=bool)
+            for posting in optional:
+                keep |= self.contains(ids, posting)
+            ids = ids[keep]
+        for posting in map(self.posting, not_tags):
+            if posting is not None:
+                ids = ids[~self.contains(ids, posting)]
+        return ids
+
+    def facets(self, ids: np.ndarray, limit: int) -> list:
+        """Most common tags among a set of media ids."""
+        if limit <= 0 or not len(self.tag_names):
+            return []
+        if len(ids) == self.size:
+            counts = self.tag_counts
+        elif len(ids) * 2 > self.size:
+            # Cheaper to count the complement and subtract
+            mask = np.ones(self.size, dtype=bool)
+            mask[ids] = False
+            counts = self.tag_counts - self.count_tags(np.flatnonzero(mask))
+        else:
+            counts = self.count_tags(ids)
+        top = np.flatnonzero(counts)
+        if len(top) > limit:
+            top = top[np.argpartition(-counts[top], limit - 1)[:limit]]
+        top = top[np.lexsort((top, -counts[top]))]
+        return [{"tag": self.tag_names[tag_id], "count": int(counts[tag_id])} for tag_id in top]
+
+    def count_tags(self, ids: np.ndarray) -> np.ndarray:
+        """Per-tag counts over a set of media ids, using the forward index."""
+        starts = self.row_offsets[ids]
+        lengths = self.row_offsets[ids + 1] - starts
+        total = int(lengths.sum())
+        if not total:
+            return np.zeros(len(self.tag_names), dtype=np.int64)
+        # Expand each [start, start + length) range into flat row_tags positions
+        positions = np.repeat(starts - np.concatenate(([0], np.cumsum(lengths)[:-1])), lengths) + np.arange(total)
+        return np.bincount(self.row_tags[positions], minlength=len(self.tag_names))
+
+    def item(self, media_id: int) -> dict:
+        """Response payload for one media id."""
+        tag_ids = self.row_tags[self.row_offsets[media_id]:self.row_offsets[media_id + 1]]
+        return {
+            "media_id": self.media_ids[media_id],
+            "media_type": self.media_types[media_id],
+            "tags": [self.tag_names[tag_id] for tag_id in tag_ids],
+        }
+
+    def encode_cursor(self, media_id: int) -> str:
+        """Opaque cursor pointing just past a media id."""
+        raw = f"{media_id}:{self.media_ids[media_id]}".encode("utf-8")
+        return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+    def decode_cursor(self, cursor: str) -> int:
+        """Resolve a cursor to a media id, surviving reloads that shift rows."""
+        try:
+            raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode("utf-8")
+            position, media_id = raw.split(":", 1)
+            position = int(position)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        if 0 <= position < self.size and self.media_ids[position] == media_id:
+            return position
+        try:
+            return self.media_ids.index(media_id)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Cursor no longer matches any media")
+
+
+class TagIndexStore:
+    """Holds the current TagIndex and rebuilds it when tags.csv changes."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.index = None
+        self.failed_version = None
+        self.loading = False
+        self.lock = threading.Lock()
+
+    def file_version(self) -> str:
+        """Version string derived from the file's mtime and size."""
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return ""
+        return f"{stat.st_mtime_ns:x}-{stat.st_size:x}"
+
+    def current(self) -> TagIndex:
+        """Return the index, starting a background reload if the file changed."""
+        version = self.file_version()
+        if self.index is None:
+            self.reload(version)
+        elif version != self.index.version and version != self.failed_version:
+            with self.lock:
+                if self.loading:
+                    return self.index
+                self.loading = True
+            threading.Thread(target=self.reload, args=(version, True), daemon=True).start()
+        return self.index
+
+    def reload(self, version: str, background: bool = False):
+        """Build a new index and swap it in; the old one keeps serving meanwhile."""
+        try:
+            if not version:
+                index = TagIndex()
+            else:
+                index = TagIndex.load(self.path, version)
+                logger.info(f"Indexed {index.size} media and {len(index.tag_names)} tags from {self.path}")
+            self.index = index
+        except Exception as e:
+            logger.error(f"Failed to index {self.path}: {str(e)}")
+            self.failed_version = version
+            if self.index is None:
+                self.index = TagIndex()
+        finally:
+            if background:
+                with self.lock:
+                    self.loading = False
+
+
+tag_store = TagIndexStore(TAGS_CSV)
+embedding_store = tag_media.EmbeddingStore(tag_media.embedding_store_path())
+
+
+def cached_response(request: Request, response: Response, index: TagIndex) -> Optional[Response]:
+    """Set ETag/Cache-Control for a response; return a 304 if the client is current."""
+    key = f"{index.version}?{request.url.path}?{request.url.query}".encode("utf-8")
+    etag = f'"{hashlib.blake2b(key, digest_size=12).hexdigest()}"'
+    headers = {"ETag": etag, "Cache-Control": f"public, max-age={SEARCH_CACHE_MAX_AGE}, must-revalidate"}
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return None
+
+
+def find_video(manifest_conn: sqlite3.Connection, media_id: str, scan: bool = True) -> Optional[str]:
+    """Path relative to VIDEO_DIR of a media id, from the manifest or, when scan is set, a directory scan."""
+    video_dir = tag_media.get_path(tag_media.VIDEO_DIR)
+    if manifest_conn:
+        for row in manifest_conn.execute(
+                "SELECT rel_path FROM media WHERE video_id = ? ORDER BY rel_path", (media_id,)):
+            if (video_dir / row["rel_path"]).is_file():
+                return row["rel_path"]
+    if not scan:
+        return None
+    for extension in tag_media.VIDEO_EXTENSIONS:
+        for file in sorted(video_dir.rglob(f"{glob.escape(media_id)}{extension}")):
+            return str(file.relative_to(video_dir))
+    return None
+
+
+class JobRequest(BaseModel):
+    paths: List[str] = []
+    media_ids: List[str] = []
+    thumbs: bool = True
+    tags: bool = True
+    force: bool = False
+
+
+class TagJobService:
+    """Background worker that previews and tags videos with a model loaded once.
+
+    Videos from all queued jobs are taken in micro-batches: the worker waits up
+    to JOB_BATCH_WINDOW seconds for up to TAG_BATCH_SIZE videos, probes them and
+    makes previews (or decodes frames) on FFMPEG_WORKERS threads, then tags the
+    whole batch in one forward pass. Results go to the manifest and a journal
+    straight away; the journal is merged into tags.csv once the queue has been
+    idle for JOB_MERGE_DELAY seconds.
+    """
+
+    def __init__(self):
+        self.tagger = None
+        self.vocabulary_version = ""
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        self.pool = None
+        self.thread = None
+        self.journal = tag_media.TagJournal(f"{TAGS_CSV}.jobs.journal")
+
+    def start(self):
+        """Load the tagger and start the worker thread."""
+        self.tagger = tag_media.load_tagger(tag_media.load_candidate_tags())
+        self.vocabulary_version = tag_media.get_tagging_version()
+        self.pool = ThreadPoolExecutor(max_workers=max(1, tag_media.FFMPEG_WORKERS))
+        self.thread = threading.Thread(target=self.run, name="tag-jobs", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Finish queued work, merge outstanding tags and stop the worker."""
+        if self.thread:
+            self.queue.put(None)
+            self.thread.join()
+            self.pool.shutdown()
+
+    def submit(self, request: JobRequest, rel_paths: list) -> dict:
+        """Queue a job for the given paths and media ids and return its status."""
+        targets = [(rel_path, Path(rel_path).stem) for rel_path in rel_paths]
+        targets += [(None, media_id) for media_id in request.media_ids]
+        job = {
+            "id": uuid.uuid4().hex,
+            "status": "queued",
+            "created_at": time.time(),
+            "finished_at": None,
+            "items": [
+                {"rel_path": rel_path, "media_id": media_id, "status": "queued",
+                 "duration": None, "previews": None, "tags": None, "error": None}
+                for rel_path, media_id in targets
+            ],
+        }
+        with self.lock:
+            self.jobs[job["id"]] = job
+            while len(self.jobs) > JOB_HISTORY:
+                self.jobs.popitem(last=False)
+            for entry in job["items"]:
+                self.queue.put((job, entry, request))
+            return self.snapshot(job["id"], locked=True)
+
+    def snapshot(self, job_id: str, locked: bool = False) -> Optional[dict]:
+        """Copy of a job's status, or None if it is unknown."""
+        if not locked:
+            with self.lock:
+                return self.snapshot(job_id, locked=True)
+        job = self.jobs.get(job_id)
+        if job is None:
+            return None
+        return {**job, "items": [dict(entry) for entry in job["items"]]}
+
+    def recent(self, limit: int) -> list:
+        """Status summaries of the most recent jobs, newest first."""
+        with self.lock:
+            jobs = list(self.jobs.values())[-limit:]
+            return [{key: job[key] for key in ("id", "status", "created_at", "finished_at")} | {"items": len(job["items"])}
+                    for job in reversed(jobs)]
+
+    def run(self):
+        manifest_conn = None
+        try:
+            manifest_conn = tag_media.open_manifest()
+        except sqlite3.Error as e:
+            logger.error(f"Failed to open manifest {tag_media.MANIFEST_DB}: {str(e)}")
+        dirty = bool(self.journal.resume())
+        try:
+            while True:
+                try:
+                    first = self.queue.get(timeout=JOB_MERGE_DELAY if dirty else None)
+                except queue.Empty:
+                    self.merge()
+                    dirty = False
+                    continue
+                if first is None:
+                    break
+                batch, stopping = [first], False
+                deadline = time.monotonic() + JOB_BATCH_WINDOW
+                while len(batch) < tag_media.TAG_BATCH_SIZE:
+                    try:
+                        entry = self.queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                    except queue.Empty:
+                        break
+                    if entry is None:
+                        stopping = True
+                        break
+                    batch.append(entry)
+                try:
+                    dirty = self.process(batch, manifest_conn) or dirty
+                except Exception as e:
+                    logger.error(f"Tag job batch failed: {str(e)}")
+                    self.finish([(job, entry, None, str(e)) for job, entry, _ in batch])
+                if stopping:
+                    break
+        finally:
+            if dirty:
+                self.merge()
+            if self.journal.rows():
+                self.journal.close()
+            else:
+                self.journal.discard()
+            if manifest_conn:
+                manifest_conn.close()
+
+    def prepare(self, item: dict) -> dict:
+        """Probe, preview and frame-extraction steps of the pipeline for one item."""
+        tag_media.probe_item(item)
+        if not item.get("skip") and (item["previews"] is None or not item["generate_thumbs"]):
+            tag_media.preview_item(item, item["generate_thumbs"])
+        if not item.get("skip") and item["needs_tags"] and tag_media.TAG_SOURCE == "frames":
+            item["frames"] = tag_media.extract_frames(str(item["file_path"]), item["duration"])
+        return item
+
+    def process(self, batch: list, manifest_conn: sqlite3.Connection) -> bool:
+        """Run one micro-batch, returning whether new tags were journaled."""
+        results, work = [], []
+        for job, entry, request in batch:
+            with self.lock:
+                job["status"] = entry["status"] = "running"
+            rel_path = entry["rel_path"] or find_video(manifest_conn, entry["media_id"])
+            if rel_path is None:
+                results.append((job, entry, None, "Video not found"))
+                continue
+            manifest = tag_media.load_manifest(manifest_conn, [rel_path]) if manifest_conn else {}
+            items = tag_media.pipeline_items([rel_path], manifest, request.thumbs, request.tags, {},
+                                             self.vocabulary_version)
+            if not items:
+                results.append((job, entry, None, "Video could not be read"))
+                continue
+            item = items[0]
+            if request.force:
+                item["previews"] = item["tags"] = item["vocabulary_version"] = None
+                item["force_previews"] = True
+                tag_media.update_item_state(item, request.thumbs, request.tags, self.vocabulary_version)
+            item["generate_thumbs"] = request.thumbs
+            results.append((job, entry, item, None))
+            if not item["fresh"]:
+                work.append(item)
+
+        list(self.pool.map(self.prepare, work))
+        pending = [item for item in work if not item.get("skip") and item["needs_tags"]]
+        journaled = False
+        if pending:
+            for item, row in zip(pending, tag_media.tag_pending(pending, self.tagger)):
+                item["vocabulary_version"] = self.vocabulary_version if item["tags"] is not None else None
+                if item["tags"] is not None:
+                    self.journal.append(item, row)
+                    journaled = True
+        if journaled:
+            self.journal.checkpoint()
+        if manifest_conn and work:
+            tag_media.save_manifest_entries(manifest_conn, work)
+        self.finish(results)
+        return journaled
+
+    def finish(self, results: list):
+        """Record item outcomes and mark jobs whose items are all finished as done."""
+        with self.lock:
+            for job, entry, item, error in results:
+                if item is not None:
+                    entry.update({
+                        "rel_path": item["rel_path"],
+                        "media_id": item["video_id"],
+                        "duration": item["duration"],
+                        "previews": item["previews"],
+                        "tags": item["tags"],
+                    })
+                    if item["needs_tags"] and item["tags"] is None and not item.get("skip"):
+                        error = "Tagging failed"
+                entry["status"] = "failed" if error else "skipped" if item.get("skip") else "done"
+                entry["error"] = error
+                if all(e["status"] in ("done", "skipped", "failed") for e in job["items"]):
+                    job["status"] = "done"
+                    job["finished_at"] = time.time()
+
+    def merge(self):
+        """Merge journaled tags into tags.csv and start a fresh journal."""
+        updates = self.journal.rows()
+        if updates and tag_media.merge_tags_csv(updates):
+            self.journal.discard()
+            self.journal.resume()
+
+
+job_service = TagJobService()
+
+
+def video_rel_path(path: str) -> str:
+    """Validate a video path and return it relative to VIDEO_DIR."""
+    video_dir = tag_media.get_path(tag_media.VIDEO_DIR)
+    file_path = (video_dir / path).resolve()
+    if file_path.suffix.lower() not in tag_media.VIDEO_EXTENSIONS or not file_path.is_relative_to(video_dir):
+        raise HTTPException(status_code=400, detail=f"Not a video under VIDEO_DIR: {path}")
+    if not file_path.is_file():
+        raise HTTPException(status_code=404, detail=f"Video not found: {path}")
+    return str(file_path.relative_to(video_dir))
+
+
+class PreviewCache:
+    """THUMBS_DIR/preview as a size-bounded LRU disk cache with on-demand generation.
+
+    Recency is kept in an OrderedDict and persisted in each file's atime, so
+    the order survives restarts. When PREVIEW_CACHE_MAX_MB is set, the least
+    recently served previews are deleted once the directory grows past it.
+    A missing preview is generated with generate_previews(); concurrent
+    requests for it share one ffmpeg run. Only videos in the manifest are
+    looked up, so a name of an unknown video is a 404 without scanning
+    VIDEO_DIR. Previews written by tag_media.py runs and tag jobs are counted
+    by a rescan every PREVIEW_RESCAN_INTERVAL seconds. All bookkeeping
+    happens on the event loop, so it needs no locks.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.directory = None
+        self.entries = OrderedDict()  # file name -> size, least recently used first
+        self.total_bytes = 0
+        self.flights = {}
+        self.scanned_at = 0.0
+
+    def list_files(self) -> list:
+        """(last used, name, size) of every preview file on disk."""
+        files = []
+        for file in self.directory.iterdir():
+            if file.name.endswith(".part") or not file.is_file():
+                continue
+            try:
+                stat = file.stat()
+            except FileNotFoundError:  # Evicted or replaced meanwhile
+                continue
+            files.append((max(stat.st_atime, stat.st_mtime), file.name, stat.st_size))
+        return files
+
+    def scan(self):
+        """Load the existing previews, oldest access first."""
+        self.directory = tag_media.get_path(tag_media.THUMBS_DIR, "preview")
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.scanned_at = time.monotonic()
+        for _, name, size in sorted(self.list_files()):
+            self.entries[name] = size
+        self.total_bytes = sum(self.entries.values())
+        logger.info(f"Preview cache: {len(self.entries)} files, {self.total_bytes / 1024 / 1024:.1f} MB")
+        self.evict()
+
+    def sync(self, files: list):
+        """Account for previews other writers added or deleted since the last scan, then evict."""
+        listed = set()
+        for _, name, size in sorted(files):
+            listed.add(name)
+            if name not in self.entries:
+                self.entries[name] = size  # New to the cache, so most recently used
+                self.total_bytes += size
+        for name in [name for name in self.entries if name not in listed]:
+            if not (self.directory / name).exists():
+                self.total_bytes -= self.entries.pop(name)
+        self.evict()
+
+    @staticmethod
+    def parse_name(name: str) -> Optional[tuple]:
+        """(video_id, kind) for a preview file name, or None if it is not one."""
+        return tag_media.parse_preview_name(name)
+
+    def touch(self, name: str, stat: os.stat_result):
+        """Mark a preview as just used."""
+        if name not in self.entries:
+            self.total_bytes += stat.st_size
+        else:
+            self.total_bytes += stat.st_size - self.entries[name]
+        self.entries[name] = stat.st_size
+        self.entries.move_to_end(name)
+        now = time.time()
+        if now - stat.st_atime > PREVIEW_TOUCH_INTERVAL:
+            try:
+                os.utime(self.directory / name, ns=(int(now * 1e9), stat.st_mtime_ns))
+            except OSError:
+                pass
+        self.evict()
+
+    def evict(self):
+        """Delete least recently used previews until the cache fits PREVIEW_CACHE_MAX_MB."""
+        while self.max_bytes and self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            name, size = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                (self.directory / name).unlink(missing_ok=True)
+                logger.debug(f"Evicted preview {name} ({size / 1024:.1f} KB)")
+            except OSError as e:
+                logger.error(f"Failed to evict preview {name}: {str(e)}")
+
+    def generate(self, video_id: str, kind: str) -> bool:
+        """Generate one preview for a video, as generate_jpeg()/generate_animation() do."""
+        manifest_conn = None
+        try:
+            manifest_conn = tag_media.open_manifest()
+        except sqlite3.Error as e:
+            logger.error(f"Failed to open manifest {tag_media.MANIFEST_DB}: {str(e)}")
+        try:
+            rel_path = find_video(manifest_conn, video_id, scan=False) if manifest_conn else None
+            if rel_path is None:
+                return False
+            row = tag_media.load_manifest(manifest_conn, [rel_path]).get(rel_path) if manifest_conn else None
+            file_path = str(tag_media.get_path(tag_media.VIDEO_DIR, rel_path))
+            stat = os.stat(file_path)
+            if row and row["duration"] and row["size"] == stat.st_size and row["mtime_ns"] == stat.st_mtime_ns:
+                duration = row["duration"]
+            else:
+                duration = tag_media.get_video_duration(file_path)
+            if duration <= 0:
+                return False
+            if kind == "jpeg":
+                return bool(tag_media.generate_jpeg(file_path, video_id, duration))
+            return bool(tag_media.generate_animation(file_path, video_id, duration, kind))
+        except Exception as e:
+            logger.error(f"Failed to generate {kind} preview for {video_id}: {str(e)}")
+            return False
+        finally:
+            if manifest_conn:
+                manifest_conn.close()
+
+    async def get(self, name: str) -> Optional[tuple]:
+        """(path, stat) of a preview, generating it first if it is missing."""
+        parsed = self.parse_name(name)
+        if parsed is None or name.startswith("."):
+            return None
+        if time.monotonic() - self.scanned_at >= PREVIEW_RESCAN_INTERVAL:
+            self.scanned_at = time.monotonic()
+            self.sync(await asyncio.to_thread(self.list_files))
+        path = self.directory / name
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            flight = self.flights.get(name)
+            if flight is None:
+                flight = asyncio.ensure_future(asyncio.to_thread(self.generate, *parsed))
+                self.flights[name] = flight
+                flight.add_done_callback(lambda _: self.flights.pop(name, None))
+            # Shielded so a client hanging up does not cancel the run others are waiting on
+            if not await asyncio.shield(flight):
+                return None
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                return None
+        self.touch(name, stat)
+        return path, stat
+
+
+preview_cache = PreviewCache(PREVIEW_CACHE_MAX_MB * 1024 * 1024)
+
+
+def not_modified(request: Request, etag: str, mtime: float) -> bool:
+    """Whether a conditional GET can be answered with 304."""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        return etag in if_none_match or if_none_match.strip() == "*"
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+class RequestMetrics:
+    """ASGI middleware recording latency and response status per route in tag_media.metrics."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        start = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # The router stores the matched route in the scope, so paths with ids share one series
+            route = getattr(scope.get("route"), "path", "unmatched")
+            tag_media.metrics.observe("api_request_seconds", time.perf_counter() - start,
+                                      method=scope["method"], route=route)
+            tag_media.metrics.inc("api_responses_total", method=scope["method"], route=route, status=status)
+
+
+tag_media.metrics.describe("api_request_seconds", "Seconds to answer a request, by route")
+tag_media.metrics.describe("api_responses_total", "Responses sent, by route and status")
+tag_media.metrics.describe("api_indexed_media", "Media in the current tag index")
+tag_media.metrics.describe("api_preview_cache_bytes", "Bytes of previews in the preview cache")
+tag_media.metrics.describe("api_preview_cache_files", "Previews in the preview cache")
+tag_media.metrics.describe("api_job_queue_depth", "Tag job items waiting for the worker")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    tag_store.current()
+    await asyncio.to_thread(preview_cache.scan)
+    if TAG_JOBS:
+        await asyncio.to_thread(job_service.start)
+    yield
+    if TAG_JOBS:
+        await asyncio.to_thread(job_service.stop)
+
+
 # Initialize FastAPI app
-app = FastAPI(docs_url="/docs", redoc_url=None)  # Serve Swagger UI at /docs
+app = FastAPI(docs_url="/docs", redoc_url=None, lifespan=lifespan)  # Serve Swagger UI at /docs
+app.add_middleware(RequestMetrics)
 
 @app.get("/")
 def read_root():
-    return {"Hello": "World"}
+    index = tag_store.current()
+    return {"media": index.size, "tags": len(index.tag_names), "version": index.version}
+
+
+@app.get("/metrics")
+def read_metrics():
+    """Pipeline stage, job and request metrics in the Prometheus text format."""
+    tag_media.metrics.set("api_indexed_media", tag_store.current().size)
+    tag_media.metrics.set("api_preview_cache_bytes", preview_cache.total_bytes)
+    tag_media.metrics.set("api_preview_cache_files", len(preview_cache.entries))
+    if TAG_JOBS:
+        tag_media.metrics.set("api_job_queue_depth", job_service.queue.qsize())
+    return Response(tag_media.metrics.prometheus(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@app.get("/api/search")
+def search_media(
+    request: Request,
+    response: Response,
+    all_tags: List[str] = Query([], alias="all", description="Media must have every one of these tags"),
+    any_tags: List[str] = Query([], alias="any", description="Media must have at least one of these tags"),
+    not_tags: List[str] = Query([], alias="not", description="Media must have none of these tags"),
+    cursor: Optional[str] = None,
+    limit: int = Query(SEARCH_PAGE_SIZE, ge=0, le=SEARCH_MAX_PAGE_SIZE),
+    facets: int = Query(0, ge=0, le=1000, description="Number of tag facet counts to return"),
+):
+    index = tag_store.current()
+    not_modified = cached_response(request, response, index)
+    if not_modified:
+        return not_modified
+
+    ids = index.search(all_tags, any_tags, not_tags)
+    start = np.searchsorted(ids, index.decode_cursor(cursor), side="right") if cursor else 0
+    page = ids[start:start + limit]
+    next_cursor = index.encode_cursor(int(page[-1])) if len(page) and start + limit < len(ids) else None
+    return {
+        "total": int(len(ids)),
+        "items": [index.item(int(media_id)) for media_id in page],
+        "next_cursor": next_cursor,
+        "facets": index.facets(ids, facets),
+    }
+
+
+@app.get("/api/tags")
+def list_tags(
+    request: Request,
+    response: Response,
+    prefix: str = "",
+    limit: int = Query(SEARCH_PAGE_SIZE, ge=1, le=SEARCH_MAX_PAGE_SIZE),
+):
+    index = tag_store.current()
+    not_modified = cached_response(request, response, index)
+    if not_modified:
+        return not_modified
+
+    tags = [
+        {"tag": name, "count": int(index.tag_counts[tag_id])}
+        for tag_id, name in enumerate(index.tag_names) if name.startswith(prefix)
+    ]
+    tags.sort(key=lambda entry: (-entry["count"], entry["tag"]))
+    return {"total": len(tags), "tags": tags[:limit]}
+
+
+@app.get("/api/similar/{media_id}")
+def similar_media(
+    media_id: str,
+    limit: int = Query(tag_media.SIMILAR_LIMIT, ge=1, le=SEARCH_MAX_PAGE_SIZE),
+    min_score: float = Query(-1.0, ge=-1.0, le=1.0, description="Minimum cosine similarity, "
+                             f"e.g. {tag_media.DUPLICATE_THRESHOLD} for near-duplicates"),
+):
+    embedding_store.refresh()
+    if media_id not in embedding_store:
+        raise HTTPException(status_code=404, detail="No stored embedding for this media")
+    return {
+        "media_id": media_id,
+        "items": [{"media_id": other, "score": round(score, 4)}
+                  for other, score in embedding_store.similar(media_id, limit, min_score)],
+    }
+
+
+@app.api_route(f"{tag_media.THUMBNAIL_URL_PREFIX}/preview/{{name}}", methods=["GET", "HEAD"])
+async def read_preview(name: str, request: Request):
+    found = await preview_cache.get(name)
+    if found is None:
+        raise HTTPException(status_code=404, detail="Preview not found")
+    path, stat = found
+    headers = {
+        "ETag": f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"',
+        "Last-Modified": formatdate(stat.st_mtime, usegmt=True),
+        "Cache-Control": f"public, max-age={PREVIEW_CACHE_MAX_AGE}",
+    }
+    if not_modified(request, headers["ETag"], stat.st_mtime):
+        return Response(status_code=304, headers=headers)
+    # FileResponse answers Range requests and hands the file to the server via pathsend when supported
+    kind = preview_cache.parse_name(name)[1]
+    media_type = "image/jpeg" if kind == "jpeg" else tag_media.PREVIEW_FORMATS[kind]["media_type"]
+    return FileResponse(path, media_type=media_type, headers=headers, stat_result=stat)
+
+
+@app.post("/api/jobs", status_code=202)
+def create_job(request: JobRequest):
+    if not TAG_JOBS:
+        raise HTTPException(status_code=503, detail="Tag jobs are disabled (TAG_JOBS=0)")
+    if not request.paths and not request.media_ids:
+        raise HTTPException(status_code=400, detail="Give at least one path or media id")
+    rel_paths = [video_rel_path(path) for path in request.paths]
+    return job_service.submit(request, rel_paths)
+
+
+@app.get("/api/jobs")
+def list_jobs(limit: int = Query(50, ge=1, le=JOB_HISTORY)):
+    return {"jobs": job_service.recent(limit)}
 
 
-@app.get("/api/{item_id}")
-def read_item(item_id: int, q: Union[str, None] = None):
-    return {"item_id": item_id, "q": q}
+@app.get("/api/jobs/{job_id}")
+async def read_job(job_id: str, wait: float = Query(0, ge=0, le=60, description="Seconds to wait for the job to finish")):
+    deadline = time.monotonic() + wait
+    while True:
+        job = job_service.snapshot(job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail="Job not found")
+        if job["status"] == "done" or time.monotonic() >= deadline:
+            return job
+        await asyncio.sleep(0.02)
 
 if __name__ == "__main__":
     try:
@@ -1,21 +1,57 @@
 # todo: requirements, settings ini file, sanitizing filenames
 
+from __future__ import annotations
+
+import time
+IMPORT_STARTED = time.perf_counter()
+
 import os
+import sys
+import atexit
+import bisect
+import functools
+import itertools
+import importlib
 import logging
+import logging.handlers
 import subprocess
 import csv
 from pathlib import Path
-import ffmpeg
 import shutil
-import time
+import argparse
+import json
+import sqlite3
+import tempfile
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from colorama import init, Fore, Style
 from tqdm import tqdm
 from dotenv import load_dotenv
-from PIL import Image
-from transformers import pipeline
-import pandas as pd
 import hashlib
 
+class LazyModule:
+    """Stand-in for a module that is imported on first attribute access.
+
+    Thumbnail-only and cleanup-only runs never touch NumPy or Pillow, so they
+    should not pay for importing them. The import goes through the regular
+    import lock, so loader threads can race to it safely, and the module's
+    namespace is then copied in so later lookups skip __getattr__.
+    """
+
+    def __init__(self, name: str):
+        self.__dict__["_LazyModule__name"] = name
+
+    def __getattr__(self, attr: str):
+        module = importlib.import_module(self.__name)
+        self.__dict__.update(module.__dict__)
+        return getattr(module, attr)
+
+np = LazyModule("numpy")
+Image = LazyModule("PIL.Image")
+
 # Initialize colorama for colored console output
 init(autoreset=True)
 
@@ -29,6 +65,64 @@ TAGS_CSV = os.getenv("TAGS_CSV", "../public/tags.csv")
 INPUT_TAGS = os.getenv("INPUT_TAGS", "../public/selected_tags.csv")
 EXCLUSIONS = os.getenv("EXCLUSIONS", "../public/exclusions.csv")
 THUMBNAIL_URL_PREFIX = os.getenv("THUMBNAIL_URL_PREFIX", "/thumbnails")
+TAG_BATCH_SIZE = int(os.getenv("TAG_BATCH_SIZE", 16))
+TAG_LOADER_WORKERS = int(os.getenv("TAG_LOADER_WORKERS", 4))
+MAX_TAGS = 20
+TAGS_FIELDS = ["media_id", "media_type"] + [f"tag{i}" for i in range(1, MAX_TAGS + 1)]
+VIDEO_EXTENSIONS = (".mp4", ".webm")
+PROBE_WORKERS = int(os.getenv("PROBE_WORKERS", 4))
+FFMPEG_WORKERS = int(os.getenv("FFMPEG_WORKERS", max(1, (os.cpu_count() or 2) // 2)))
+FFMPEG_THREADS = int(os.getenv("FFMPEG_THREADS", 2))  # 0 lets ffmpeg pick
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", 64))
+MANIFEST_DB = os.getenv("MANIFEST_DB", "media_manifest.db")
+CHECKPOINT_INTERVAL = float(os.getenv("CHECKPOINT_INTERVAL", 60))
+FINGERPRINT_MODE = os.getenv("FINGERPRINT_MODE", "fast").lower()  # off, fast (matches confirmed in full), or full
+FINGERPRINT_WORKERS = int(os.getenv("FINGERPRINT_WORKERS", 4))
+FINGERPRINT_SAMPLES = 16
+FINGERPRINT_BLOCK_SIZE = 64 * 1024
+HASH_BUFFER_SIZE = 8 * 1024 * 1024
+CLIP_MODEL = os.getenv("CLIP_MODEL", "openai/clip-vit-base-patch32")
+CANDIDATE_TAG_LIMIT = int(os.getenv("CANDIDATE_TAG_LIMIT", 50))  # 0 keeps the whole vocabulary
+TEXT_EMBEDDINGS_CACHE = os.getenv("TEXT_EMBEDDINGS_CACHE", ".cache/text_embeddings")
+EMBEDDINGS_DIR = os.getenv("EMBEDDINGS_DIR", ".cache/image_embeddings")  # empty disables the image embedding store
+EMBEDDING_BLOCK_ROWS = 4096  # stored embeddings scored per matrix multiply
+SIMILAR_LIMIT = int(os.getenv("SIMILAR_LIMIT", 10))
+DUPLICATE_THRESHOLD = float(os.getenv("DUPLICATE_THRESHOLD", 0.95))  # cosine similarity of near-duplicate videos
+HYPOTHESIS_TEMPLATE = "This is a photo of {}."
+TAG_SOURCE = os.getenv("TAG_SOURCE", "thumbnail").lower()  # thumbnail, or frames decoded from the video
+TAG_FRAMES = int(os.getenv("TAG_FRAMES", 8))
+TAG_FRAME_SAMPLING = os.getenv("TAG_FRAME_SAMPLING", "uniform").lower()  # uniform or keyframes
+TAG_FRAME_POOLING = os.getenv("TAG_FRAME_POOLING", "mean").lower()  # mean or max
+TAG_FRAME_SIZE = 224
+TAG_ENGINE = os.getenv("TAG_ENGINE", "torch").lower()  # torch, onnx, or onnx-int8
+TAG_INTRA_OP_THREADS = int(os.getenv("TAG_INTRA_OP_THREADS", 0))  # 0 lets the engine pick
+TAG_INTER_OP_THREADS = int(os.getenv("TAG_INTER_OP_THREADS", 0))
+TAG_ENGINES = ("torch", "onnx", "onnx-int8")
+ONNX_CACHE = os.getenv("ONNX_CACHE", ".cache/onnx")
+ONNX_OPSET = 17
+IMPORT_TIME_BUDGET = float(os.getenv("IMPORT_TIME_BUDGET", 0.25))  # seconds, checked by --import-time
+PREVIEW_FORMAT = os.getenv("PREVIEW_FORMAT", "gif").lower()  # gif, webp, mp4 (H.264), or webm (VP9)
+PREVIEW_SECONDS = float(os.getenv("PREVIEW_SECONDS", 2))
+PREVIEW_SELECTION = os.getenv("PREVIEW_SELECTION", "fixed").lower()  # fixed offsets (fastest), or scored keyframes
+PREVIEW_CANDIDATES = int(os.getenv("PREVIEW_CANDIDATES", 16))  # keyframes scored per video in keyframes mode
+SELECTION_SIZE = (128, 72)  # grayscale size candidates are scored at
+PREVIEW_FPS = int(os.getenv("PREVIEW_FPS", 10))
+GIF_COLORS = int(os.getenv("GIF_COLORS", 128))  # palette size, 2-256
+WEBP_QUALITY = int(os.getenv("WEBP_QUALITY", 60))  # 0-100
+MP4_CRF = int(os.getenv("MP4_CRF", 30))  # 0-51, lower is better and bigger
+WEBM_CRF = int(os.getenv("WEBM_CRF", 40))  # 0-63, lower is better and bigger
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR", "backup")
+SNAPSHOT_LINK = os.getenv("SNAPSHOT_LINK", "hardlink").lower()  # hardlink, or reflink (copy-on-write clone)
+SNAPSHOT_KEEP = int(os.getenv("SNAPSHOT_KEEP", 5))  # 0 keeps any number
+SNAPSHOT_MAX_AGE_DAYS = float(os.getenv("SNAPSHOT_MAX_AGE_DAYS", 30))  # 0 keeps any age
+SNAPSHOT_MAX_MB = int(os.getenv("SNAPSHOT_MAX_MB", 0))  # disk held only by snapshots, 0 for no limit
+FICLONE = 0x40049409  # Linux ioctl cloning a file's blocks (Btrfs, XFS, bcachefs)
+SHARD = os.getenv("SHARD", "")  # "INDEX/COUNT" to process one shard of VIDEO_DIR, e.g. "0/4"
+SHARD_MODE = os.getenv("SHARD_MODE", "hash").lower()  # hash of the video id (file stem), or index in the sorted video ids
+SHARD_MODES = ("hash", "index")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "DEBUG").upper()
+METRICS_JSON = os.getenv("METRICS_JSON", "media_metrics.json")  # empty skips the end-of-run summary file
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)  # seconds
 DEFAULT_CANDIDATE_TAGS = [
     "cat", "dog", "car", "tree", "sky", "building", "person", "landscape", "night", "day",
     "beach", "forest", "city", "food", "animal", "water", "mountain", "road", "cloud", "sun"
@@ -52,9 +146,23 @@ class ColoredFormatter(logging.Formatter):
         log_message = super().format(record)
         return f"{self.COLORS.get(record.levelname, Fore.CYAN)}{log_message}{Style.RESET_ALL}"
 
+def queue_logging(target: logging.Logger, handlers: list) -> logging.handlers.QueueListener:
+    """Send target's records through a queue to handlers running on a listener thread.
+
+    Callers only pay for putting the record on the queue; formatting and the
+    console and file writes happen on the listener thread, which is drained
+    when the interpreter exits.
+    """
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    target.addHandler(logging.handlers.QueueHandler(log_queue))
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
 # Configure logging
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)
+logger.setLevel(LOG_LEVEL)
 
 file_handler = logging.FileHandler('media_processing.log')
 file_handler.setLevel(logging.DEBUG)
@@ -70,8 +178,143 @@ console_handler.setFormatter(ColoredFormatter(
     datefmt='%Y-%m-%d %H:%M:%S'
 ))
 
-logger.addHandler(file_handler)
-logger.addHandler(console_handler)
+log_listener = queue_logging(logger, [file_handler, console_handler])
+logger.propagate = False  # libraries that configure the root logger would otherwise repeat every line
+
+def flush_logs():
+    """Wait until every queued record has been written, e.g. before prompting on the console."""
+    log_listener.stop()
+    log_listener.start()
+
+class Metrics:
+    """Thread-safe counters, gauges and latency histograms, exported as JSON or Prometheus text.
+
+    A series is a metric name plus its labels. Histograms keep one count per
+    METRIC_BUCKETS bucket and a sum, so recording a value is a lock and a
+    bisect, and memory stays fixed however many videos go through.
+    """
+
+    def __init__(self, buckets: tuple = METRIC_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.kinds = {}  # name -> counter, gauge, or histogram
+        self.help = {}
+        self.values = {}  # (name, labels) -> value of a counter or gauge
+        self.histograms = {}  # (name, labels) -> {"counts": per bucket plus one over the last, "sum", "max"}
+
+    def describe(self, name: str, text: str):
+        self.help[name] = text
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.kinds.setdefault(name, "counter")
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def set(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.kinds.setdefault(name, "gauge")
+            self.values[key] = value
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.kinds.setdefault(name, "histogram")
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {"counts": [0] * (len(self.buckets) + 1), "sum": 0.0, "max": 0.0}
+            histogram["counts"][bisect.bisect_left(self.buckets, seconds)] += 1
+            histogram["sum"] += seconds
+            histogram["max"] = max(histogram["max"], seconds)
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def timed(self, name: str, **labels):
+        """Decorator observing how long each call of the function takes."""
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.timer(name, **labels):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def quantile(self, histogram: dict, q: float) -> float:
+        """Estimate a quantile from bucket counts, interpolating within the bucket like Prometheus."""
+        counts = histogram["counts"]
+        rank, seen = q * sum(counts), 0
+        for k, bound in enumerate(self.buckets):
+            if counts[k] and seen + counts[k] >= rank:
+                lower = self.buckets[k - 1] if k else 0.0
+                return min(lower + (bound - lower) * (rank - seen) / counts[k], histogram["max"])
+            seen += counts[k]
+        return histogram["max"]
+
+    def snapshot(self) -> tuple[dict, dict]:
+        with self.lock:
+            return dict(self.values), {key: {**histogram, "counts": list(histogram["counts"])}
+                                       for key, histogram in self.histograms.items()}
+
+    def summary(self) -> dict:
+        """{name: {"label=value,...": value or histogram stats}} with p50/p95 estimated in seconds."""
+        values, histograms = self.snapshot()
+        result = {}
+        for (name, labels), value in sorted(values.items()):
+            result.setdefault(name, {})[",".join(f"{k}={v}" for k, v in labels)] = value
+        for (name, labels), histogram in sorted(histograms.items()):
+            count = sum(histogram["counts"])
+            result.setdefault(name, {})[",".join(f"{k}={v}" for k, v in labels)] = {
+                "count": count,
+                "sum": round(histogram["sum"], 4),
+                "mean": round(histogram["sum"] / count, 4),
+                "p50": round(self.quantile(histogram, 0.5), 4),
+                "p95": round(self.quantile(histogram, 0.95), 4),
+                "max": round(histogram["max"], 4),
+            }
+        return result
+
+    def prometheus(self) -> str:
+        """Every series in the Prometheus text exposition format."""
+        def label_text(labels: tuple) -> str:
+            if not labels:
+                return ""
+            escaped = [str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in labels]
+            return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + "}"
+
+        values, histograms = self.snapshot()
+        series = {}
+        for (name, labels), value in sorted(values.items()):
+            series.setdefault(name, []).append(f"{name}{label_text(labels)} {value}")
+        for (name, labels), histogram in sorted(histograms.items()):
+            lines, cumulative = series.setdefault(name, []), 0
+            for bound, count in zip(self.buckets, histogram["counts"]):
+                cumulative += count
+                lines.append(f"{name}_bucket{label_text(labels + (('le', bound),))} {cumulative}")
+            total = sum(histogram["counts"])
+            lines.append(f"{name}_bucket{label_text(labels + (('le', '+Inf'),))} {total}")
+            lines.append(f"{name}_sum{label_text(labels)} {histogram['sum']}")
+            lines.append(f"{name}_count{label_text(labels)} {total}")
+        out = []
+        for name in sorted(series):
+            if name in self.help:
+                out.append(f"# HELP {name} {self.help[name]}")
+            out.append(f"# TYPE {name} {self.kinds[name]}")
+            out += series[name]
+        return "\n".join(out) + "\n"
+
+metrics = Metrics()
+metrics.describe("tag_media_stage_seconds", "Seconds per call of each processing stage")
+metrics.describe("tag_media_ffmpeg_failures_total", "ffmpeg and ffprobe runs that failed")
+metrics.describe("tag_media_bytes_written_total", "Bytes of preview files written")
+metrics.describe("tag_media_images_tagged_total", "Images and frame sets scored by the tagger")
+metrics.describe("tag_media_videos_total", "Videos finished by the pipeline, by outcome")
 
 def get_path(*segments: str) -> Path:
     """Generate a path relative to the project, handling .env variables."""
@@ -82,110 +325,359 @@ def get_path(*segments: str) -> Path:
         logger.error(f"Failed to resolve path for {segments}: {str(e)}")
         raise
 
-def get_file_hash(file_path: str) -> str:
-    """Compute SHA256 hash of a file."""
+@metrics.timed("tag_media_stage_seconds", stage="fingerprint")
+def get_file_hash(file_path: str, mode: str = "full") -> str:
+    """Compute a SHA256 content fingerprint of a file, prefixed with the mode used.
+
+    "full" hashes the whole file through a large reusable buffer. "fast" hashes
+    the file size plus the head, tail, and FINGERPRINT_SAMPLES evenly spaced
+    blocks, so its cost does not grow with file size.
+    """
     sha256 = hashlib.sha256()
     try:
         with open(file_path, "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                sha256.update(chunk)
-        return sha256.hexdigest()
+            if mode == "fast":
+                size = os.fstat(f.fileno()).st_size
+                sha256.update(str(size).encode())
+                last = max(size - FINGERPRINT_BLOCK_SIZE, 0)
+                offsets = {0, last, *(last * n // (FINGERPRINT_SAMPLES + 1) for n in range(1, FINGERPRINT_SAMPLES + 1))}
+                for offset in sorted(offsets):
+                    f.seek(offset)
+                    sha256.update(f.read(FINGERPRINT_BLOCK_SIZE))
+            else:
+                buffer = bytearray(HASH_BUFFER_SIZE)
+                view = memoryview(buffer)
+                while n := f.readinto(buffer):
+                    sha256.update(view[:n])
+        return f"{mode}:{sha256.hexdigest()}"
     except Exception as e:
         logger.error(f"Failed to hash {file_path}: {str(e)}")
         return ""
 
+@metrics.timed("tag_media_stage_seconds", stage="probe")
 def get_video_duration(file_path: str) -> float:
     """Get video duration using ffprobe."""
     try:
-        probe = ffmpeg.probe(file_path)
-        duration = float(probe["format"]["duration"])
+        result = subprocess.run(
+            ["ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "json", file_path],
+            check=True, capture_output=True, text=True
+        )
+        duration = float(json.loads(result.stdout)["format"]["duration"])
         logger.info(f"Duration for {file_path}: {duration:.2f}s")
         return duration
-    except ffmpeg.Error as e:
-        logger.error(f"FFprobe error for {file_path}: {e.stderr.decode()}")
+    except subprocess.CalledProcessError as e:
+        metrics.inc("tag_media_ffmpeg_failures_total", tool="ffprobe")
+        logger.error(f"FFprobe error for {file_path}: {e.stderr}")
         return 0
     except Exception as e:
+        metrics.inc("tag_media_ffmpeg_failures_total", tool="ffprobe")
         logger.error(f"Unexpected error getting duration for {file_path}: {str(e)}")
         return 0
 
-def generate_jpeg(file_path: str, video_id: str, duration: float) -> str:
-    """Generate a JPEG thumbnail at 10% of duration, 480x270."""
+PREVIEW_FILTER = "scale=480:270:force_original_aspect_ratio=decrease,pad=480:270:(ow-iw)/2:(oh-ih)/2"
+
+# Animated preview formats: file extension, HTTP media type, the end of the filter
+# chain after scaling, and the encoder options. The GIF palette is computed from
+# the clip itself (palettegen) and applied in the same graph (paletteuse).
+PREVIEW_FORMATS = {
+    "gif": {
+        "extension": "gif",
+        "media_type": "image/gif",
+        "filter": f"split[colors][frames];[colors]palettegen=max_colors={GIF_COLORS}:stats_mode=diff[palette];"
+                  "[frames][palette]paletteuse=dither=bayer:bayer_scale=3:diff_mode=rectangle",
+        "options": ["-c:v", "gif", "-loop", "0", "-f", "gif"],
+    },
+    "webp": {
+        "extension": "webp",
+        "media_type": "image/webp",
+        "filter": "format=yuv420p",
+        "options": ["-c:v", "libwebp_anim", "-quality", str(WEBP_QUALITY), "-compression_level", "4",
+                    "-loop", "0", "-f", "webp"],
+    },
+    "mp4": {
+        "extension": "mp4",
+        "media_type": "video/mp4",
+        "filter": "format=yuv420p",
+        "options": ["-c:v", "libx264", "-preset", "veryfast", "-crf", str(MP4_CRF), "-an",
+                    "-movflags", "+faststart", "-f", "mp4"],
+    },
+    "webm": {
+        "extension": "webm",
+        "media_type": "video/webm",
+        "filter": "format=yuv420p",
+        "options": ["-c:v", "libvpx-vp9", "-crf", str(WEBM_CRF), "-b:v", "0", "-deadline", "realtime",
+                    "-cpu-used", "8", "-row-mt", "1", "-an", "-f", "webm"],
+    },
+}
+
+def preview_url(filename: str) -> str:
+    """Return the public URL of a file in THUMBS_DIR/preview."""
+    return f"{THUMBNAIL_URL_PREFIX}/preview/{filename}"
+
+def animation_name(video_id: str, preview_format: str = None) -> str:
+    """File name of a video's animated preview in preview_format (default PREVIEW_FORMAT)."""
+    return f"{video_id}.{PREVIEW_FORMATS[preview_format or PREVIEW_FORMAT]['extension']}"
+
+def parse_preview_name(name: str):
+    """(video_id, kind) of a preview file name, kind being "jpeg" or a PREVIEW_FORMATS key, or None."""
+    if name.endswith("_thumb.jpg"):
+        return name[:-len("_thumb.jpg")], "jpeg"
+    video_id, _, extension = name.rpartition(".")
+    for preview_format, spec in PREVIEW_FORMATS.items():
+        if video_id and extension == spec["extension"]:
+            return video_id, preview_format
+    return None
+
+@metrics.timed("tag_media_stage_seconds", stage="preview")
+def generate_previews(file_path: str, video_id: str, duration: float, jpeg: bool = True,
+                      animation: bool = True, preview_format: str = None) -> tuple[str, str]:
+    """Generate the JPEG thumbnail and/or animated preview for a video in a single ffmpeg run.
+
+    Each output gets its own input-side -ss, so ffmpeg seeks to the nearest
+    keyframe before decoding instead of decoding from the start of the file.
+    The JPEG is taken at 10% and the animation starts at 50% of the duration,
+    or, with PREVIEW_SELECTION=keyframes, at the keyframes select_preview_times()
+    picks. The animation is written in preview_format (default PREVIEW_FORMAT).
+    Outputs are written to .part files and renamed into place on success.
+    Returns (jpeg_url, animation_url), with "" for outputs not requested or failed.
+    """
+    preview_format = preview_format or PREVIEW_FORMAT
+    selected = select_preview_times(file_path, duration) if PREVIEW_SELECTION == "keyframes" else None
+    jpeg_time, animation_time = selected or (duration * 0.1, duration * 0.5)
+    # Selected times are keyframes, and seeking without -accurate_seek lands back on exactly them
+    keyframe_seek = ["-noaccurate_seek"] if selected else []
     preview_dir = get_path(THUMBS_DIR, "preview")
     preview_dir.mkdir(parents=True, exist_ok=True)
     jpeg_path = preview_dir / f"{video_id}_thumb.jpg"
+    animation_path = preview_dir / animation_name(video_id, preview_format)
+
+    threads = ["-threads", str(FFMPEG_THREADS)] if FFMPEG_THREADS > 0 else []
+    inputs, filters, outputs, targets = [], [], [], []
+    if jpeg:
+        timestamp = min(max(jpeg_time, 0), duration)
+        inputs += [*threads, *(["-skip_frame", "nokey"] if selected else []), *keyframe_seek,
+                   "-ss", str(timestamp), "-i", file_path]
+        filters.append(f"[{len(targets)}:v]{PREVIEW_FILTER}[thumb]")
+        # passthrough keeps the lone keyframe, which frame-rate conversion would drop when non-key frames are skipped
+        outputs += ["-map", "[thumb]", "-frames:v", "1", "-fps_mode", "passthrough", "-q:v", "6", "-f", "mjpeg",
+                    f"{jpeg_path}.part"]
+        targets.append(("JPEG", jpeg_path))
+    if animation:
+        spec = PREVIEW_FORMATS[preview_format]
+        start_time = min(max(animation_time, 0), duration)
+        inputs += [*threads, *keyframe_seek, "-ss", str(start_time), "-t", str(PREVIEW_SECONDS), "-i", file_path]
+        filters.append(f"[{len(targets)}:v]fps={PREVIEW_FPS},{PREVIEW_FILTER},{spec['filter']}[anim]")
+        outputs += ["-map", "[anim]", *threads, *spec["options"], f"{animation_path}.part"]
+        targets.append((preview_format.upper(), animation_path))
+    if not targets:
+        return "", ""
 
-    timestamp = min(max(duration * 0.1, 0), duration)
     try:
         subprocess.run(
-            [
-                "ffmpeg", "-i", file_path, "-ss", str(timestamp), "-vframes", "1",
-                "-vf", "scale=480:270:force_original_aspect_ratio=decrease,pad=480:270:(ow-iw)/2:(oh-ih)/2",
-                "-q:v", "6", str(jpeg_path), "-y"
-            ],
+            ["ffmpeg", "-y", *inputs, *(["-filter_complex_threads", str(FFMPEG_THREADS)] if threads else []),
+             "-filter_complex", ";".join(filters), *outputs],
             check=True, capture_output=True, text=True
         )
-        jpeg_size = jpeg_path.stat().st_size / 1024
-        logger.log(logging.SUCCESS, f"Generated JPEG for {video_id}: {jpeg_path} ({jpeg_size:.2f} KB)")
-        return f"{THUMBNAIL_URL_PREFIX}/preview/{video_id}_thumb.jpg"
+        for label, path in targets:
+            Path(f"{path}.part").replace(path)
+            size = path.stat().st_size
+            metrics.inc("tag_media_bytes_written_total", size, format=label.lower())
+            logger.log(logging.SUCCESS, f"Generated {label} for {video_id}: {path} ({size / 1024:.2f} KB)")
+        return (preview_url(jpeg_path.name) if jpeg else "", preview_url(animation_path.name) if animation else "")
     except subprocess.CalledProcessError as e:
-        logger.error(f"FFmpeg JPEG error for {video_id}: {e.stderr}")
-        return ""
+        metrics.inc("tag_media_ffmpeg_failures_total", tool="ffmpeg")
+        logger.error(f"FFmpeg preview error for {video_id}: {e.stderr}")
     except Exception as e:
-        logger.error(f"Unexpected error generating JPEG for {video_id}: {str(e)}")
-        return ""
+        metrics.inc("tag_media_ffmpeg_failures_total", tool="ffmpeg")
+        logger.error(f"Unexpected error generating previews for {video_id}: {str(e)}")
+    for _, path in targets:
+        Path(f"{path}.part").unlink(missing_ok=True)
+    return "", ""
 
-def generate_gif(file_path: str, video_id: str, duration: float) -> str:
-    """Generate a 2-second GIF at 10% of duration, 640x360, 10 fps."""
-    preview_dir = get_path(THUMBS_DIR, "preview")
-    preview_dir.mkdir(parents=True, exist_ok=True)
-    gif_path = preview_dir / f"{video_id}.gif"
+def generate_jpeg(file_path: str, video_id: str, duration: float) -> str:
+    """Generate a 480x270 JPEG thumbnail at 10% of duration, or at the best keyframe."""
+    return generate_previews(file_path, video_id, duration, animation=False)[0]
+
+def generate_animation(file_path: str, video_id: str, duration: float, preview_format: str = None) -> str:
+    """Generate a PREVIEW_SECONDS 480x270 animation at PREVIEW_FPS fps from 50% of duration, or the best keyframe."""
+    return generate_previews(file_path, video_id, duration, jpeg=False, preview_format=preview_format)[1]
 
-    start_time = min(max(duration * 0.5, 0), duration)
+def frame_timestamps(duration: float, count: int) -> list:
+    """Return count timestamps at the centres of equal slices of the video."""
+    return [duration * (k + 0.5) / count for k in range(count)]
+
+def keyframe_candidates(file_path: str, duration: float, count: int = PREVIEW_CANDIDATES):
+    """Decode the keyframe at or before each of count evenly spaced timestamps as small grayscale frames.
+
+    Returns (timestamps, (count, height, width) uint8 array), or None on failure.
+    Every input seeks without -accurate_seek and skips non-key frames, so exactly
+    one keyframe is decoded per timestamp and the cost does not grow with the
+    length of the video.
+    """
+    width, height = SELECTION_SIZE
+    threads = ["-threads", str(FFMPEG_THREADS)] if FFMPEG_THREADS > 0 else []
+    timestamps = frame_timestamps(duration, count)
+    inputs, filters = [], []
+    for k, timestamp in enumerate(timestamps):
+        inputs += [*threads, "-skip_frame", "nokey", "-noaccurate_seek", "-ss", f"{timestamp:.3f}",
+                   "-t", "1", "-i", file_path]
+        filters.append(f"[{k}:v]trim=end_frame=1,scale={width}:{height},format=gray[f{k}]")
+    concat = "".join(f"[f{k}]" for k in range(count))
     try:
-        subprocess.run(
-            [
-                "ffmpeg", "-i", file_path, "-ss", str(start_time), "-t", "2",
-                "-vf", "fps=10,scale=480:270:force_original_aspect_ratio=decrease,pad=480:270:(ow-iw)/2:(oh-ih)/2",
-                "-c:v", "gif", "-crf", "28", str(gif_path), "-y"
-            ],
-            check=True, capture_output=True, text=True
+        result = subprocess.run(
+            ["ffmpeg", *inputs, "-filter_complex", ";".join(filters) + f";{concat}concat=n={count}:v=1:a=0[out]",
+             "-map", "[out]", "-an", "-fps_mode", "passthrough", "-f", "rawvideo", "-pix_fmt", "gray", "pipe:1"],
+            check=True, capture_output=True
         )
-        gif_size = gif_path.stat().st_size / 1024
-        logger.log(logging.SUCCESS, f"Generated GIF for {video_id}: {gif_path} ({gif_size:.2f} KB)")
-        return f"{THUMBNAIL_URL_PREFIX}/preview/{video_id}.gif"
+        if len(result.stdout) != count * width * height:
+            logger.warning(f"FFmpeg returned {len(result.stdout) // (width * height)}/{count} keyframes for {file_path}")
+            return None
+        return timestamps, np.frombuffer(result.stdout, dtype=np.uint8).reshape(count, height, width)
     except subprocess.CalledProcessError as e:
-        logger.error(f"FFmpeg GIF error for {video_id}: {e.stderr}")
-        return ""
+        metrics.inc("tag_media_ffmpeg_failures_total", tool="ffmpeg")
+        logger.error(f"FFmpeg keyframe decode error for {file_path}: {e.stderr.decode(errors='replace')}")
     except Exception as e:
-        logger.error(f"Unexpected error generating GIF for {video_id}: {str(e)}")
-        return ""
+        logger.error(f"Unexpected error decoding keyframes from {file_path}: {str(e)}")
+    return None
+
+def score_keyframes(frames: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """(usable, quality, change) per frame of a (frames, height, width) grayscale array.
+
+    Frames that are nearly black, nearly white or flat (fades, blank title
+    cards) are not usable. Quality mixes sharpness (variance of the Laplacian)
+    and contrast; change is the difference from the previous candidate, which
+    is high at scene cuts. Both are scaled to 0-1 over the candidates.
+    """
+    pixels = frames.astype(np.float32) / 255
+    brightness = pixels.mean(axis=(1, 2))
+    contrast = pixels.std(axis=(1, 2))
+    laplacian = (4 * pixels[:, 1:-1, 1:-1] - pixels[:, :-2, 1:-1] - pixels[:, 2:, 1:-1]
+                 - pixels[:, 1:-1, :-2] - pixels[:, 1:-1, 2:])
+    sharpness = laplacian.var(axis=(1, 2))
+    change = np.abs(np.diff(pixels, axis=0)).mean(axis=(1, 2))
+    change = np.concatenate([change[:1], change]) if len(change) else np.zeros(len(pixels), dtype=np.float32)
+
+    def scaled(values: np.ndarray) -> np.ndarray:
+        top = values.max() if len(values) else 0
+        return values / top if top > 0 else np.zeros_like(values)
+
+    usable = (brightness > 0.1) & (brightness < 0.9) & (contrast > 0.04)
+    return usable, 0.6 * scaled(sharpness) + 0.4 * scaled(contrast), scaled(change)
+
+@metrics.timed("tag_media_stage_seconds", stage="select")
+def select_preview_times(file_path: str, duration: float):
+    """Pick keyframe timestamps for the JPEG and the animation, or None to fall back to fixed offsets.
+
+    The JPEG gets the best-quality usable keyframe. The animation starts at the
+    usable keyframe with the best mix of quality and scene change that leaves
+    PREVIEW_SECONDS before the end, so the loop opens on a fresh shot.
+    """
+    candidates = keyframe_candidates(file_path, duration)
+    if candidates is None:
+        return None
+    timestamps, frames = candidates
+    usable, quality, change = score_keyframes(frames)
+    if not usable.any():
+        logger.debug(f"No usable keyframes in {file_path}, using fixed offsets")
+        return None
+    jpeg_index = int(np.argmax(np.where(usable, quality, -1)))
+    fits = usable & (np.asarray(timestamps) + PREVIEW_SECONDS <= duration)
+    animation_score = np.where(fits, 0.5 * quality + 0.5 * change, -1)
+    animation_time = timestamps[int(np.argmax(animation_score))] if fits.any() else duration * 0.5
+    logger.debug(f"Selected keyframes for {file_path}: JPEG at {timestamps[jpeg_index]:.2f}s, "
+                 f"animation at {animation_time:.2f}s")
+    return timestamps[jpeg_index], animation_time
+
+@metrics.timed("tag_media_stage_seconds", stage="frames")
+def extract_frames(file_path: str, duration: float, count: int = TAG_FRAMES,
+                   sampling: str = TAG_FRAME_SAMPLING):
+    """Decode sampled frames straight into a (frames, 224, 224, 3) uint8 array, or None on failure.
+
+    Frames are scaled and centre-cropped to the CLIP input size inside ffmpeg
+    and piped out as raw RGB, so no image files are written or re-decoded.
+    "uniform" seeks to count evenly spaced timestamps; "keyframes" decodes only
+    keyframes, up to 4 * count of them spaced out over the video, and keeps
+    count evenly spread ones. Videos with fewer than count keyframes, like
+    short clips with a single one, fall back to "uniform".
+    """
+    size = TAG_FRAME_SIZE
+    crop = f"scale={size}:{size}:force_original_aspect_ratio=increase:flags=bicubic,crop={size}:{size},setsar=1"
+    threads = ["-threads", str(FFMPEG_THREADS)] if FFMPEG_THREADS > 0 else []
+    if sampling == "keyframes":
+        spacing = max(duration, 1) / (4 * count)
+        command = ["ffmpeg", *threads, "-skip_frame", "nokey", "-i", file_path,
+                   "-vf", f"select='isnan(prev_selected_t)+gte(t-prev_selected_t,{spacing:.3f})',{crop}",
+                   "-frames:v", str(4 * count)]
+    else:
+        inputs, filters = [], []
+        for k, timestamp in enumerate(frame_timestamps(duration, count)):
+            inputs += [*threads, "-ss", f"{timestamp:.3f}", "-t", "2", "-i", file_path]
+            filters.append(f"[{k}:v]trim=end_frame=1,{crop}[f{k}]")
+        concat = "".join(f"[f{k}]" for k in range(count))
+        command = ["ffmpeg", *inputs, "-filter_complex",
+                   ";".join(filters) + f";{concat}concat=n={count}:v=1:a=0[out]", "-map", "[out]"]
+    try:
+        result = subprocess.run(
+            [*command, "-an", "-fps_mode", "passthrough", "-f", "rawvideo", "-pix_fmt", "rgb24", "pipe:1"],
+            check=True, capture_output=True
+        )
+        frame_bytes = size * size * 3
+        usable = len(result.stdout) // frame_bytes * frame_bytes
+        if sampling == "keyframes" and usable < count * frame_bytes:
+            logger.debug(f"{file_path} has {usable // frame_bytes} keyframes, sampling {count} frames uniformly")
+            return extract_frames(file_path, duration, count, "uniform")
+        if not usable:
+            logger.error(f"FFmpeg returned no frames for {file_path}")
+            return None
+        frames = np.frombuffer(result.stdout[:usable], dtype=np.uint8).reshape(-1, size, size, 3)
+        if sampling == "keyframes":
+            frames = frames[np.linspace(0, len(frames) - 1, count).round().astype(int)]
+        return frames
+    except subprocess.CalledProcessError as e:
+        metrics.inc("tag_media_ffmpeg_failures_total", tool="ffmpeg")
+        logger.error(f"FFmpeg frame extraction error for {file_path}: {e.stderr.decode(errors='replace')}")
+    except Exception as e:
+        metrics.inc("tag_media_ffmpeg_failures_total", tool="ffmpeg")
+        logger.error(f"Unexpected error extracting frames from {file_path}: {str(e)}")
+    return None
 
 def load_candidate_tags() -> list:
     """Load candidate tags from INPUT_TAGS, exclude tags from EXCLUSIONS, fallback to DEFAULT_CANDIDATE_TAGS."""
     logger.info(f"Loading candidate tags from {INPUT_TAGS}...")
     try:
-        df = pd.read_csv(INPUT_TAGS, dtype={'tag_id': str, 'name': str, 'category': str, 'count': int})
-        if not all(col in df.columns for col in ['tag_id', 'name', 'category', 'count']):
-            logger.error(f"Invalid CSV format in {INPUT_TAGS}: Missing required columns")
-            return DEFAULT_CANDIDATE_TAGS
-        if df['tag_id'].duplicated().any():
+        with open(INPUT_TAGS, "r", newline="", encoding="utf-8") as f:
+            reader = csv.DictReader(f)
+            if not all(col in (reader.fieldnames or []) for col in ['tag_id', 'name', 'category', 'count']):
+                logger.error(f"Invalid CSV format in {INPUT_TAGS}: Missing required columns")
+                return DEFAULT_CANDIDATE_TAGS
+            seen_ids, duplicate_ids, empty_names = set(), False, False
+            valid_tags = []
+            for row in reader:
+                duplicate_ids = duplicate_ids or row['tag_id'] in seen_ids
+                seen_ids.add(row['tag_id'])
+                name, count = row['name'] or '', int(row['count'])
+                if not name:
+                    empty_names = True
+                elif count > 100:
+                    valid_tags.append((count, name))
+        if duplicate_ids:
             logger.warning(f"Duplicate tag_ids found in {INPUT_TAGS}")
-        if df['name'].isna().any() or (df['name'] == '').any():
+        if empty_names:
             logger.warning(f"Empty or missing tag names in {INPUT_TAGS}")
-        valid_tags = df[df['name'].notna() & (df['name'] != '') & (df['count'] > 100)]
-        tags = valid_tags.sort_values('count', ascending=False)['name'].tolist()
+        tags = [name for _, name in sorted(valid_tags, key=lambda entry: entry[0], reverse=True)]
 
         excluded_tags = set()
         try:
-            exclusions_df = pd.read_csv(EXCLUSIONS)
-            if 'name' in exclusions_df.columns:
-                excluded_tags = set(exclusions_df['name'].dropna().str.lower())
-                logger.info(f"Loaded {len(excluded_tags)} excluded tags from {EXCLUSIONS}")
-            else:
-                logger.warning(f"No 'name' column found in {EXCLUSIONS}, skipping exclusions")
+            with open(EXCLUSIONS, "r", newline="", encoding="utf-8") as f:
+                reader = csv.DictReader(f)
+                if 'name' in (reader.fieldnames or []):
+                    excluded_tags = {row['name'].lower() for row in reader if row['name']}
+                    logger.info(f"Loaded {len(excluded_tags)} excluded tags from {EXCLUSIONS}")
+                else:
+                    logger.warning(f"No 'name' column found in {EXCLUSIONS}, skipping exclusions")
         except FileNotFoundError:
             logger.warning(f"{EXCLUSIONS} not found, skipping exclusions")
-        except pd.errors.ParserError:
+        except csv.Error:
             logger.warning(f"Failed to parse {EXCLUSIONS}: Invalid CSV format, skipping exclusions")
         except Exception as e:
             logger.error(f"Unexpected error loading {EXCLUSIONS}: {str(e)}")
@@ -195,74 +687,929 @@ def load_candidate_tags() -> list:
         if not filtered_tags:
             logger.warning(f"No valid tags remain after filtering exclusions from {INPUT_TAGS}")
             return DEFAULT_CANDIDATE_TAGS
+        if CANDIDATE_TAG_LIMIT > 0:
+            filtered_tags = filtered_tags[:CANDIDATE_TAG_LIMIT]
         logger.log(logging.SUCCESS, f"Loaded {len(filtered_tags)} candidate tags from {INPUT_TAGS}")
-        return filtered_tags[:50]
+        return filtered_tags
     except FileNotFoundError:
         logger.error(f"{INPUT_TAGS} not found")
         return DEFAULT_CANDIDATE_TAGS
-    except pd.errors.ParserError:
+    except csv.Error:
         logger.error(f"Failed to parse {INPUT_TAGS}: Invalid CSV format")
         return DEFAULT_CANDIDATE_TAGS
     except Exception as e:
         logger.error(f"Unexpected error loading {INPUT_TAGS}: {str(e)}")
         return DEFAULT_CANDIDATE_TAGS
 
-def tag_image(image_path: str, tagger, candidate_tags: list) -> list:
-    """Tag image using CLIP pipeline, return top 20 tags with confidence scores."""
+def get_vocabulary_version() -> str:
+    """Hash the model name, tag limit, and INPUT_TAGS/EXCLUSIONS contents into a cache key."""
+    sha256 = hashlib.sha256()
+    sha256.update(f"{CLIP_MODEL}|{HYPOTHESIS_TEMPLATE}|{CANDIDATE_TAG_LIMIT}".encode())
+    for source in (INPUT_TAGS, EXCLUSIONS):
+        try:
+            sha256.update(Path(source).read_bytes())
+        except OSError:
+            sha256.update(b"<missing>")
+        sha256.update(b"\0")
+    return sha256.hexdigest()[:16]
+
+def frame_settings_hash() -> str:
+    """Hash the frame-tagging settings, which change what a video's tags and embedding are made from."""
+    settings = f"frames|{TAG_FRAMES}|{TAG_FRAME_SAMPLING}|{TAG_FRAME_POOLING}|{TAG_FRAME_SIZE}"
+    return hashlib.sha256(settings.encode()).hexdigest()[:8]
+
+def get_tagging_version() -> str:
+    """Return the version recorded with tags: the vocabulary plus any frame-tagging settings."""
+    vocabulary_version = get_vocabulary_version()
+    if TAG_SOURCE != "frames":
+        return vocabulary_version
+    return f"{vocabulary_version}-{frame_settings_hash()}"
+
+def text_embeddings_path(model_name: str, engine: str, vocabulary_version: str) -> Path:
+    """Cache file of the candidate-tag text embeddings for a model, engine, and vocabulary."""
+    engine = "" if engine == "torch" else f"-{engine}"
+    return get_path(TEXT_EMBEDDINGS_CACHE, f"{model_name.replace('/', '--')}{engine}-{vocabulary_version}.npz")
+
+def model_output_features(output):
+    """Return projected embeddings from get_*_features across transformers versions."""
+    return getattr(output, "pooler_output", output)
+
+class TagScorer:
+    """Scores L2-normalized image embeddings against candidate-tag text embeddings.
+
+    This is the NumPy half of the CLIP taggers, and all that re-tagging from
+    stored image embeddings needs.
+    """
+
+    def __init__(self, labels: list, text_embeddings: np.ndarray, logit_scale: float):
+        self.labels = list(labels)
+        self.text_embeddings = text_embeddings
+        self.logit_scale = logit_scale
+
+    def probabilities(self, image_embeddings: np.ndarray) -> np.ndarray:
+        """Return each image's softmax distribution over the candidate tags."""
+        embeddings = np.ascontiguousarray(image_embeddings, dtype=np.float32)
+        logits = self.logit_scale * (embeddings @ self.text_embeddings.T)
+        logits -= logits.max(axis=-1, keepdims=True)
+        np.exp(logits, out=logits)
+        return logits / logits.sum(axis=-1, keepdims=True)
+
+    def top_tags(self, probs: np.ndarray) -> list:
+        """Return the top MAX_TAGS {label, score} dicts for each row of probabilities."""
+        k = min(MAX_TAGS, len(self.labels))
+        indices = np.argpartition(-probs, k - 1, axis=-1)[:, :k]
+        scores = np.take_along_axis(probs, indices, axis=-1)
+        order = np.argsort(-scores, axis=-1, kind="stable")
+        indices, scores = np.take_along_axis(indices, order, axis=-1), np.take_along_axis(scores, order, axis=-1)
+        return [
+            [{"label": self.labels[j], "score": score} for score, j in zip(row_scores, row_indices)]
+            for row_scores, row_indices in zip(scores.tolist(), indices.tolist())
+        ]
+
+    def score(self, image_embeddings: np.ndarray) -> list:
+        """Score image embeddings against every candidate tag, return the top MAX_TAGS per image."""
+        return self.top_tags(self.probabilities(image_embeddings))
+
+    def score_frame_sets(self, embeddings: np.ndarray, sizes: list, pooling: str = "mean") -> list:
+        """Score consecutive runs of sizes frame embeddings, pooling per-frame probabilities per video."""
+        probs = self.probabilities(embeddings)
+        pooled, start = [], 0
+        for size in sizes:
+            chunk = probs[start:start + size]
+            start += size
+            pooled.append(chunk.max(axis=0) if pooling == "max" else chunk.mean(axis=0))
+        return self.top_tags(np.stack(pooled))
+
+class ClipTagger(TagScorer):
+    """CLIP zero-shot tagger scoring images against cached candidate-tag text embeddings.
+
+    Scores match the zero-shot-image-classification pipeline (softmax over the
+    scaled cosine similarities), but the text side is encoded once per
+    vocabulary and each image batch costs a single matrix multiply and top-k.
+    Encoding runs on PyTorch; scoring is plain NumPy so other engines share it.
+    """
+
+    engine = "torch"
+
+    def __init__(self, model_name: str, candidate_tags: list, vocabulary_version: str):
+        import torch
+        from transformers import CLIPModel, CLIPProcessor
+
+        if TAG_INTRA_OP_THREADS > 0:
+            torch.set_num_threads(TAG_INTRA_OP_THREADS)
+        if TAG_INTER_OP_THREADS > 0:
+            try:
+                torch.set_num_interop_threads(TAG_INTER_OP_THREADS)
+            except RuntimeError as e:
+                logger.warning(f"Could not set PyTorch inter-op threads: {str(e)}")
+        self.torch = torch
+        self.model_name = model_name
+        self.model = CLIPModel.from_pretrained(model_name).eval()
+        self.processor = CLIPProcessor.from_pretrained(model_name)
+        self.labels = list(candidate_tags)
+        self.logit_scale = float(self.model.logit_scale.exp())
+        self.text_embeddings = self.load_text_embeddings(vocabulary_version)
+
+    def cache_path(self, vocabulary_version: str) -> Path:
+        return text_embeddings_path(self.model_name, self.engine, vocabulary_version)
+
+    def load_text_embeddings(self, vocabulary_version: str) -> np.ndarray:
+        """Load candidate-tag embeddings from the cache, encoding and saving them on a miss."""
+        cache_path = self.cache_path(vocabulary_version)
+        if cache_path.exists():
+            try:
+                with np.load(cache_path, allow_pickle=False) as cached:
+                    if cached["labels"].tolist() == self.labels:
+                        logger.info(f"Loaded {len(self.labels)} cached tag embeddings from {cache_path}")
+                        return cached["embeddings"].astype(np.float32)
+                logger.warning(f"Tag embedding cache {cache_path} does not match the candidate tags, re-encoding")
+            except Exception as e:
+                logger.warning(f"Failed to read tag embedding cache {cache_path}: {str(e)}")
+
+        logger.info(f"Encoding {len(self.labels)} candidate tags with {self.model_name} ({self.engine})...")
+        embeddings = self.encode_texts([HYPOTHESIS_TEMPLATE.format(tag) for tag in self.labels])
+        try:
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = cache_path.with_suffix(".tmp.npz")
+            np.savez(tmp_path, labels=np.array(self.labels), embeddings=embeddings,
+                     logit_scale=np.float32(self.logit_scale))
+            tmp_path.replace(cache_path)
+            logger.log(logging.SUCCESS, f"Cached tag embeddings: {cache_path}")
+        except OSError as e:
+            logger.warning(f"Failed to cache tag embeddings to {cache_path}: {str(e)}")
+        return embeddings
+
+    def encode_texts(self, texts: list, chunk_size: int = 256) -> np.ndarray:
+        """Return L2-normalized text embeddings, encoding chunk_size prompts per forward pass."""
+        chunks = []
+        with self.torch.no_grad():
+            for start in range(0, len(texts), chunk_size):
+                inputs = self.processor(text=texts[start:start + chunk_size], padding=True, return_tensors="pt")
+                features = model_output_features(self.model.get_text_features(**inputs))
+                chunks.append(self.torch.nn.functional.normalize(features, dim=-1))
+        return self.torch.cat(chunks).numpy().astype(np.float32)
+
+    def encode_images(self, images: list) -> np.ndarray:
+        """Return L2-normalized image embeddings for a batch in one forward pass."""
+        with self.torch.no_grad():
+            inputs = self.processor(images=images, return_tensors="pt")
+            features = model_output_features(self.model.get_image_features(**inputs))
+            return self.torch.nn.functional.normalize(features, dim=-1).numpy()
+
+    def tag(self, images: list) -> list:
+        """Return the top MAX_TAGS {label, score} dicts for each image."""
+        return self.score(self.encode_images(images))
+
+    def tag_frame_sets(self, frame_sets: list, pooling: str = "mean") -> list:
+        """Tag each video from several frames in one forward pass, pooling per-frame probabilities."""
+        embeddings = self.encode_images([frame for frames in frame_sets for frame in frames])
+        return self.score_frame_sets(embeddings, [len(frames) for frames in frame_sets], pooling)
+
+def export_onnx_clip(model_name: str, quantize: bool = False) -> tuple[Path, Path, float]:
+    """Export CLIP's image and text encoders to ONNX once, caching them under ONNX_CACHE.
+
+    Both graphs end in L2 normalization, so they output the same embeddings as
+    ClipTagger.encode_*. With quantize, int8 copies are made with ONNX Runtime's
+    dynamic quantization (weights stored as int8, activations quantized on the
+    fly). Returns (image model path, text model path, logit scale).
+    """
+    export_dir = get_path(ONNX_CACHE, model_name.replace("/", "--"))
+    vision_path, text_path = export_dir / "vision.onnx", export_dir / "text.onnx"
+    config_path = export_dir / "config.json"
+    if not (vision_path.exists() and text_path.exists() and config_path.exists()):
+        import torch
+        from transformers import CLIPModel
+
+        logger.info(f"Exporting {model_name} to ONNX in {export_dir}...")
+        export_dir.mkdir(parents=True, exist_ok=True)
+        model = CLIPModel.from_pretrained(model_name).eval()
+
+        class ImageEncoder(torch.nn.Module):
+            def forward(self, pixel_values):
+                features = model_output_features(model.get_image_features(pixel_values=pixel_values))
+                return torch.nn.functional.normalize(features, dim=-1)
+
+        class TextEncoder(torch.nn.Module):
+            def forward(self, input_ids, attention_mask):
+                features = model_output_features(
+                    model.get_text_features(input_ids=input_ids, attention_mask=attention_mask))
+                return torch.nn.functional.normalize(features, dim=-1)
+
+        image_size = model.config.vision_config.image_size
+        exports = [
+            (ImageEncoder(), (torch.zeros(1, 3, image_size, image_size),), ["pixel_values"],
+             {"pixel_values": {0: "batch"}, "embeddings": {0: "batch"}}, vision_path),
+            (TextEncoder(), (torch.ones(1, 8, dtype=torch.long), torch.ones(1, 8, dtype=torch.long)),
+             ["input_ids", "attention_mask"],
+             {"input_ids": {0: "batch", 1: "sequence"}, "attention_mask": {0: "batch", 1: "sequence"},
+              "embeddings": {0: "batch"}}, text_path),
+        ]
+        with torch.no_grad():
+            for module, args, input_names, dynamic_axes, path in exports:
+                tmp_path = path.with_name(f"{path.stem}.tmp.onnx")
+                torch.onnx.export(module, args, str(tmp_path), input_names=input_names,
+                                  output_names=["embeddings"], dynamic_axes=dynamic_axes,
+                                  opset_version=ONNX_OPSET, do_constant_folding=True)
+                tmp_path.replace(path)
+        config_path.write_text(json.dumps({"model": model_name, "logit_scale": float(model.logit_scale.exp())}))
+        logger.log(logging.SUCCESS, f"Exported {model_name} to {export_dir}")
+
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        quantized = []
+        for path in (vision_path, text_path):
+            int8_path = path.with_name(f"{path.stem}-int8.onnx")
+            if not int8_path.exists():
+                logger.info(f"Quantizing {path.name} to int8...")
+                tmp_path = int8_path.with_name(f"{int8_path.stem}.tmp.onnx")
+                quantize_dynamic(str(path), str(tmp_path), weight_type=QuantType.QInt8)
+                tmp_path.replace(int8_path)
+            quantized.append(int8_path)
+        vision_path, text_path = quantized
+    return vision_path, text_path, json.loads(config_path.read_text())["logit_scale"]
+
+class OnnxClipTagger(ClipTagger):
+    """ClipTagger running exported CLIP encoders on ONNX Runtime's CPU provider.
+
+    Preprocessing still uses the Hugging Face processor (with NumPy tensors),
+    so PyTorch is only needed the first time a model is exported. The text
+    encoder session is only created when tag embeddings are not cached.
+    """
+
+    def __init__(self, model_name: str, candidate_tags: list, vocabulary_version: str, quantize: bool = False):
+        import onnxruntime as ort
+        from transformers import CLIPProcessor
+
+        self.ort = ort
+        self.engine = "onnx-int8" if quantize else "onnx"
+        self.model_name = model_name
+        self.processor = CLIPProcessor.from_pretrained(model_name)
+        self.labels = list(candidate_tags)
+        vision_path, self.text_path, self.logit_scale = export_onnx_clip(model_name, quantize)
+        self.vision_session = self.create_session(vision_path)
+        self.text_embeddings = self.load_text_embeddings(vocabulary_version)
+
+    def create_session(self, path: Path):
+        options = self.ort.SessionOptions()
+        options.graph_optimization_level = self.ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if TAG_INTRA_OP_THREADS > 0:
+            options.intra_op_num_threads = TAG_INTRA_OP_THREADS
+        if TAG_INTER_OP_THREADS > 0:
+            options.inter_op_num_threads = TAG_INTER_OP_THREADS
+            options.execution_mode = self.ort.ExecutionMode.ORT_PARALLEL
+        return self.ort.InferenceSession(str(path), options, providers=["CPUExecutionProvider"])
+
+    def encode_texts(self, texts: list, chunk_size: int = 256) -> np.ndarray:
+        """Return L2-normalized text embeddings, encoding chunk_size prompts per run."""
+        session = self.create_session(self.text_path)
+        chunks = []
+        for start in range(0, len(texts), chunk_size):
+            inputs = self.processor(text=texts[start:start + chunk_size], padding=True, return_tensors="np")
+            chunks.append(session.run(None, {
+                "input_ids": inputs["input_ids"].astype(np.int64),
+                "attention_mask": inputs["attention_mask"].astype(np.int64),
+            })[0])
+        return np.concatenate(chunks).astype(np.float32)
+
+    def encode_images(self, images: list) -> np.ndarray:
+        """Return L2-normalized image embeddings for a batch in one run."""
+        inputs = self.processor(images=images, return_tensors="np")
+        return self.vision_session.run(None, {"pixel_values": inputs["pixel_values"].astype(np.float32)})[0]
+
+def load_image(image_path: str):
+    """Open an image and convert it to RGB, returning None on failure."""
+    try:
+        with Image.open(image_path) as image:
+            return image.convert("RGB")
+    except Exception as e:
+        logger.error(f"Error loading {image_path}: {str(e)}")
+        return None
+
+def top_tags(results: list) -> list:
+    """Return the MAX_TAGS highest-scoring pipeline results."""
+    return sorted(results, key=lambda x: x["score"], reverse=True)[:MAX_TAGS]
+
+def log_tags(source: str, tag_data: list):
+    """Log the labels and scores chosen for a tagged image."""
+    summary = ", ".join(f"{item['label']} ({item['score']:.2f})" for item in tag_data)
+    logger.log(logging.SUCCESS, f"Tags for {source}: {summary}")
+
+def tag_image(image_path: str, tagger) -> list:
+    """Tag image using CLIP, return top 20 tags with confidence scores."""
     logger.debug(f"Tagging image: {image_path}")
     try:
         image = Image.open(image_path).convert("RGB")
-        results = tagger(image, candidate_labels=candidate_tags)
-        tag_data = sorted(results, key=lambda x: x['score'], reverse=True)[:20]
-        tags = [item['label'] for item in tag_data]
-        logger.log(logging.SUCCESS, f"Tags for {image_path}: {', '.join(f'{item['label']} ({item['score']:.2f})' for item in tag_data)}")
-        return tags
+        tag_data = top_tags(tagger.tag([image])[0])
+        log_tags(image_path, tag_data)
+        return [item["label"] for item in tag_data]
     except Exception as e:
         logger.error(f"Error tagging {image_path}: {str(e)}")
         return []
 
-def load_existing_tags() -> list:
-    """Load existing tags.csv if it exists."""
+def tag_images(image_paths: list, tagger, batch_size: int = TAG_BATCH_SIZE, embeddings: list = None) -> list:
+    """Tag images in batches, one forward pass per batch, return a tag list per image.
+
+    Images for the next batch are decoded on TAG_LOADER_WORKERS threads while the
+    current batch runs through the model. Images that fail to load or tag get [].
+    When an embeddings list is given, it is filled with each image's embedding
+    (None where tagging failed).
+    """
+    results = [[] for _ in image_paths]
+    if embeddings is not None:
+        embeddings[:] = [None] * len(image_paths)
+    if not image_paths:
+        return results
+    batch_size = max(1, batch_size)
+    batches = [list(range(start, min(start + batch_size, len(image_paths))))
+               for start in range(0, len(image_paths), batch_size)]
+
+    tagged = 0
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, TAG_LOADER_WORKERS)) as pool:
+        pending = [pool.submit(load_image, image_paths[j]) for j in batches[0]]
+        for k, batch in enumerate(batches):
+            images = [future.result() for future in pending]
+            if k + 1 < len(batches):
+                pending = [pool.submit(load_image, image_paths[j]) for j in batches[k + 1]]
+
+            loaded = [(j, image) for j, image in zip(batch, images) if image is not None]
+            if not loaded:
+                continue
+            logger.debug(f"Tagging batch {k + 1}/{len(batches)} ({len(loaded)} images)")
+            try:
+                with metrics.timer("tag_media_stage_seconds", stage="tag"):
+                    batch_embeddings = tagger.encode_images([image for _, image in loaded])
+                    outputs = tagger.score(batch_embeddings)
+            except Exception as e:
+                logger.error(f"Error tagging batch {k + 1}/{len(batches)}: {str(e)}")
+                continue
+            for (j, _), output, embedding in zip(loaded, outputs, batch_embeddings):
+                if embeddings is not None:
+                    embeddings[j] = embedding
+                tag_data = top_tags(output)
+                log_tags(image_paths[j], tag_data)
+                results[j] = [item["label"] for item in tag_data]
+            tagged += len(loaded)
+            metrics.inc("tag_media_images_tagged_total", len(loaded), source="thumbnail")
+
+    elapsed = time.perf_counter() - start_time
+    if tagged:
+        logger.info(f"Tagged {tagged} images in {elapsed:.2f}s "
+                    f"({tagged / elapsed:.2f} images/sec, batch size {batch_size})")
+    return results
+
+def benchmark_tag_batch_sizes(image_paths: list, tagger, batch_sizes: list) -> dict:
+    """Tag the same images at each batch size and report images/sec for each."""
+    report = {}
+    for batch_size in batch_sizes:
+        start_time = time.perf_counter()
+        tag_images(image_paths, tagger, batch_size)
+        elapsed = time.perf_counter() - start_time
+        report[batch_size] = len(image_paths) / elapsed if elapsed > 0 else 0.0
+    for batch_size, rate in report.items():
+        logger.log(logging.SUCCESS, f"Batch size {batch_size}: {rate:.2f} images/sec over {len(image_paths)} images")
+    return report
+
+def load_tagger(candidate_tags: list, engine: str = None):
+    """Load the CLIP tagger for the candidate tags on TAG_ENGINE, returning None on failure."""
+    engine = engine or TAG_ENGINE
+    logger.debug(f"Loading CLIP model {CLIP_MODEL} ({engine})...")
+    try:
+        if engine == "torch":
+            tagger = ClipTagger(CLIP_MODEL, candidate_tags, get_vocabulary_version())
+        elif engine in ("onnx", "onnx-int8"):
+            tagger = OnnxClipTagger(CLIP_MODEL, candidate_tags, get_vocabulary_version(), engine == "onnx-int8")
+        else:
+            raise ValueError(f"Unknown TAG_ENGINE {engine!r}, expected one of {', '.join(TAG_ENGINES)}")
+        logger.log(logging.SUCCESS, f"CLIP model loaded successfully ({len(candidate_tags)} candidate tags, {engine})")
+        return tagger
+    except Exception as e:
+        logger.error(f"Failed to load CLIP model: {str(e)}")
+        return None
+
+def compare_engines(image_paths: list, candidate_tags: list, engines: list) -> dict:
+    """Tag the same images on each engine and report speed and top-k agreement with the first engine.
+
+    Agreement at k is the mean fraction of an image's top k reference tags that
+    the engine also puts in its top k; top-1 agreement is the exact-match rate.
+    """
+    results, rates = {}, {}
+    for engine in engines:
+        tagger = load_tagger(candidate_tags, engine)
+        if not tagger:
+            continue
+        warmup = load_image(image_paths[0])
+        if warmup is not None:
+            tagger.tag([warmup])
+        start_time = time.perf_counter()
+        results[engine] = tag_images(image_paths, tagger)
+        elapsed = time.perf_counter() - start_time
+        rates[engine] = len(image_paths) / elapsed if elapsed > 0 else 0.0
+        del tagger
+
+    report = {}
+    reference = results.get(engines[0])
+    for engine, tag_lists in results.items():
+        entry = {"images_per_sec": round(rates[engine], 2)}
+        if reference is not None and engine != engines[0]:
+            for k in sorted({1, 5, MAX_TAGS}):
+                overlaps = [len(set(ref[:k]) & set(tags[:k])) / min(k, len(ref))
+                            for ref, tags in zip(reference, tag_lists) if ref]
+                entry[f"top{k}_agreement"] = round(sum(overlaps) / len(overlaps), 4) if overlaps else None
+        report[engine] = entry
+        summary = ", ".join(f"{key}={value}" for key, value in entry.items())
+        logger.log(logging.SUCCESS, f"Engine {engine}: {summary}")
+    if reference is None:
+        logger.error(f"Reference engine {engines[0]} failed to load, no agreement computed")
+    return report
+
+def tag_frame_items(items: list, tagger, embeddings: list = None) -> list:
+    """Tag items from their decoded frames in one batch, return a tag list per item.
+
+    When an embeddings list is given, it is filled with each item's mean frame
+    embedding, normalized (None where tagging failed).
+    """
+    results = [[] for _ in items]
+    if embeddings is not None:
+        embeddings[:] = [None] * len(items)
+    valid = [j for j, item in enumerate(items) if item.get("frames") is not None]
+    if not valid:
+        return results
+    start_time = time.perf_counter()
+    sizes = [len(items[j]["frames"]) for j in valid]
+    try:
+        with metrics.timer("tag_media_stage_seconds", stage="tag"):
+            frame_embeddings = tagger.encode_images([frame for j in valid for frame in items[j]["frames"]])
+            outputs = tagger.score_frame_sets(frame_embeddings, sizes, TAG_FRAME_POOLING)
+    except Exception as e:
+        logger.error(f"Error tagging frames for {len(valid)} videos: {str(e)}")
+        return results
+    if embeddings is not None:
+        starts = np.cumsum([0] + sizes[:-1])
+        pooled = np.add.reduceat(np.asarray(frame_embeddings, dtype=np.float32), starts, axis=0)
+        pooled /= np.maximum(np.linalg.norm(pooled, axis=-1, keepdims=True), 1e-12)
+        for j, embedding in zip(valid, pooled):
+            embeddings[j] = embedding
+    for j, output in zip(valid, outputs):
+        tag_data = top_tags(output)
+        log_tags(f"{items[j]['rel_path']} ({len(items[j]['frames'])} frames)", tag_data)
+        results[j] = [item["label"] for item in tag_data]
+    elapsed = time.perf_counter() - start_time
+    frame_count = sum(len(items[j]["frames"]) for j in valid)
+    metrics.inc("tag_media_images_tagged_total", len(valid), source="frames")
+    logger.info(f"Tagged {len(valid)} videos from {frame_count} frames in {elapsed:.2f}s "
+                f"({frame_count / elapsed:.2f} frames/sec)")
+    return results
+
+def tag_pending(pending: list, tagger, store: EmbeddingStore = None) -> list:
+    """Batch-tag queued pipeline items and return their tags.csv rows, keeping their embeddings in store.
+
+    Items whose image or frames could not be tagged get tags None, not [], so
+    they are tried again next run instead of being recorded as untaggable.
+    Items only queued for their embedding (backfill_embeddings()) keep their
+    previous tags instead when the new pass yields none.
+    """
+    embeddings = []
+    if tagger and TAG_SOURCE == "frames":
+        tag_lists = tag_frame_items(pending, tagger, embeddings)
+    elif tagger:
+        tag_lists = tag_images([str(item["jpeg_path"]) for item in pending], tagger, embeddings=embeddings)
+    else:
+        tag_lists = [[] for _ in pending]
+    if tagger and store is not None:
+        for item, embedding in zip(pending, embeddings):
+            if embedding is not None:
+                store.put(item["video_id"], embedding, item["size"], item["mtime_ns"])
+    rows = []
+    for item, tags, embedding in zip(pending, tag_lists, embeddings or [None] * len(pending)):
+        previous = item.pop("backfill", None)
+        if not tagger:
+            logger.warning(f"Skipping tagging for {item['rel_path']} due to model failure")
+        elif embedding is None:
+            logger.warning(f"Failed to embed {item['rel_path']}, keeping its previous tags" if previous is not None
+                           else f"Failed to tag {item['rel_path']}, it will be tried again next run")
+        elif not tags:
+            logger.warning(f"No tags generated for {item['rel_path']}" + (", keeping its previous tags" if previous else ""))
+        item["tags"] = tags if tagger and embedding is not None else None
+        if previous is not None and not item["tags"]:
+            item["tags"] = tags = previous
+        item.pop("frames", None)
+        rows.append(tag_row(item["video_id"], tags))
+    return rows
+
+def tag_row(video_id: str, tags: list) -> dict:
+    """Build a tags.csv row for a video."""
+    return {
+        "media_id": video_id,
+        "media_type": "video",
+        **{f"tag{i}": tag for i, tag in enumerate(tags, 1)}
+    }
+
+def load_existing_tags(known_ids: set) -> tuple[set, dict]:
+    """Stream tags.csv, returning every media_id plus the tags of ids not in known_ids."""
     logger.debug(f"Checking for existing {TAGS_CSV}...")
-    tags_data = []
+    existing_ids, unknown_tags = set(), {}
     if Path(TAGS_CSV).exists():
         try:
             with open(TAGS_CSV, "r", newline="") as f:
-                reader = csv.DictReader(f)
-                tags_data = list(reader)
-            logger.info(f"Loaded {len(tags_data)} existing tags from {TAGS_CSV}")
+                for entry in csv.DictReader(f):
+                    existing_ids.add(entry["media_id"])
+                    if entry["media_id"] not in known_ids:
+                        unknown_tags[entry["media_id"]] = [
+                            entry[f"tag{i}"] for i in range(1, MAX_TAGS + 1) if entry.get(f"tag{i}")]
+            logger.info(f"Loaded {len(existing_ids)} existing tags from {TAGS_CSV}")
         except Exception as e:
             logger.error(f"Failed to load {TAGS_CSV}: {str(e)}")
-    return tags_data
+    return existing_ids, unknown_tags
 
-def clean_orphaned_tags(tags_data: list, video_files: list) -> list:
-    """Remove tags for videos no longer in VIDEO_DIR."""
-    logger.info("Cleaning orphaned tags...")
-    video_ids = {Path(v).stem for v in video_files}
-    valid_tags = []
-    removed_count = 0
-    for entry in tags_data:
-        media_id = entry["media_id"]
-        if media_id in video_ids:
-            valid_tags.append(entry)
+class EmbeddingStore:
+    """CLIP image embeddings of tagged videos, in a float16 matrix memory-mapped from disk.
+
+    vectors.f16 holds one L2-normalized row per video and index.json maps each
+    video_id to its row, plus the size and mtime of the file it was embedded
+    from. Re-embedded videos overwrite their row, new ones take a free row or
+    are appended, and rows of removed videos are freed. The index is replaced
+    atomically after the rows are written, so a crash can only leave rows that
+    nothing points to. One process writes a store at a time; others may read.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.vectors_path = self.path / "vectors.f16"
+        self.index_path = self.path / "index.json"
+        self.lock = threading.RLock()
+        self.pending = {}  # video_id -> (float32 embedding, size, mtime_ns) waiting for save()
+        self.dirty = False
+        self.last_save = time.monotonic()
+        self.load()
+
+    def load(self):
+        """(Re)read the index, dropping unsaved changes."""
+        with self.lock:
+            self.dim, self.count, self.ids, self.matrix = None, 0, {}, None
+            self.pending, self.dirty = {}, False
+            self.version = self.index_version()
+            if not self.version:
+                return
+            try:
+                index = json.loads(self.index_path.read_text())
+                self.dim, self.count, self.ids = index["dim"], index["count"], index["ids"]
+            except (OSError, ValueError, KeyError) as e:
+                logger.error(f"Failed to read embedding index {self.index_path}: {str(e)}")
+                self.dim, self.count, self.ids = None, 0, {}
+
+    def index_version(self) -> str:
+        try:
+            stat = self.index_path.stat()
+        except OSError:
+            return ""
+        return f"{stat.st_mtime_ns:x}-{stat.st_size:x}"
+
+    def refresh(self):
+        """Reload if another process has saved the store since it was loaded."""
+        with self.lock:
+            if not self.pending and not self.dirty and self.index_version() != self.version:
+                self.load()
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __contains__(self, video_id: str) -> bool:
+        return video_id in self.ids
+
+    def current(self, video_id: str, size: int, mtime_ns: int) -> bool:
+        """Whether video_id's stored embedding was made from a file of this size and mtime."""
+        entry = self.ids.get(video_id)
+        return entry is not None and entry[1] == size and entry[2] == mtime_ns
+
+    def vectors(self) -> np.ndarray:
+        """The (rows, dim) float16 matrix, memory-mapped read-only."""
+        if self.matrix is None and self.count:
+            self.matrix = np.memmap(self.vectors_path, dtype=np.float16, mode="r", shape=(self.count, self.dim))
+        return self.matrix
+
+    def get(self, video_ids: list) -> np.ndarray:
+        """(len(video_ids), dim) float32 embeddings of stored video_ids."""
+        with self.lock:
+            rows = np.fromiter((self.ids[video_id][0] for video_id in video_ids), dtype=np.int64, count=len(video_ids))
+            return self.vectors()[rows].astype(np.float32)
+
+    def put(self, video_id: str, embedding: np.ndarray, size: int, mtime_ns: int):
+        """Queue an embedding for video_id, saving every CHECKPOINT_INTERVAL seconds."""
+        with self.lock:
+            self.pending[video_id] = (np.asarray(embedding, dtype=np.float32), size, mtime_ns)
+        if time.monotonic() - self.last_save >= CHECKPOINT_INTERVAL:
+            self.save()
+
+    def copy(self, source_id: str, video_id: str, size: int, mtime_ns: int) -> bool:
+        """Store source_id's embedding for video_id as well, when both files have the same content."""
+        with self.lock:
+            if source_id in self.pending:
+                embedding = self.pending[source_id][0]
+            elif source_id in self.ids:
+                embedding = self.get([source_id])[0]
+            else:
+                return False
+            self.pending[video_id] = (embedding, size, mtime_ns)
+            return True
+
+    def remove(self, video_ids):
+        """Forget the embeddings of video_ids, freeing their rows at the next save()."""
+        with self.lock:
+            for video_id in video_ids:
+                self.pending.pop(video_id, None)
+                self.dirty = self.ids.pop(video_id, None) is not None or self.dirty
+
+    def retain(self, video_ids: set):
+        """Forget the embeddings of every video not in video_ids."""
+        self.remove([video_id for video_id in list(self.ids) if video_id not in video_ids])
+
+    def save(self) -> bool:
+        """Write pending rows, then atomically replace the index."""
+        with self.lock:
+            self.last_save = time.monotonic()
+            if not self.pending and not self.dirty:
+                return True
+            try:
+                dim = self.dim or len(next(iter(self.pending.values()))[0])
+                used = {entry[0] for entry in self.ids.values()}
+                free = (row for row in range(self.count) if row not in used)
+                self.matrix = None  # unmap before writing, Windows cannot extend a mapped file
+                self.path.mkdir(parents=True, exist_ok=True)
+                with open(self.vectors_path, "r+b" if self.vectors_path.exists() else "wb") as f:
+                    for video_id, (embedding, size, mtime_ns) in self.pending.items():
+                        if len(embedding) != dim:
+                            logger.error(f"Embedding of {video_id} has {len(embedding)} dimensions, "
+                                         f"{self.path} stores {dim}")
+                            continue
+                        row = self.ids[video_id][0] if video_id in self.ids else next(free, None)
+                        if row is None:
+                            row, self.count = self.count, self.count + 1
+                        f.seek(row * dim * 2)
+                        f.write(embedding.astype(np.float16).tobytes())
+                        self.ids[video_id] = [row, size, mtime_ns]
+                    f.flush()
+                    os.fsync(f.fileno())
+                tmp_path = self.index_path.with_name(f"{self.index_path.name}.tmp")
+                tmp_path.write_text(json.dumps({"dim": dim, "count": self.count, "ids": self.ids}))
+                tmp_path.replace(self.index_path)
+                self.dim, self.pending, self.dirty = dim, {}, False
+                self.version = self.index_version()
+                logger.debug(f"Saved {len(self.ids)} embeddings to {self.path}")
+                return True
+            except OSError as e:
+                logger.error(f"Failed to save embeddings to {self.path}: {str(e)}")
+                return False
+
+    def blocks(self, video_ids: list):
+        """Yield (video_ids, float32 embeddings) in blocks of EMBEDDING_BLOCK_ROWS."""
+        for start in range(0, len(video_ids), EMBEDDING_BLOCK_ROWS):
+            block = video_ids[start:start + EMBEDDING_BLOCK_ROWS]
+            yield block, self.get(block)
+
+    def similar(self, video_id: str, limit: int = SIMILAR_LIMIT, min_score: float = -1.0) -> list:
+        """(video_id, cosine similarity) of the limit stored videos closest to video_id, best first."""
+        with self.lock:
+            query = self.get([video_id])[0]
+            others = [other for other in self.ids if other != video_id]
+            scores = np.concatenate([embeddings @ query for _, embeddings in self.blocks(others)] or [np.zeros(0)])
+        limit = min(limit, len(others))
+        if not limit:
+            return []
+        top = np.argpartition(-scores, limit - 1)[:limit]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [(others[j], float(scores[j])) for j in top if scores[j] >= min_score]
+
+    def near_duplicates(self, threshold: float = DUPLICATE_THRESHOLD) -> list:
+        """(video_id, video_id, cosine similarity) of every pair at or above threshold, best first.
+
+        Pairs are found block against block, so memory stays at two blocks and
+        their similarity matrix however large the store is.
+        """
+        pairs = []
+        with self.lock:
+            video_ids = sorted(self.ids)
+            blocks = [start for start in range(0, len(video_ids), EMBEDDING_BLOCK_ROWS)]
+            for i in blocks:
+                left = self.get(video_ids[i:i + EMBEDDING_BLOCK_ROWS])
+                for j in blocks[blocks.index(i):]:
+                    right = left if j == i else self.get(video_ids[j:j + EMBEDDING_BLOCK_ROWS])
+                    scores = left @ right.T
+                    if j == i:
+                        scores[np.tril_indices(len(scores))] = -np.inf  # each pair once, not with itself
+                    for a, b in zip(*np.nonzero(scores >= threshold)):
+                        pairs.append((video_ids[i + a], video_ids[j + b], float(scores[a, b])))
+        return sorted(pairs, key=lambda pair: -pair[2])
+
+def embedding_store_path(root: str = None) -> Path:
+    """Store for the current CLIP_MODEL and TAG_SOURCE, whose embeddings are not comparable to others."""
+    source = f"frames-{frame_settings_hash()}" if TAG_SOURCE == "frames" else "thumbnail"
+    return get_path(root or EMBEDDINGS_DIR, f"{CLIP_MODEL.replace('/', '--')}-{source}")
+
+def load_tag_scorer(candidate_tags: list):
+    """A TagScorer for candidate_tags from cached text embeddings, loading the tagger only on a cache miss."""
+    vocabulary_version = get_vocabulary_version()
+    for engine in dict.fromkeys((TAG_ENGINE, *TAG_ENGINES)):
+        cache_path = text_embeddings_path(CLIP_MODEL, engine, vocabulary_version)
+        if not cache_path.exists():
+            continue
+        try:
+            with np.load(cache_path, allow_pickle=False) as cached:
+                if cached["labels"].tolist() == list(candidate_tags):
+                    logger.info(f"Loaded {len(candidate_tags)} cached tag embeddings from {cache_path}")
+                    return TagScorer(candidate_tags, cached["embeddings"].astype(np.float32),
+                                     float(cached["logit_scale"]))
+        except Exception as e:
+            logger.warning(f"Failed to read tag embedding cache {cache_path}: {str(e)}")
+    logger.info("No cached tag embeddings for this vocabulary, loading the tagger to encode them")
+    return load_tagger(candidate_tags)
+
+class TagJournal:
+    """Append-only JSON-lines journal of new tags.csv rows, with atomic checkpoints.
+
+    Rows are appended as soon as they are produced. Every CHECKPOINT_INTERVAL
+    seconds the journal is fsynced and its length is recorded in a checkpoint
+    file written to a temp file and renamed into place. On the next run the
+    journal is cut back to the last checkpoint, so a crash loses at most one
+    interval of work, and the surviving rows are reused instead of re-tagging.
+    """
+
+    def __init__(self, path: str):
+        self.path = Path(path)
+        self.checkpoint_path = Path(f"{path}.checkpoint")
+        self.file = None
+        self.last_checkpoint = time.monotonic()
+
+    def resume(self) -> dict:
+        """Truncate the journal to the last checkpoint and return its entries keyed by rel_path."""
+        committed = 0
+        try:
+            committed = json.loads(self.checkpoint_path.read_text())["journal_bytes"]
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Ignoring unreadable checkpoint {self.checkpoint_path}: {str(e)}")
+        entries = {}
+        if self.path.exists():
+            with open(self.path, "r+b") as f:
+                f.truncate(committed)
+                f.seek(0)
+                for line in f:
+                    entry = json.loads(line)
+                    entries[entry["rel_path"]] = entry
+        if entries:
+            logger.log(logging.SUCCESS, f"Resuming from checkpoint: {len(entries)} tagged videos in {self.path}")
+        self.file = open(self.path, "a", encoding="utf-8")
+        return entries
+
+    def append(self, item: dict, row: dict):
+        """Record a tags.csv row along with the file state and vocabulary it was made for."""
+        self.file.write(json.dumps({
+            "rel_path": item["rel_path"],
+            "size": item["size"],
+            "mtime_ns": item["mtime_ns"],
+            "vocabulary_version": item["vocabulary_version"],
+            "row": row,
+        }) + "\n")
+        if time.monotonic() - self.last_checkpoint >= CHECKPOINT_INTERVAL:
+            self.checkpoint()
+
+    def checkpoint(self):
+        """Flush the journal to disk and atomically record its committed length."""
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        tmp_path = self.checkpoint_path.with_name(f"{self.checkpoint_path.name}.tmp")
+        tmp_path.write_text(json.dumps({"journal_bytes": self.file.tell(), "updated_at": time.time()}))
+        tmp_path.replace(self.checkpoint_path)
+        self.last_checkpoint = time.monotonic()
+        logger.debug(f"Checkpointed {self.path} at {self.file.tell()} bytes")
+
+    def rows(self) -> dict:
+        """Return the journaled rows keyed by media_id, in rel_path order."""
+        if self.file:
+            self.file.flush()
+        entries = {}
+        if not self.path.exists():
+            return entries
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                entry = json.loads(line)
+                entries[entry["rel_path"]] = entry["row"]
+        return {row["media_id"]: row for _, row in sorted(entries.items())}
+
+    def close(self):
+        if self.file:
+            self.checkpoint()
+            self.file.close()
+            self.file = None
+
+    def discard(self):
+        """Delete the journal and checkpoint once their rows are merged into tags.csv."""
+        if self.file:
+            self.file.close()
+            self.file = None
+        self.path.unlink(missing_ok=True)
+        self.checkpoint_path.unlink(missing_ok=True)
+
+@contextmanager
+def file_lock(path: str):
+    """Hold an exclusive lock on path, shared with other processes, for the duration of the block.
+
+    The operating system drops the lock when the process dies, so a crash never
+    leaves a stale lock behind.
+    """
+    with open(path, "a+b") as f:
+        if os.name == "nt":
+            import msvcrt
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    pass  # LK_LOCK gives up after 10 seconds
+            try:
+                yield
+            finally:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
         else:
-            logger.warning(f"Removed orphaned tag for video:{media_id}")
-            removed_count += 1
-    logger.log(logging.SUCCESS, f"Cleaned {removed_count} orphaned tags, {len(valid_tags)} tags retained")
-    return valid_tags
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+@metrics.timed("tag_media_stage_seconds", stage="csv_write")
+def merge_tags_csv(updates: dict, video_ids: set = None, removed_ids: set = None) -> bool:
+    """Stream tags.csv into a new file with updated rows merged in, then rename it into place.
 
+    Existing rows are replaced in place by updates (keyed by media_id), and the
+    remaining updates are appended. Orphaned rows are dropped here: any row or
+    update whose media_id is not in video_ids (when given) or is in removed_ids.
+    CLI runs, --watch, and the API job service all merge into tags.csv, so each
+    merge holds TAGS_CSV.lock and writes through a temp file of its own.
+    """
+    logger.info("Merging tags and cleaning orphaned tags...")
+    tags_path = Path(TAGS_CSV)
+    updates = dict(updates)
+    removed_ids = removed_ids or set()
+    written = removed_count = 0
+    tmp_path = None
+    try:
+        with file_lock(f"{TAGS_CSV}.lock"):
+            fd, tmp_path = tempfile.mkstemp(prefix=f"{tags_path.name}.", suffix=".tmp", dir=tags_path.parent)
+            with open(fd, "w", newline="") as out:
+                writer = csv.DictWriter(out, fieldnames=TAGS_FIELDS)
+                writer.writeheader()
+                if tags_path.exists():
+                    with open(tags_path, "r", newline="") as f:
+                        for entry in csv.DictReader(f):
+                            media_id = entry["media_id"]
+                            if (video_ids is not None and media_id not in video_ids) or media_id in removed_ids:
+                                logger.warning(f"Removed orphaned tag for video:{media_id}")
+                                updates.pop(media_id, None)
+                                removed_count += 1
+                                continue
+                            writer.writerow(updates.pop(media_id, entry))
+                            written += 1
+                for media_id, row in updates.items():
+                    if (video_ids is not None and media_id not in video_ids) or media_id in removed_ids:
+                        logger.warning(f"Removed orphaned tag for video:{media_id}")
+                        removed_count += 1
+                        continue
+                    writer.writerow(row)
+                    written += 1
+            os.chmod(tmp_path, 0o644)  # mkstemp files are private to their owner
+            Path(tmp_path).replace(tags_path)
+        logger.log(logging.SUCCESS, f"Cleaned {removed_count} orphaned tags, {written} tags retained")
+        logger.log(logging.SUCCESS, f"Generated {TAGS_CSV}: {written} videos tagged")
+        return True
+    except Exception as e:
+        logger.error(f"Failed to write {TAGS_CSV}: {str(e)}")
+        if tmp_path:
+            Path(tmp_path).unlink(missing_ok=True)
+        return False
+
+@metrics.timed("tag_media_stage_seconds", stage="cleanup")
 def clean_thumbnails(video_files: list):
-    """Remove orphaned thumbnails and GIFs in THUMBS_DIR/preview."""
+    """Remove orphaned thumbnails and animations, and any file that is not a preview, in THUMBS_DIR/preview.
+
+    Animations of existing videos are kept in every PREVIEW_FORMATS format, since
+    the API can serve them all.
+    """
     preview_dir = get_path(THUMBS_DIR, "preview")
     preview_dir.mkdir(parents=True, exist_ok=True)
     video_ids = {Path(v).stem for v in video_files}
     removed_count = 0
 
-    logger.info("Cleaning orphaned thumbnails and GIFs...")
+    logger.info("Cleaning orphaned thumbnails and animations...")
     try:
         for file in preview_dir.glob("*"):
-            file_id = file.stem if file.suffix == ".gif" else file.stem.replace("_thumb", "")
-            if file_id not in video_ids:
+            parsed = parse_preview_name(file.name)
+            if parsed is None or parsed[0] not in video_ids:
                 try:
                     file.unlink()
                     logger.log(logging.SUCCESS, f"Removed orphaned file: {file}")
@@ -273,13 +1620,41 @@ def clean_thumbnails(video_files: list):
     except Exception as e:
         logger.error(f"Unexpected error during thumbnail cleanup: {str(e)}")
 
+def remove_deleted_videos(deleted: list, remove_previews: bool, manifest_conn: sqlite3.Connection = None) -> set:
+    """Drop manifest rows and previews for deleted videos, return the video_ids whose tags should go.
+
+    A video_id still used by another file in the manifest keeps its previews and tags.
+    """
+    if manifest_conn:
+        manifest_conn.executemany("DELETE FROM media WHERE rel_path = ?", [(rel_path,) for rel_path in deleted])
+        manifest_conn.commit()
+    removed_ids = set()
+    for rel_path in deleted:
+        video_id = Path(rel_path).stem
+        if manifest_conn and manifest_conn.execute("SELECT 1 FROM media WHERE video_id = ?", (video_id,)).fetchone():
+            continue
+        removed_ids.add(video_id)
+        logger.warning(f"Removed deleted video: {rel_path}")
+
+    if remove_previews:
+        preview_dir = get_path(THUMBS_DIR, "preview")
+        for video_id in removed_ids:
+            names = [f"{video_id}_thumb.jpg"] + [animation_name(video_id, f) for f in PREVIEW_FORMATS]
+            for file in (preview_dir / name for name in names):
+                try:
+                    file.unlink(missing_ok=True)
+                except OSError as e:
+                    logger.error(f"Failed to remove {file}: {str(e)}")
+    return removed_ids
+
+@metrics.timed("tag_media_stage_seconds", stage="scan")
 def get_video_files() -> list:
     """Scan VIDEO_DIR recursively for .mp4 and .webm files."""
     video_dir = get_path(VIDEO_DIR)
     video_files = []
     try:
         for file in video_dir.rglob("*"):
-            if file.suffix.lower() in [".mp4", ".webm"]:
+            if file.suffix.lower() in VIDEO_EXTENSIONS:
                 video_files.append(str(file.relative_to(video_dir)))
         logger.info(f"Found {len(video_files)} videos")
         return sorted(video_files)
@@ -290,19 +1665,94 @@ def get_video_files() -> list:
         logger.error(f"Unexpected error scanning {VIDEO_DIR}: {str(e)}")
         return []
 
+ACTIVE_SHARD = None  # {"index", "count", "mode", "tags_csv"} once use_shard() has been called
+
+def parse_shard(spec: str) -> tuple[int, int]:
+    """Parse "INDEX/COUNT" into (index, count), raising ValueError if it is not a valid shard."""
+    try:
+        index, count = (int(part) for part in spec.split("/"))
+    except ValueError:
+        raise ValueError(f"Invalid shard {spec!r}, expected INDEX/COUNT such as 0/4")
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(f"Invalid shard {spec!r}, INDEX must be from 0 to COUNT - 1")
+    return index, count
+
+def shard_path(path: str, index: int, count: int) -> str:
+    """path with a shard tag before its extension, e.g. tags.csv -> tags.shard-0-of-4.csv."""
+    path = Path(path)
+    return str(path.with_name(f"{path.stem}.shard-{index}-of-{count}{path.suffix}"))
+
+def use_shard(index: int, count: int, mode: str = SHARD_MODE):
+    """Work on one shard of VIDEO_DIR from now on, with its own tags, journal, manifest, and metrics files.
+
+    Several machines or processes can then share VIDEO_DIR and THUMBS_DIR, each
+    running a different shard, with its own embedding store too. Previews go to
+    the shared THUMBS_DIR, since shard_files() keeps every video_id, with all
+    the paths that share it, in one shard. Library-wide cleanup is left to
+    merge_shards().
+    """
+    global ACTIVE_SHARD, TAGS_CSV, MANIFEST_DB, METRICS_JSON, EMBEDDINGS_DIR
+    if mode not in SHARD_MODES:
+        raise ValueError(f"Unknown shard mode {mode}, expected one of {', '.join(SHARD_MODES)}")
+    ACTIVE_SHARD = {"index": index, "count": count, "mode": mode, "tags_csv": TAGS_CSV}
+    TAGS_CSV = shard_path(TAGS_CSV, index, count)
+    MANIFEST_DB = shard_path(MANIFEST_DB, index, count)
+    METRICS_JSON = shard_path(METRICS_JSON, index, count) if METRICS_JSON else ""
+    EMBEDDINGS_DIR = shard_path(EMBEDDINGS_DIR, index, count) if EMBEDDINGS_DIR else ""
+    logger.info(f"Processing shard {index}/{count} ({mode} mode) into {TAGS_CSV} and {MANIFEST_DB}")
+
+def seed_shard_tags(video_files: list):
+    """Start a shard's tags file from the library's tags.csv rows for its videos, so they are not retagged."""
+    library_csv = Path(ACTIVE_SHARD["tags_csv"])
+    if not library_csv.exists():
+        return
+    video_ids = {Path(v).stem for v in video_files}
+    try:
+        with open(library_csv, "r", newline="") as f:
+            rows = {entry["media_id"]: entry for entry in csv.DictReader(f) if entry["media_id"] in video_ids}
+    except (OSError, csv.Error, KeyError) as e:
+        logger.error(f"Failed to seed shard tags from {library_csv}: {str(e)}")
+        return
+    if rows and merge_tags_csv(rows):
+        logger.info(f"Seeded {TAGS_CSV} with {len(rows)} tags from {library_csv}")
+
+def shard_files(video_files: list) -> list:
+    """The video_files that belong to the active shard, or all of them when not sharded.
+
+    Videos are assigned by video_id (the file stem), which previews, tags, and
+    embeddings are keyed by, so videos sharing a name in different folders are
+    always processed by the same shard. "hash" places each video_id by a SHA-1
+    of it, so a video never changes shard, but shards are only roughly even.
+    "index" deals the sorted video_ids out round-robin, which is even, but
+    adding a video moves the ones after it.
+    """
+    if ACTIVE_SHARD is None:
+        return video_files
+    index, count = ACTIVE_SHARD["index"], ACTIVE_SHARD["count"]
+    if ACTIVE_SHARD["mode"] == "index":
+        members = set(sorted({Path(rel_path).stem for rel_path in video_files})[index::count])
+        return [rel_path for rel_path in video_files if Path(rel_path).stem in members]
+    return [rel_path for rel_path in video_files
+            if int(hashlib.sha1(Path(rel_path).stem.encode()).hexdigest(), 16) % count == index]
+
+def prompt_input(prompt: str) -> str:
+    """input() once queued log lines are out, so they do not land after the prompt."""
+    flush_logs()
+    return input(prompt)
+
 def prompt_user() -> tuple[bool, bool, bool]:
     """Prompt user for thumbnail/GIF generation, tagging, and cache clearing."""
     logger.info(f"{Fore.MAGENTA}Starting media processing configuration...")
     
     while True:
-        response = input(f"{Fore.CYAN}Generate thumbnails and GIFs for videos? (y/n): {Style.RESET_ALL}").strip().lower()
+        response = prompt_input(f"{Fore.CYAN}Generate thumbnails and GIFs for videos? (y/n): {Style.RESET_ALL}").strip().lower()
         if response in ['y', 'n']:
             generate_thumbs = response == 'y'
             break
         logger.warning("Invalid input, please enter 'y' or 'n'")
 
     while True:
-        response = input(f"{Fore.CYAN}Generate tags for thumbnails? (y/n): {Style.RESET_ALL}").strip().lower()
+        response = prompt_input(f"{Fore.CYAN}Generate tags for thumbnails? (y/n): {Style.RESET_ALL}").strip().lower()
         if response in ['y', 'n']:
             generate_tags = response == 'y'
             break
@@ -311,7 +1761,7 @@ def prompt_user() -> tuple[bool, bool, bool]:
     clear_cache = False
     if generate_thumbs or generate_tags:
         while True:
-            response = input(f"{Fore.YELLOW}Clear thumbnail, GIF, and tag cache? This will back up existing files. (y/n): {Style.RESET_ALL}").strip().lower()
+            response = prompt_input(f"{Fore.YELLOW}Clear thumbnail, GIF, and tag cache? This will back up existing files. (y/n): {Style.RESET_ALL}").strip().lower()
             if response in ['y', 'n']:
                 clear_cache = response == 'y'
                 break
@@ -320,44 +1770,966 @@ def prompt_user() -> tuple[bool, bool, bool]:
     logger.info(f"Configuration: Thumbnails/GIFs={generate_thumbs}, Tags={generate_tags}, Clear Cache={clear_cache}")
     return generate_thumbs, generate_tags, clear_cache
 
-def process_media():
-    """Generate thumbnails, GIFs, and tags for videos, with user prompts and duplication checks."""
+def open_manifest() -> sqlite3.Connection:
+    """Open (creating if needed) the SQLite manifest of processed videos."""
+    return open_manifest_at(MANIFEST_DB)
+
+def open_manifest_at(path: str) -> sqlite3.Connection:
+    """Open (creating if needed) a manifest database at path."""
+    conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS media (
+            rel_path TEXT PRIMARY KEY,
+            video_id TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            duration REAL,
+            previews TEXT,
+            tags TEXT,
+            vocabulary_version TEXT,
+            fingerprint TEXT,
+            updated_at REAL NOT NULL
+        )
+    """)
+    columns = {row["name"] for row in conn.execute("PRAGMA table_info(media)")}
+    if "fingerprint" not in columns:
+        conn.execute("ALTER TABLE media ADD COLUMN fingerprint TEXT")
+    conn.execute("CREATE INDEX IF NOT EXISTS media_fingerprint ON media (fingerprint)")
+    conn.execute("CREATE INDEX IF NOT EXISTS media_video_id ON media (video_id)")
+    conn.commit()
+    return conn
+
+def load_manifest(conn: sqlite3.Connection, rel_paths: list = None) -> dict:
+    """Return manifest rows keyed by path relative to VIDEO_DIR, with JSON columns decoded.
+
+    When rel_paths is given only those rows are read.
+    """
+    if rel_paths is None:
+        rows = conn.execute("SELECT * FROM media")
+    else:
+        rows = [row for rel_path in rel_paths
+                for row in conn.execute("SELECT * FROM media WHERE rel_path = ?", (rel_path,))]
+    manifest = {}
+    for row in rows:
+        entry = dict(row)
+        entry["previews"] = json.loads(entry["previews"]) if entry["previews"] else None
+        entry["tags"] = json.loads(entry["tags"]) if entry["tags"] is not None else None
+        manifest[entry["rel_path"]] = entry
+    if rel_paths is None:
+        logger.info(f"Loaded {len(manifest)} manifest entries from {MANIFEST_DB}")
+    return manifest
+
+def save_manifest_entries(conn: sqlite3.Connection, items: list):
+    """Upsert the manifest rows for processed pipeline items."""
+    conn.executemany(
+        """
+        INSERT OR REPLACE INTO media
+            (rel_path, video_id, size, mtime_ns, duration, previews, tags, vocabulary_version, fingerprint, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        [
+            (
+                item["rel_path"], item["video_id"], item["size"], item["mtime_ns"], item["duration"],
+                json.dumps(item["previews"]) if item["previews"] else None,
+                json.dumps(item["tags"]) if item["tags"] is not None else None,
+                item["vocabulary_version"] if item["tags"] is not None else None,
+                item["fingerprint"] or None,
+                time.time(),
+            )
+            for item in items
+        ],
+    )
+    conn.commit()
+
+def prune_manifest(conn: sqlite3.Connection, video_files: list):
+    """Delete manifest rows for videos no longer in VIDEO_DIR."""
+    current = set(video_files)
+    stale = [(rel_path,) for (rel_path,) in conn.execute("SELECT rel_path FROM media") if rel_path not in current]
+    if stale:
+        conn.executemany("DELETE FROM media WHERE rel_path = ?", stale)
+        conn.commit()
+        logger.info(f"Removed {len(stale)} manifest entries for deleted videos")
+
+def clear_manifest_outputs(conn: sqlite3.Connection):
+    """Forget recorded previews and tags, keeping probe results."""
+    conn.execute("UPDATE media SET previews = NULL, tags = NULL, vocabulary_version = NULL")
+    conn.commit()
+    logger.log(logging.SUCCESS, f"Cleared preview and tag entries in {MANIFEST_DB}")
+
+def bounded_map(pool: ThreadPoolExecutor, fn, items: list, window: int):
+    """Yield fn(item) for each item in input order, with at most window calls in flight."""
+    in_flight = deque()
+    for item in items:
+        in_flight.append(pool.submit(fn, item))
+        if len(in_flight) >= window:
+            yield in_flight.popleft().result()
+    while in_flight:
+        yield in_flight.popleft().result()
+
+def queue_put(q: queue.Queue, item, stop_event: threading.Event) -> bool:
+    """Put item on a bounded queue, blocking until there is room or the pipeline stops."""
+    while not stop_event.is_set():
+        try:
+            q.put(item, timeout=0.5)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+def queue_get(q: queue.Queue, stop_event: threading.Event):
+    """Get the next item from a queue, returning None once the pipeline stops."""
+    while not stop_event.is_set():
+        try:
+            return q.get(timeout=0.5)
+        except queue.Empty:
+            continue
+    return None
+
+def probe_item(item: dict) -> dict:
+    """Probe stage: read the video duration and skip videos shorter than 5 seconds."""
+    rel_path = item["rel_path"]
+    logger.info(f"{Fore.MAGENTA}Processing video {item['index'] + 1}: {rel_path}")
+    try:
+        if item["duration"] is None:
+            item["duration"] = get_video_duration(str(item["file_path"]))
+        if item["duration"] < 5:
+            logger.warning(f"Skipping {rel_path}: Duration {item['duration']:.2f}s < 5s")
+            item["skip"] = True
+            if item["duration"] <= 0:
+                item["duration"] = None  # probe failed, try again next run
+    except Exception as e:
+        logger.error(f"Unexpected error probing {rel_path}: {str(e)}")
+        item["skip"] = True
+    return item
+
+def preview_item(item: dict, generate_thumbs: bool) -> dict:
+    """Preview stage: generate missing previews, or check they exist when generation is off."""
+    rel_path, video_id = item["rel_path"], item["video_id"]
+    jpeg_path, animation_path = item["jpeg_path"], item["animation_path"]
+    try:
+        if generate_thumbs:
+            make_jpeg = item["force_previews"] or not jpeg_path.exists()
+            make_animation = item["force_previews"] or not animation_path.exists()
+            if make_jpeg or make_animation:
+                item["jpeg_url"], item["animation_url"] = generate_previews(
+                    str(item["file_path"]), video_id, item["duration"], jpeg=make_jpeg, animation=make_animation)
+                if (make_jpeg and not item["jpeg_url"]) or (make_animation and not item["animation_url"]):
+                    logger.warning(f"Failed to generate previews for {rel_path}")
+                    item["skip"] = True
+                    return item
+
+            if not make_jpeg:
+                item["jpeg_url"] = preview_url(jpeg_path.name)
+                logger.info(f"JPEG exists: {jpeg_path} ({jpeg_path.stat().st_size / 1024:.2f} KB)")
+            if not make_animation:
+                item["animation_url"] = preview_url(animation_path.name)
+                logger.info(f"{PREVIEW_FORMAT.upper()} exists: {animation_path} "
+                            f"({animation_path.stat().st_size / 1024:.2f} KB)")
+        elif not (jpeg_path.exists() and animation_path.exists()):
+            if TAG_SOURCE == "frames":
+                return item
+            logger.warning(f"Thumbnail or {PREVIEW_FORMAT.upper()} missing for {rel_path}, but generation disabled")
+            item["skip"] = True
+            return item
+        item["previews"] = {"jpeg": item["jpeg_url"] or preview_url(jpeg_path.name),
+                            "animation": item["animation_url"] or preview_url(animation_path.name)}
+    except Exception as e:
+        logger.error(f"Unexpected error processing {rel_path}: {str(e)}")
+        item["skip"] = True
+    return item
+
+def previews_current(video_id: str, previews: dict) -> bool:
+    """Whether recorded preview URLs are the ones PREVIEW_FORMAT would produce now, and their files still exist.
+
+    Previews can be deleted behind the manifest's back, e.g. evicted by the
+    API's preview cache, and are then redone.
+    """
+    if previews is None:
+        return True
+    return previews.get("animation") == preview_url(animation_name(video_id)) and all(
+        get_path(THUMBS_DIR, "preview", name).exists() for name in (f"{video_id}_thumb.jpg", animation_name(video_id)))
+
+def pipeline_items(video_files: list, manifest: dict, generate_thumbs: bool, generate_tags: bool,
+                   unknown_tags: dict, vocabulary_version: str, resumed: dict = None) -> list:
+    """Build pipeline items, reusing manifest results for videos whose size and mtime are unchanged.
+
+    An item is "fresh" when nothing needs to run for it: its duration is known,
+    its previews were recorded (if wanted), and its tags match the current
+    vocabulary (if wanted). Changed files get their previews and tags redone.
+    Videos missing from the manifest but present in tags.csv keep those tags,
+    and videos tagged before an interrupted run (resumed journal entries) keep
+    the tags recorded for them.
+    """
+    resumed = resumed or {}
+    items = []
+    for index, rel_path in enumerate(video_files):
+        video_id = Path(rel_path).stem
+        file_path = get_path(VIDEO_DIR, rel_path)
+        try:
+            stat = file_path.stat()
+        except OSError as e:
+            logger.error(f"Failed to stat {rel_path}: {str(e)}")
+            continue
+        row = manifest.get(rel_path)
+        unchanged = row is not None and row["size"] == stat.st_size and row["mtime_ns"] == stat.st_mtime_ns
+        if unchanged:
+            tags, tags_version = row["tags"], row["vocabulary_version"]
+        elif row is None and video_id in unknown_tags:
+            tags, tags_version = unknown_tags[video_id], vocabulary_version
+        else:
+            tags, tags_version = None, None
+        entry = resumed.get(rel_path)
+        journaled = (entry is not None and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns
+                     and entry["vocabulary_version"] == vocabulary_version)
+        if journaled:
+            tags = [entry["row"][f"tag{i}"] for i in range(1, MAX_TAGS + 1) if entry["row"].get(f"tag{i}")]
+            tags_version = vocabulary_version
+        item = {
+            "index": index,
+            "rel_path": rel_path,
+            "video_id": video_id,
+            "file_path": file_path,
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "duration": row["duration"] if unchanged else None,
+            "jpeg_path": get_path(THUMBS_DIR, "preview", f"{video_id}_thumb.jpg"),
+            "animation_path": get_path(THUMBS_DIR, "preview", animation_name(video_id)),
+            "jpeg_url": "",
+            "animation_url": "",
+            "force_previews": row is not None and not unchanged,
+            # Previews recorded in another PREVIEW_FORMAT are redone; the JPEG is kept if it exists
+            "previews": row["previews"] if unchanged and previews_current(video_id, row["previews"]) else None,
+            "tags": tags,
+            "vocabulary_version": tags_version,
+            "fingerprint": row.get("fingerprint") if unchanged else None,
+            "journaled": journaled,
+        }
+        update_item_state(item, generate_thumbs, generate_tags, vocabulary_version)
+        items.append(item)
+    return items
+
+def update_item_state(item: dict, generate_thumbs: bool, generate_tags: bool, vocabulary_version: str):
+    """Work out whether an item still needs tagging and whether it can skip the pipeline."""
+    short = item["duration"] is not None and item["duration"] < 5
+    tags_current = item["tags"] is not None and item["vocabulary_version"] == vocabulary_version
+    item["needs_tags"] = generate_tags and not short and not tags_current
+    item["fresh"] = item["duration"] is not None and (short or (
+        not item["needs_tags"] and (item["previews"] is not None or not generate_thumbs)))
+
+def fingerprint_items(items: list, manifest_conn: sqlite3.Connection = None):
+    """Compute missing FINGERPRINT_MODE fingerprints on FINGERPRINT_WORKERS threads.
+
+    Unchanged videos that predate fingerprinting are backfilled in the manifest.
+    """
+    if FINGERPRINT_MODE not in ("fast", "full"):
+        return
+    todo = [item for item in items if not (item["fingerprint"] or "").startswith(f"{FINGERPRINT_MODE}:")]
+    if not todo:
+        return
+    logger.info(f"Fingerprinting {len(todo)} videos ({FINGERPRINT_MODE} mode)...")
+    with ThreadPoolExecutor(max_workers=max(1, FINGERPRINT_WORKERS)) as pool:
+        hashes = pool.map(lambda item: get_file_hash(str(item["file_path"]), FINGERPRINT_MODE), todo)
+        for item, fingerprint in zip(todo, hashes):
+            item["fingerprint"] = fingerprint
+    if manifest_conn:
+        manifest_conn.executemany(
+            "UPDATE media SET fingerprint = ? WHERE rel_path = ? AND size = ? AND mtime_ns = ?",
+            [(item["fingerprint"] or None, item["rel_path"], item["size"], item["mtime_ns"])
+             for item in todo if item["fresh"]],
+        )
+        manifest_conn.commit()
+
+def link_previews(source_id: str, video_id: str, previews: dict) -> dict:
+    """Hardlink (or copy) another video's preview files to video_id's names.
+
+    Returns the preview URLs for video_id, or None if any source file is missing.
+    """
+    preview_dir = get_path(THUMBS_DIR, "preview")
+    linked = {}
+    for kind, url in previews.items():
+        name = url.rsplit("/", 1)[-1]
+        source = preview_dir / name
+        if not name.startswith(source_id) or not source.exists():
+            return None
+        target_name = video_id + name[len(source_id):]
+        target = preview_dir / target_name
+        if target != source:
+            part = target.with_name(f"{target_name}.part")
+            part.unlink(missing_ok=True)
+            try:
+                os.link(source, part)
+            except OSError:
+                shutil.copy2(source, part)
+            part.replace(target)
+        linked[kind] = preview_url(target_name)
+    return linked
+
+def adopt_results(item: dict, source: dict, generate_thumbs: bool, generate_tags: bool, vocabulary_version: str):
+    """Copy the duration, previews, and tags of a video with identical content onto item."""
+    item["duration"] = source["duration"]
+    if source["previews"] and previews_current(source["video_id"], source["previews"]):
+        try:
+            previews = link_previews(source["video_id"], item["video_id"], source["previews"])
+        except OSError as e:
+            logger.error(f"Failed to reuse previews of {source['video_id']} for {item['video_id']}: {str(e)}")
+            previews = None
+        if previews:
+            item["previews"] = previews
+            item["force_previews"] = False
+    if source["tags"] is not None and (source["vocabulary_version"] == vocabulary_version or not generate_tags):
+        item["tags"], item["vocabulary_version"] = source["tags"], source["vocabulary_version"]
+    update_item_state(item, generate_thumbs, generate_tags, vocabulary_version)
+    item["adopted"] = True
+    item["adopted_from"] = source["video_id"]
+
+def same_content(item: dict, other: dict, full_hashes: dict) -> bool:
+    """Whether item has the content of other (a manifest row or pipeline item) with the same fingerprint.
+
+    A "fast" fingerprint only samples the file, so the match is confirmed: by
+    a full hash of both files when other's file is still there unchanged, or,
+    when it is gone, by item having its size and mtime, as a moved or renamed
+    file does. Anything else, like a re-encode padded to the same size, is
+    treated as different content.
+    """
+    if not item["fingerprint"].startswith("fast:"):
+        return True
+    path = get_path(VIDEO_DIR, other["rel_path"])
+    same_stat = item["size"] == other["size"] and item["mtime_ns"] == other["mtime_ns"]
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return same_stat
+    except OSError:
+        return False
+    if other["rel_path"] == item["rel_path"] or (stat.st_size, stat.st_mtime_ns) != (other["size"], other["mtime_ns"]):
+        return same_stat and other["rel_path"] == item["rel_path"]
+    for entry in (item, other):
+        if entry["rel_path"] not in full_hashes:
+            full_hashes[entry["rel_path"]] = get_file_hash(str(get_path(VIDEO_DIR, entry["rel_path"])), "full")
+    return bool(full_hashes[item["rel_path"]]) and full_hashes[item["rel_path"]] == full_hashes[other["rel_path"]]
+
+def reuse_duplicates(items: list, manifest: dict, generate_thumbs: bool, generate_tags: bool,
+                     vocabulary_version: str):
+    """Let new, changed, renamed, or duplicate videos reuse results recorded for the same content.
+
+    Videos matching a manifest row by fingerprint adopt its results now. Copies
+    of content that is new in this run are marked duplicate_of their first copy
+    and adopt its results once the pipeline has processed it. Matches are
+    confirmed with same_content() first.
+    """
+    known = {}
+    for row in manifest.values():
+        if row.get("fingerprint") and row["duration"] is not None:
+            known.setdefault(row["fingerprint"], []).append(row)
+    first_copies = {}
+    full_hashes = {}
+    reused = rejected = 0
+    for item in items:
+        if item["fresh"] or not item["fingerprint"]:
+            continue
+        candidates = known.get(item["fingerprint"], [])
+        source = next((row for row in candidates if same_content(item, row, full_hashes)), None)
+        first_copy = first_copies.setdefault(item["fingerprint"], item)
+        if source is not None:
+            adopt_results(item, source, generate_thumbs, generate_tags, vocabulary_version)
+            reused += 1
+        elif candidates:
+            rejected += 1
+        elif first_copy is not item:
+            if same_content(item, first_copy, full_hashes):
+                item["duplicate_of"] = first_copy
+                reused += 1
+            else:
+                rejected += 1
+    if reused:
+        logger.info(f"Reusing results for {reused} videos with matching fingerprints")
+    if rejected:
+        logger.info(f"Processing {rejected} videos whose fingerprint matched but whose content differs")
+
+def backfill_embeddings(items: list, store: EmbeddingStore):
+    """Send tagged videos that have no current embedding in store back through tagging.
+
+    Videos tagged before the store existed, or by the API job service, which
+    does not write to it, are otherwise never embedded. Their tags are redone
+    with the same vocabulary, which is the image-encoder pass they are missing.
+    Videos whose thumbnail is gone are left for a run that regenerates it, and
+    the previous tags are kept in item["backfill"], so tag_pending() can fall
+    back to them when tagging fails.
+    """
+    backfill = [item for item in items
+                if item["fresh"] and item["tags"] is not None and not item.get("adopted")
+                and not (item["duration"] is not None and item["duration"] < 5)
+                and (TAG_SOURCE == "frames" or item["jpeg_path"].exists())
+                and not store.current(item["video_id"], item["size"], item["mtime_ns"])]
+    for item in backfill:
+        item["needs_tags"], item["fresh"], item["backfill"] = True, False, list(item["tags"])
+    if backfill:
+        logger.info(f"Embedding {len(backfill)} tagged videos missing from {store.path}")
+
+def run_pipeline(items: list, generate_thumbs: bool, generate_tags: bool, existing_ids: set, tagger,
+                 manifest_conn: sqlite3.Connection = None, vocabulary_version: str = "",
+                 journal: TagJournal = None, store: EmbeddingStore = None) -> int:
+    """Run probe, preview, and tagging stages concurrently over pipeline items.
+
+    Stages are connected by queues of PIPELINE_QUEUE_SIZE items, so a slow stage
+    throttles the ones before it. Probing runs on PROBE_WORKERS threads, previews
+    on FFMPEG_WORKERS threads (each ffmpeg using FFMPEG_THREADS), and tagging in
+    the calling thread in batches of TAG_BATCH_SIZE. Every item reaches the tag
+    stage, even when skipped, so progress stays accurate. Fresh items bypass the
+    stages entirely. Finished items are recorded in the manifest, and their
+    new tags.csv rows in the journal, as they complete. The journal is
+    checkpointed before each manifest commit, so a crash never leaves the
+    manifest marking a video done whose new tags were lost. Image embeddings of
+    tagged videos go to store, when given. Returns the number of videos tagged.
+    """
+    fresh = [item for item in items if item["fresh"]]
+    duplicates = [item for item in items if not item["fresh"] and item.get("duplicate_of")]
+    work = [item for item in items if not item["fresh"] and not item.get("duplicate_of")]
+
+    def record(item: dict, row: dict):
+        if journal and not item["journaled"]:
+            journal.append(item, row)
+        if store is not None and item.get("adopted_from"):
+            store.copy(item["adopted_from"], item["video_id"], item["size"], item["mtime_ns"])
+
+    def save(done: list):
+        if journal:
+            journal.checkpoint()
+        save_manifest_entries(manifest_conn, done)
+
+    for item in fresh:
+        if generate_tags and item["tags"] is not None and (item.get("adopted") or item["video_id"] not in existing_ids):
+            record(item, tag_row(item["video_id"], item["tags"]))
+    if fresh:
+        metrics.inc("tag_media_videos_total", len(fresh), outcome="unchanged")
+        logger.info(f"Skipping {len(fresh)} unchanged videos recorded in {MANIFEST_DB}")
+    if manifest_conn:
+        save([item for item in fresh if item.get("adopted")])
+
+    preview_queue = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    tag_queue = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    stop_event = threading.Event()
+    preview_workers = max(1, FFMPEG_WORKERS)
+
+    def probe_stage():
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, PROBE_WORKERS)) as pool:
+                for item in bounded_map(pool, probe_item, work, PIPELINE_QUEUE_SIZE):
+                    if not queue_put(preview_queue, item, stop_event):
+                        return
+        except Exception as e:
+            logger.error(f"Probe stage failed: {str(e)}")
+        finally:
+            for _ in range(preview_workers):
+                queue_put(preview_queue, None, stop_event)
+
+    def preview_stage():
+        while True:
+            item = queue_get(preview_queue, stop_event)
+            if item is None:
+                queue_put(tag_queue, None, stop_event)
+                return
+            if not item.get("skip") and (item["previews"] is None or not generate_thumbs):
+                preview_item(item, generate_thumbs)
+            if not item.get("skip") and item["needs_tags"] and TAG_SOURCE == "frames":
+                item["frames"] = extract_frames(str(item["file_path"]), item["duration"])
+            if not queue_put(tag_queue, item, stop_event):
+                return
+
+    threads = [threading.Thread(target=probe_stage, name="probe", daemon=True)]
+    threads += [threading.Thread(target=preview_stage, name=f"preview-{n}", daemon=True)
+                for n in range(preview_workers)]
+    for thread in threads:
+        thread.start()
+
+    pending = []
+    finished = []
+    tagged_count = 0
+    finished_workers = 0
+    with tqdm(total=len(items), initial=len(fresh), desc="Processing videos", unit="video") as progress:
+        def complete(done: list):
+            for item in done:
+                metrics.inc("tag_media_videos_total", outcome="skipped" if item.get("skip") else "processed")
+            finished.extend(done)
+            progress.update(len(done))
+            if manifest_conn and len(finished) >= 100:
+                save(finished)
+                finished.clear()
+
+        def flush():
+            nonlocal tagged_count
+            for item, row in zip(pending, tag_pending(pending, tagger, store)):
+                item["vocabulary_version"] = vocabulary_version if item["tags"] is not None else None
+                if item["tags"] is not None:
+                    record(item, row)
+            tagged_count += len(pending)
+            complete(list(pending))
+            pending.clear()
+
+        try:
+            while finished_workers < preview_workers:
+                try:
+                    item = tag_queue.get(timeout=0.5)
+                except queue.Empty:
+                    if pending:
+                        flush()
+                    continue
+                if item is None:
+                    finished_workers += 1
+                    continue
+                if item.get("skip") or not item["needs_tags"]:
+                    if generate_tags and not item.get("skip"):
+                        logger.info(f"Tags already exist for {item['video_id']}, skipping")
+                    complete([item])
+                    continue
+                pending.append(item)
+                if len(pending) >= TAG_BATCH_SIZE:
+                    flush()
+            if pending:
+                flush()
+
+            # Copies of content first seen in this run take the results of their first copy
+            for item in duplicates:
+                source = item["duplicate_of"]
+                if source["duration"] is not None and not source.get("skip"):
+                    adopt_results(item, source, generate_thumbs, generate_tags, vocabulary_version)
+                    if generate_tags and item["tags"] is not None:
+                        record(item, tag_row(item["video_id"], item["tags"]))
+                    complete([item])
+                else:
+                    progress.update(1)
+        finally:
+            stop_event.set()
+            for thread in threads:
+                thread.join(timeout=5)
+            if manifest_conn and finished:
+                save(finished)
+
+    return tagged_count
+
+def scan_video_stats() -> dict:
+    """Return (size, mtime_ns) for every video in VIDEO_DIR, keyed by relative path."""
+    video_dir = get_path(VIDEO_DIR)
+    stats = {}
+    for file in video_dir.rglob("*"):
+        if file.suffix.lower() in VIDEO_EXTENSIONS:
+            try:
+                stat = file.stat()
+                stats[str(file.relative_to(video_dir))] = (stat.st_size, stat.st_mtime_ns)
+            except OSError:
+                continue
+    return stats
+
+class VideoChangeTracker:
+    """Debounce file events until a video's size and mtime stop changing.
+
+    A marked path is reported only after `debounce` seconds without new events
+    and with an unchanged stat, so files still being copied in are held back.
+    """
+
+    def __init__(self, debounce: float):
+        self.debounce = debounce
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def signature(self, rel_path: str):
+        try:
+            stat = get_path(VIDEO_DIR, rel_path).stat()
+            return stat.st_size, stat.st_mtime_ns
+        except OSError:
+            return None
+
+    def mark(self, rel_path: str):
+        if Path(rel_path).suffix.lower() in VIDEO_EXTENSIONS:
+            with self.lock:
+                self.pending[rel_path] = (time.monotonic(), self.signature(rel_path))
+
+    def ready(self) -> tuple[list, list]:
+        """Return (changed, deleted) paths that have settled since they were marked."""
+        changed, deleted = [], []
+        now = time.monotonic()
+        with self.lock:
+            for rel_path, (seen, signature) in list(self.pending.items()):
+                if now - seen < self.debounce:
+                    continue
+                current = self.signature(rel_path)
+                if current != signature:
+                    self.pending[rel_path] = (now, current)
+                    continue
+                del self.pending[rel_path]
+                (deleted if current is None else changed).append(rel_path)
+        return sorted(changed), sorted(deleted)
+
+def start_file_observer(tracker: VideoChangeTracker):
+    """Watch VIDEO_DIR with watchdog if it is installed, returning the observer or None."""
+    try:
+        from watchdog.observers import Observer
+        from watchdog.events import FileSystemEventHandler
+    except ImportError:
+        return None
+
+    video_dir = get_path(VIDEO_DIR)
+
+    class Handler(FileSystemEventHandler):
+        def mark(self, path: str):
+            try:
+                tracker.mark(str(Path(path).resolve().relative_to(video_dir)))
+            except ValueError:
+                pass
+
+        def on_any_event(self, event):
+            if event.is_directory:
+                return
+            self.mark(event.src_path)
+            if getattr(event, "dest_path", None):
+                self.mark(event.dest_path)
+
+    observer = Observer()
+    observer.schedule(Handler(), str(video_dir), recursive=True)
+    observer.start()
+    return observer
+
+def reflink(source: Path, target: Path):
+    """Clone source into a new file at target sharing its blocks copy-on-write, raising OSError if unsupported."""
+    try:
+        import fcntl
+    except ImportError:
+        raise OSError("Reflinks are only supported on Linux")
+    try:
+        with open(source, "rb") as src, open(target, "xb") as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        shutil.copystat(source, target)
+    except OSError:
+        target.unlink(missing_ok=True)
+        raise
+
+def link_file(source: Path, target: Path, mode: str = SNAPSHOT_LINK) -> str:
+    """Make target a reflink (mode "reflink") or hardlink of source, returning how it was made.
+
+    A refused reflink falls back to a hardlink, and a refused hardlink (across
+    devices, or on a filesystem without them) to a copy.
+    """
+    if mode == "reflink":
+        try:
+            reflink(source, target)
+            return "reflinked"
+        except OSError as e:
+            logger.debug(f"Reflink refused for {source}, hardlinking instead: {str(e)}")
+    try:
+        os.link(source, target)
+        return "hardlinked"
+    except OSError:
+        shutil.copy2(source, target)
+        return "copied"
+
+def link_tree(source_dir: Path, target_dir: Path, mode: str = SNAPSHOT_LINK) -> dict:
+    """Recreate the files of source_dir in target_dir with link_file, counting how each was made.
+
+    After the first refused reflink the rest are hardlinked straight away.
+    """
+    counts = {"reflinked": 0, "hardlinked": 0, "copied": 0}
+    target_dir.mkdir(parents=True, exist_ok=True)
+    for source in source_dir.rglob("*"):
+        target = target_dir / source.relative_to(source_dir)
+        if source.is_dir():
+            target.mkdir(parents=True, exist_ok=True)
+            continue
+        kind = link_file(source, target, mode)
+        counts[kind] += 1
+        if kind != "reflinked":
+            mode = "hardlink"
+    return counts
+
+def list_snapshots() -> list:
+    """Snapshots in SNAPSHOT_DIR, oldest first, as {"name", "path", "created_at"} dicts."""
+    root = get_path(SNAPSHOT_DIR)
+    snapshots = []
+    if not root.exists():
+        return snapshots
+    for path in root.iterdir():
+        if not path.is_dir() or not path.name.startswith("backup_"):
+            continue
+        try:
+            created_at = json.loads((path / "snapshot.json").read_text())["created_at"]
+        except (OSError, ValueError, KeyError):
+            created_at = path.stat().st_mtime  # Full-copy backups from before snapshots
+        snapshots.append({"name": path.name, "path": path, "created_at": created_at})
+    return sorted(snapshots, key=lambda snapshot: (snapshot["created_at"], snapshot["name"]))
+
+def snapshot_inodes(snapshots: list) -> dict:
+    """{(device, inode): [size, names of snapshots linking it]} for snapshot files the live outputs do not share.
+
+    Hardlinked files only take space once, and only while some link to them
+    remains, so this is what deleting snapshots can free.
+    """
+    live = set()
+    for path in [*get_path(THUMBS_DIR, "preview").glob("*"), Path(TAGS_CSV)]:
+        try:
+            stat = path.stat()
+            live.add((stat.st_dev, stat.st_ino))
+        except OSError:
+            pass
+    inodes = {}
+    for snapshot in snapshots:
+        for path in snapshot["path"].rglob("*"):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            if path.is_file() and (stat.st_dev, stat.st_ino) not in live:
+                inodes.setdefault((stat.st_dev, stat.st_ino), [stat.st_size, set()])[1].add(snapshot["name"])
+    return inodes
+
+def prune_snapshots(keep: int = SNAPSHOT_KEEP, max_age_days: float = SNAPSHOT_MAX_AGE_DAYS,
+                    max_bytes: int = SNAPSHOT_MAX_MB * 1024 * 1024) -> list:
+    """Delete the oldest snapshots beyond the retention limits, returning their names.
+
+    Snapshots go oldest first while there are more than keep, the oldest is
+    older than max_age_days, or snapshots hold more than max_bytes that no live
+    file shares. 0 disables a limit, and the newest snapshot is always kept.
+    """
+    snapshots = list_snapshots()
+    inodes = snapshot_inodes(snapshots) if max_bytes > 0 else {}
+    held = sum(size for size, _ in inodes.values())
+    removed = []
+    while len(snapshots) > 1:
+        oldest = snapshots[0]
+        age_days = (time.time() - oldest["created_at"]) / 86400
+        reasons = [reason for reason, applies in (
+            (f"more than {keep} snapshots", keep > 0 and len(snapshots) > keep),
+            (f"older than {max_age_days:g} days", max_age_days > 0 and age_days > max_age_days),
+            (f"snapshots hold {held / 1024 / 1024:.1f} MB", max_bytes > 0 and held > max_bytes),
+        ) if applies]
+        if not reasons:
+            break
+        try:
+            shutil.rmtree(oldest["path"])
+        except OSError as e:
+            logger.error(f"Failed to remove snapshot {oldest['path']}: {str(e)}")
+            break
+        logger.log(logging.SUCCESS, f"Removed snapshot {oldest['name']} ({', '.join(reasons)})")
+        removed.append(snapshots.pop(0)["name"])
+        for key, (size, holders) in list(inodes.items()):
+            holders.discard(oldest["name"])
+            if not holders:
+                held -= size
+                del inodes[key]
+    return removed
+
+def take_snapshot():
+    """Snapshot the previews, tags.csv and manifest into SNAPSHOT_DIR, prune old snapshots, and return its path.
+
+    Previews and tags.csv are linked, not copied (see link_tree), so a snapshot
+    costs a directory entry per file. That is safe because both are only ever
+    replaced by renaming a new file into place, never rewritten, so a linked
+    file keeps the snapshot's contents. The manifest is rewritten in place by
+    SQLite, so it is copied with SQLite's backup API. The snapshot is built
+    under a hidden name and renamed into place once complete. Returns None on
+    failure.
+    """
+    root = get_path(SNAPSHOT_DIR)
+    name = base_name = f"backup_{time.strftime('%Y%m%d_%H%M%S')}"
+    for n in itertools.count(2):
+        if not (root / name).exists():
+            break
+        name = f"{base_name}_{n}"
+    staging = root / f".{name}.part"
+    start_time = time.perf_counter()
+    try:
+        staging.mkdir(parents=True)
+        preview_dir = get_path(THUMBS_DIR, "preview")
+        counts = link_tree(preview_dir, staging / "thumbnails") if preview_dir.exists() else {}
+        if Path(TAGS_CSV).exists():
+            link_file(Path(TAGS_CSV), staging / "tags.csv")
+        if Path(MANIFEST_DB).exists():
+            source, target = sqlite3.connect(MANIFEST_DB), sqlite3.connect(staging / "manifest.db")
+            try:
+                source.backup(target)
+            finally:
+                source.close()
+                target.close()
+        (staging / "snapshot.json").write_text(json.dumps({"created_at": time.time(), "files": counts}))
+        staging.rename(root / name)
+    except (OSError, sqlite3.Error) as e:
+        logger.error(f"Failed to snapshot previews and tags into {root / name}: {str(e)}")
+        shutil.rmtree(staging, ignore_errors=True)
+        return None
+    files = ", ".join(f"{count} {kind}" for kind, count in counts.items() if count) or "no previews"
+    logger.log(logging.SUCCESS, f"Snapshot {name} of previews, tags and manifest in "
+                                f"{time.perf_counter() - start_time:.2f}s ({files})")
+    prune_snapshots()
+    return root / name
+
+def show_snapshots():
+    """Log each snapshot with its age and the disk space only it holds."""
+    snapshots = list_snapshots()
+    if not snapshots:
+        logger.info(f"No snapshots in {get_path(SNAPSHOT_DIR)}")
+        return
+    inodes = snapshot_inodes(snapshots)
+    for snapshot in snapshots:
+        own = sum(size for size, holders in inodes.values() if holders == {snapshot["name"]})
+        age = (time.time() - snapshot["created_at"]) / 86400
+        logger.info(f"{snapshot['name']}: {age:.1f} days old, {own / 1024 / 1024:.1f} MB held only by it")
+    logger.info(f"{len(snapshots)} snapshots hold {sum(size for size, _ in inodes.values()) / 1024 / 1024:.1f} MB")
+
+def restore_snapshot(name: str) -> bool:
+    """Bring back a snapshot's previews, tags.csv and manifest in place of the current ones.
+
+    Everything is staged next to its destination first (previews linked, the
+    manifest copied), so a failure leaves the current outputs untouched, then
+    renamed into place: tags.csv and the manifest in one rename each, and the
+    preview directory in two. The snapshot is kept, and "latest" names the
+    newest one. The tag journal is discarded, as it belongs to the old state.
+    """
+    snapshots = list_snapshots()
+    matches = snapshots[-1:] if name == "latest" else [s for s in snapshots if s["name"] == name]
+    if not matches:
+        logger.error(f"No snapshot {name} in {get_path(SNAPSHOT_DIR)}")
+        return False
+    snapshot = matches[0]["path"]
+    preview_dir = get_path(THUMBS_DIR, "preview")
+    staged_previews = preview_dir.with_name("preview.restore")
+    old_previews = preview_dir.with_name("preview.old")
+    staged_tags = Path(f"{TAGS_CSV}.restore")
+    staged_manifest = Path(f"{MANIFEST_DB}.restore")
+    try:
+        shutil.rmtree(staged_previews, ignore_errors=True)
+        if (snapshot / "thumbnails").exists():
+            link_tree(snapshot / "thumbnails", staged_previews)
+        else:
+            staged_previews.mkdir(parents=True)
+        staged_tags.unlink(missing_ok=True)
+        if (snapshot / "tags.csv").exists():
+            link_file(snapshot / "tags.csv", staged_tags)
+        if (snapshot / "manifest.db").exists():
+            shutil.copy2(snapshot / "manifest.db", staged_manifest)
+
+        shutil.rmtree(old_previews, ignore_errors=True)
+        if preview_dir.exists():
+            preview_dir.rename(old_previews)
+        staged_previews.rename(preview_dir)
+        with file_lock(f"{TAGS_CSV}.lock"):
+            if staged_tags.exists():
+                staged_tags.replace(TAGS_CSV)
+            else:
+                Path(TAGS_CSV).unlink(missing_ok=True)
+        if staged_manifest.exists():
+            # A leftover WAL would be replayed onto the restored database
+            for suffix in ("-wal", "-shm"):
+                Path(f"{MANIFEST_DB}{suffix}").unlink(missing_ok=True)
+            staged_manifest.replace(MANIFEST_DB)
+        TagJournal(f"{TAGS_CSV}.journal").discard()
+    except OSError as e:
+        logger.error(f"Failed to restore snapshot {snapshot}: {str(e)}")
+        if not preview_dir.exists() and old_previews.exists():
+            old_previews.rename(preview_dir)
+        return False
+    finally:
+        shutil.rmtree(staged_previews, ignore_errors=True)
+        staged_tags.unlink(missing_ok=True)
+        staged_manifest.unlink(missing_ok=True)
+    shutil.rmtree(old_previews, ignore_errors=True)
+    logger.log(logging.SUCCESS, f"Restored previews, tags and manifest from {snapshot}")
+    return True
+
+def watch_media(options: tuple, poll_interval: float, debounce: float, force_polling: bool = False):
+    """Process the library with options, then process videos as they are added, modified, or deleted until interrupted.
+
+    Uses filesystem notifications through watchdog when available, otherwise
+    rescans VIDEO_DIR every poll_interval seconds. Watching starts before the
+    initial full pass, so videos that change during it are picked up after it.
+    Only settled changes are passed to process_media(), which handles just
+    those videos. The CLIP model stays loaded between runs, and is reloaded
+    only when the vocabulary changes.
+    """
+    generate_thumbs, generate_tags, _ = options
+    tracker = VideoChangeTracker(debounce)
+    observer = None if force_polling else start_file_observer(tracker)
+    snapshot = scan_video_stats() if observer is None else None
+    last_poll = time.monotonic()
+    tagger, tagger_version = None, None
+
+    def current_tagger():
+        nonlocal tagger, tagger_version
+        if generate_tags and (tagger is None or tagger_version != get_vocabulary_version()):
+            tagger_version = get_vocabulary_version()
+            tagger = load_tagger(load_candidate_tags())
+        return tagger
+
+    try:
+        process_media(options, tagger=current_tagger())
+        if observer:
+            logger.info(f"{Fore.MAGENTA}Watching {VIDEO_DIR} for changes (debounce {debounce:.0f}s)...")
+        else:
+            logger.info(f"{Fore.MAGENTA}Polling {VIDEO_DIR} every {poll_interval:.0f}s for changes (debounce {debounce:.0f}s)...")
+        while True:
+            time.sleep(1)
+            if observer is None and time.monotonic() - last_poll >= poll_interval:
+                current = scan_video_stats()
+                for rel_path in current.keys() | snapshot.keys():
+                    if current.get(rel_path) != snapshot.get(rel_path):
+                        tracker.mark(rel_path)
+                snapshot = current
+                last_poll = time.monotonic()
+            changed, deleted = tracker.ready()
+            if changed or deleted:
+                logger.info(f"Detected {len(changed)} new or modified and {len(deleted)} deleted videos")
+                process_media((generate_thumbs, generate_tags, False), changed=changed, deleted=deleted,
+                              tagger=current_tagger() if changed else None)
+    except KeyboardInterrupt:
+        logger.info("Stopping watch mode")
+    finally:
+        if observer:
+            observer.stop()
+            observer.join()
+
+def process_media(options: tuple = None, changed: list = None, deleted: list = None, tagger=None):
+    """Generate thumbnails, GIFs, and tags for videos, with user prompts and duplication checks.
+
+    options is (generate_thumbs, generate_tags, clear_cache); the user is prompted
+    when it is None. When changed or deleted is given, only those paths (relative
+    to VIDEO_DIR) are handled and the library-wide scan and cleanup are skipped.
+    tagger, when given, is used instead of loading the CLIP model.
+    """
     start_time = time.time()
     logger.info(f"{Fore.MAGENTA}Starting media processing...")
+    if PREVIEW_FORMAT not in PREVIEW_FORMATS:
+        logger.error(f"Unknown PREVIEW_FORMAT {PREVIEW_FORMAT}, expected one of {', '.join(PREVIEW_FORMATS)}")
+        return
 
     # Get user preferences
-    generate_thumbs, generate_tags, clear_cache = prompt_user()
+    generate_thumbs, generate_tags, clear_cache = options if options else prompt_user()
+    incremental = changed is not None or deleted is not None
+    if incremental:
+        clear_cache = False
+    if ACTIVE_SHARD and clear_cache:
+        logger.warning("Skipping cache clearing, a shard would delete previews of the other shards")
+        clear_cache = False
+    if ACTIVE_SHARD and incremental and ACTIVE_SHARD["mode"] == "index":
+        logger.error("Processing changed videos needs SHARD_MODE=hash, index shards move when videos change")
+        return
 
     # Get video files
-    video_files = get_video_files()
+    if incremental:
+        video_files, deleted = shard_files(sorted(changed or [])), shard_files(sorted(deleted or []))
+    else:
+        video_files = shard_files(get_video_files())
+        if ACTIVE_SHARD:
+            logger.info(f"Shard {ACTIVE_SHARD['index']}/{ACTIVE_SHARD['count']} has {len(video_files)} videos")
     total_videos = len(video_files)
-    success_count = 0
-    tags_data = load_existing_tags() if generate_tags else []
-    existing_tag_ids = {entry["media_id"] for entry in tags_data}
+    journal = TagJournal(f"{TAGS_CSV}.journal") if generate_tags else None
+    store = EmbeddingStore(embedding_store_path()) if generate_tags and EMBEDDINGS_DIR else None
 
     # Handle cache clearing
     if clear_cache:
         logger.info("Initiating cache clearing...")
-        backup_dir = Path("backup") / f"backup_{time.strftime('%Y%m%d_%H%M%S')}"
-        backup_dir.mkdir(parents=True, exist_ok=True)
+        if take_snapshot() is None:
+            return
 
         preview_dir = get_path(THUMBS_DIR, "preview")
-        if preview_dir.exists():
-            try:
-                shutil.copytree(preview_dir, backup_dir / "thumbnails")
-                logger.log(logging.SUCCESS, f"Backed up thumbnails and GIFs to {backup_dir / 'thumbnails'}")
-            except Exception as e:
-                logger.error(f"Failed to back up thumbnails: {str(e)}")
-                return
-
-        if Path(TAGS_CSV).exists():
-            try:
-                shutil.copy(TAGS_CSV, backup_dir / "tags.csv")
-                logger.log(logging.SUCCESS, f"Backed up {TAGS_CSV} to {backup_dir / 'tags.csv'}")
-            except Exception as e:
-                logger.error(f"Failed to back up {TAGS_CSV}: {str(e)}")
-                return
-
         try:
             if preview_dir.exists():
                 shutil.rmtree(preview_dir)
@@ -365,112 +2737,432 @@ def process_media():
             if Path(TAGS_CSV).exists():
                 Path(TAGS_CSV).unlink()
                 logger.log(logging.SUCCESS, f"Cleared tags cache: {TAGS_CSV}")
+            if journal:
+                journal.discard()
             preview_dir.mkdir(parents=True, exist_ok=True)
-            tags_data = []
-            existing_tag_ids = set()
         except Exception as e:
             logger.error(f"Failed to clear cache: {str(e)}")
             return
 
-    # Load CLIP pipeline for tagging
-    tagger = None
+    # Load the manifest of previously processed videos
+    manifest_conn, manifest = None, {}
+    try:
+        manifest_conn = open_manifest()
+        if clear_cache:
+            clear_manifest_outputs(manifest_conn)
+        manifest = load_manifest(manifest_conn)
+    except sqlite3.Error as e:
+        logger.error(f"Failed to open manifest {MANIFEST_DB}: {str(e)}")
+        logger.warning("Continuing without the manifest, every video will be processed")
+
+    vocabulary_version = get_tagging_version() if generate_tags else ""
+    existing_ids, unknown_tags = set(), {}
+    resumed = {}
     if generate_tags:
-        logger.debug("Loading CLIP pipeline...")
+        if ACTIVE_SHARD and not incremental and not Path(TAGS_CSV).exists():
+            seed_shard_tags(video_files)
+        existing_ids, unknown_tags = load_existing_tags({row["video_id"] for row in manifest.values()})
         try:
-            tagger = pipeline("zero-shot-image-classification", model="openai/clip-vit-base-patch32")
-            logger.log(logging.SUCCESS, "CLIP pipeline loaded successfully")
-        except Exception as e:
-            logger.error(f"Failed to load CLIP pipeline: {str(e)}")
-            logger.warning("Continuing with empty tags due to model failure")
+            resumed = journal.resume()
+        except (OSError, ValueError, KeyError) as e:
+            logger.error(f"Failed to resume from {journal.path}: {str(e)}")
+            journal.discard()
+            resumed = journal.resume()
+    items = pipeline_items(video_files, manifest, generate_thumbs, generate_tags, unknown_tags,
+                           vocabulary_version, resumed)
+    fingerprint_items(items, manifest_conn)
+    reuse_duplicates(items, manifest, generate_thumbs, generate_tags, vocabulary_version)
+    if store is not None:
+        backfill_embeddings(items, store)
 
-    # Load candidate tags
-    candidate_tags = load_candidate_tags() if generate_tags else []
+    # Load candidate tags and the CLIP model only if something needs tagging
+    if any(item["needs_tags"] for item in items):
+        if tagger is None:
+            tagger = load_tagger(load_candidate_tags())
+        if not tagger:
+            logger.warning("Continuing with empty tags due to model failure")
+            # Videos only queued for their embedding keep their tags
+            for item in items:
+                if item.pop("backfill", None) is not None:
+                    update_item_state(item, generate_thumbs, generate_tags, vocabulary_version)
 
-    # Clean orphaned thumbnails and GIFs (if not cleared)
-    if generate_thumbs and not clear_cache:
+    # Clean orphaned thumbnails and animations (if not cleared); shards leave it to merge_shards()
+    if generate_thumbs and not clear_cache and not incremental and not ACTIVE_SHARD:
         clean_thumbnails(video_files)
 
-    # Process videos
-    for i, rel_path in enumerate(tqdm(video_files, desc="Processing videos", unit="video"), 1):
-        file_path = get_path(VIDEO_DIR, rel_path)
+    # Process videos through the probe/preview/tagging pipeline, journaling new tags
+    removed_ids = set()
+    try:
+        success_count = run_pipeline(items, generate_thumbs, generate_tags, existing_ids, tagger,
+                                     manifest_conn, vocabulary_version, journal, store)
+        if incremental:
+            removed_ids = remove_deleted_videos(deleted or [], generate_thumbs, manifest_conn)
+        elif manifest_conn:
+            prune_manifest(manifest_conn, video_files)
+        if store is not None:
+            if incremental:
+                store.remove(removed_ids)
+            else:
+                store.retain({Path(v).stem for v in video_files})
+    finally:
+        if manifest_conn:
+            manifest_conn.close()
+        if journal:
+            journal.close()
+        if store is not None:
+            store.save()
+
+    # Merge journaled tags into tags.csv, dropping orphaned rows, then discard the journal
+    if generate_tags:
+        updates = journal.rows()
+        if updates or removed_ids or Path(TAGS_CSV).exists():
+            video_ids = None if incremental else {Path(v).stem for v in video_files}
+            if merge_tags_csv(updates, video_ids, removed_ids):
+                journal.discard()
+        else:
+            journal.discard()
+
+    elapsed_time = time.time() - start_time
+    logger.info(
+        f"{Fore.MAGENTA}Media processing complete: {success_count}/{total_videos} videos processed "
+        f"in {elapsed_time:.2f} seconds"
+    )
+    write_metrics_summary()
+
+def write_metrics_summary(path: str = None):
+    """Log per-stage latencies and write the metrics summary to path (default METRICS_JSON) as JSON.
+
+    Metrics accumulate for the life of the process, so in --watch mode each
+    summary covers every run so far.
+    """
+    path = METRICS_JSON if path is None else path
+    summary = metrics.summary()
+    for labels, stats in summary.get("tag_media_stage_seconds", {}).items():
+        logger.info(f"Stage {labels.split('=', 1)[-1]}: {stats['count']} calls, {stats['sum']:.2f}s total, "
+                     f"p50 {stats['p50'] * 1000:.0f} ms, p95 {stats['p95'] * 1000:.0f} ms")
+    if not path:
+        return
+    try:
+        tmp_path = Path(f"{path}.tmp")
+        tmp_path.write_text(json.dumps({"written_at": time.strftime("%Y-%m-%dT%H:%M:%S"), "metrics": summary}, indent=2))
+        tmp_path.replace(path)
+        logger.info(f"Wrote metrics summary to {path}")
+    except OSError as e:
+        logger.error(f"Failed to write metrics summary to {path}: {str(e)}")
+
+def retag_from_embeddings() -> bool:
+    """Re-tag videos from their stored image embeddings against the current vocabulary.
+
+    Each block of EMBEDDING_BLOCK_ROWS stored embeddings is scored against the
+    candidate-tag text embeddings in one matrix multiply, so the image encoder
+    never runs, and the text side is read from TEXT_EMBEDDINGS_CACHE when this
+    vocabulary was encoded before. Videos changed since they were embedded, or
+    never embedded, are left to the next tagging run. In frames mode the stored
+    embedding is the mean of the frame embeddings, so the tags approximate
+    TAG_FRAME_POOLING over the frames.
+    """
+    store = EmbeddingStore(embedding_store_path())
+    if not len(store):
+        logger.error(f"No stored embeddings in {store.path}, run tag_media.py --tags to embed the library first")
+        return False
+    video_files = shard_files(get_video_files())
+    entries = []
+    for rel_path in video_files:
         video_id = Path(rel_path).stem
-        logger.info(f"{Fore.MAGENTA}Processing video {i}/{total_videos}: {rel_path}")
+        try:
+            stat = get_path(VIDEO_DIR, rel_path).stat()
+        except OSError as e:
+            logger.error(f"Failed to stat {rel_path}: {str(e)}")
+            continue
+        if store.current(video_id, stat.st_size, stat.st_mtime_ns):
+            entries.append((rel_path, video_id, stat.st_size, stat.st_mtime_ns))
+    if not entries:
+        logger.error(f"None of the {len(video_files)} videos have a current embedding in {store.path}")
+        return False
+    scorer = load_tag_scorer(load_candidate_tags())
+    if scorer is None:
+        return False
+
+    start_time = time.perf_counter()
+    vocabulary_version = get_tagging_version()
+    updates, manifest_rows = {}, []
+    with metrics.timer("tag_media_stage_seconds", stage="retag"):
+        for start in range(0, len(entries), EMBEDDING_BLOCK_ROWS):
+            block = entries[start:start + EMBEDDING_BLOCK_ROWS]
+            outputs = scorer.score(store.get([video_id for _, video_id, _, _ in block]))
+            for (rel_path, video_id, size, mtime_ns), output in zip(block, outputs):
+                tags = [item["label"] for item in top_tags(output)]
+                updates[video_id] = tag_row(video_id, tags)
+                manifest_rows.append((json.dumps(tags), vocabulary_version, time.time(), rel_path, size, mtime_ns))
+    metrics.inc("tag_media_images_tagged_total", len(entries), source="embeddings")
+    logger.info(f"Re-tagged {len(entries)} videos from stored embeddings in {time.perf_counter() - start_time:.2f}s")
 
+    # tags.csv first: if recording in the manifest then fails, the next run just re-tags these videos
+    if not merge_tags_csv(updates, {Path(v).stem for v in video_files}):
+        return False
+    try:
+        manifest_conn = open_manifest()
         try:
-            duration = get_video_duration(str(file_path))
-            if duration < 5:
-                logger.warning(f"Skipping {rel_path}: Duration {duration:.2f}s < 5s")
-                continue
+            manifest_conn.executemany(
+                "UPDATE media SET tags = ?, vocabulary_version = ?, updated_at = ? "
+                "WHERE rel_path = ? AND size = ? AND mtime_ns = ?", manifest_rows)
+            manifest_conn.commit()
+        finally:
+            manifest_conn.close()
+    except sqlite3.Error as e:
+        logger.error(f"Failed to record re-tagged videos in {MANIFEST_DB}: {str(e)}")
+    if len(entries) < len(video_files):
+        logger.warning(f"{len(video_files) - len(entries)} videos have no current embedding, "
+                       f"the next tagging run will tag them")
+    return True
 
-            # Generate thumbnail and GIF if needed
-            jpeg_url = ""
-            gif_url = ""
-            jpeg_path = get_path(THUMBS_DIR, "preview", f"{video_id}_thumb.jpg")
-            gif_path = get_path(THUMBS_DIR, "preview", f"{video_id}.gif")
-            if generate_thumbs:
-                if not jpeg_path.exists():
-                    jpeg_url = generate_jpeg(str(file_path), video_id, duration)
-                    if not jpeg_url:
-                        logger.warning(f"Failed to generate JPEG for {rel_path}")
-                        continue
-                else:
-                    jpeg_url = f"{THUMBNAIL_URL_PREFIX}/preview/{video_id}_thumb.jpg"
-                    logger.info(f"JPEG exists: {jpeg_path} ({jpeg_path.stat().st_size / 1024:.2f} KB)")
+def find_similar(video_id: str, limit: int = SIMILAR_LIMIT) -> list:
+    """Log and return the stored videos whose embeddings are closest to video_id's."""
+    store = EmbeddingStore(embedding_store_path())
+    if video_id not in store:
+        logger.error(f"No stored embedding for {video_id} in {store.path}")
+        return []
+    similar = store.similar(video_id, limit)
+    for other, score in similar:
+        logger.log(logging.SUCCESS, f"{other}: {score:.4f}")
+    return similar
 
-                if not gif_path.exists():
-                    gif_url = generate_gif(str(file_path), video_id, duration)
-                    if not gif_url:
-                        logger.warning(f"Failed to generate GIF for {rel_path}")
-                        continue
-                else:
-                    gif_url = f"{THUMBNAIL_URL_PREFIX}/preview/{video_id}.gif"
-                    logger.info(f"GIF exists: {gif_path} ({gif_path.stat().st_size / 1024:.2f} KB)")
-            elif not (jpeg_path.exists() and gif_path.exists()):
-                logger.warning(f"Thumbnail or GIF missing for {rel_path}, but generation disabled")
+def find_near_duplicates(threshold: float = DUPLICATE_THRESHOLD) -> list:
+    """Log and return the pairs of stored videos at or above threshold cosine similarity."""
+    store = EmbeddingStore(embedding_store_path())
+    with metrics.timer("tag_media_stage_seconds", stage="duplicates"):
+        pairs = store.near_duplicates(threshold)
+    for first, second, score in pairs:
+        logger.log(logging.SUCCESS, f"{first} ~ {second}: {score:.4f}")
+    logger.info(f"Found {len(pairs)} near-duplicate pairs among {len(store)} videos (threshold {threshold})")
+    return pairs
+
+def find_shards() -> dict:
+    """{count: {index: path}} of the shard tags files written next to TAGS_CSV."""
+    tags_path = Path(TAGS_CSV)
+    shards = {}
+    for path in tags_path.parent.glob(f"{tags_path.stem}.shard-*-of-*{tags_path.suffix}"):
+        label = path.name[len(f"{tags_path.stem}.shard-"):len(path.name) - len(tags_path.suffix)]
+        try:
+            index, count = parse_shard(label.replace("-of-", "/"))
+        except ValueError:
+            continue
+        shards.setdefault(count, {})[index] = path
+    return shards
+
+def merge_shard_manifests(count: int, video_files: list):
+    """Copy every shard's manifest rows into MANIFEST_DB, then drop rows of videos that are gone."""
+    conn = open_manifest()
+    try:
+        columns = ", ".join(row["name"] for row in conn.execute("PRAGMA table_info(media)"))
+        for index in range(count):
+            path = shard_path(MANIFEST_DB, index, count)
+            if not Path(path).exists():
+                logger.warning(f"No manifest for shard {index}/{count} at {path}")
                 continue
+            # Open it once the regular way, so an older shard manifest gets the current columns
+            open_manifest_at(path).close()
+            conn.execute("ATTACH DATABASE ? AS shard", (path,))
+            try:
+                conn.execute(f"INSERT OR REPLACE INTO media ({columns}) SELECT {columns} FROM shard.media")
+                conn.commit()
+            finally:
+                conn.execute("DETACH DATABASE shard")
+        prune_manifest(conn, video_files)
+    finally:
+        conn.close()
 
-            # Generate tags if needed
-            if generate_tags and video_id not in existing_tag_ids:
-                tags = []
-                if tagger:
-                    tags = tag_image(str(jpeg_path), tagger, candidate_tags)
-                    if not tags:
-                        logger.warning(f"No tags generated for {rel_path}")
-                else:
-                    logger.warning(f"Skipping tagging for {rel_path} due to model failure")
-                tags_data.append({
-                    "media_id": video_id,
-                    "media_type": "video",
-                    **{f"tag{i}": tag for i, tag in enumerate(tags, 1)}
-                })
-                success_count += 1
-            elif video_id in existing_tag_ids:
-                logger.info(f"Tags already exist for {video_id}, skipping")
+def merge_shard_embeddings(count: int, video_ids: set):
+    """Copy every shard's stored embeddings into the library's embedding store."""
+    store = EmbeddingStore(embedding_store_path())
+    for index in range(count):
+        path = embedding_store_path(shard_path(EMBEDDINGS_DIR, index, count))
+        if not path.exists():
+            continue
+        shard = EmbeddingStore(path)
+        for block, embeddings in shard.blocks(list(shard.ids)):
+            for video_id, embedding in zip(block, embeddings):
+                store.put(video_id, embedding, *shard.ids[video_id][1:])
+        store.save()
+    store.retain(video_ids)
+    store.save()
 
-        except Exception as e:
-            logger.error(f"Unexpected error processing {rel_path}: {str(e)}")
+def merge_shards() -> bool:
+    """Combine every shard's tags, manifest, and embeddings into the library's, cleaning orphans once.
 
-    # Clean orphaned tags
-    if generate_tags:
-        tags_data = clean_orphaned_tags(tags_data, video_files)
+    Shard files are kept, so the next sharded run stays incremental. All COUNT
+    shards of one sharding must be present; nothing is merged otherwise, since
+    tags of a missing shard's videos would be dropped as orphans.
+    """
+    shards = find_shards()
+    if len(shards) != 1:
+        if shards:
+            logger.error(f"Found shard files for several shard counts ({', '.join(map(str, sorted(shards)))}), "
+                         f"remove the stale ones before merging")
+        else:
+            logger.error(f"No shard files found next to {TAGS_CSV}")
+        return False
+    count, paths = next(iter(shards.items()))
+    missing = [str(index) for index in range(count) if index not in paths]
+    if missing:
+        logger.error(f"Missing tags for shards {', '.join(missing)} of {count}, not merging")
+        return False
+    video_files = get_video_files()
+    if not video_files:
+        logger.error(f"No videos found in {VIDEO_DIR}, not merging")
+        return False
 
-    # Write tags.csv
-    if generate_tags and tags_data:
-        logger.debug("Writing tags.csv...")
+    logger.info(f"{Fore.MAGENTA}Merging {count} shards into {TAGS_CSV}...")
+    updates = {}
+    for index in range(count):
+        if Path(f"{paths[index]}.journal").exists():
+            logger.warning(f"Shard {index}/{count} has unmerged tags in its journal, run it again to include them")
         try:
-            with open(TAGS_CSV, "w", newline="") as f:
-                writer = csv.DictWriter(f, fieldnames=["media_id", "media_type"] + [f"tag{i}" for i in range(1, 21)])
-                writer.writeheader()
-                writer.writerows(tags_data)
-            logger.log(logging.SUCCESS, f"Generated {TAGS_CSV}: {len(tags_data)} videos tagged")
-        except Exception as e:
-            logger.error(f"Failed to write {TAGS_CSV}: {str(e)}")
+            with open(paths[index], "r", newline="") as f:
+                for row in csv.DictReader(f):
+                    if row["media_id"] in updates:
+                        logger.warning(f"video:{row['media_id']} appears in more than one shard, keeping shard {index}")
+                    updates[row["media_id"]] = row
+        except (OSError, csv.Error, KeyError) as e:
+            logger.error(f"Failed to read {paths[index]}: {str(e)}")
+            return False
 
-    elapsed_time = time.time() - start_time
-    logger.info(
-        f"{Fore.MAGENTA}Media processing complete: {success_count}/{total_videos} videos processed "
-        f"in {elapsed_time:.2f} seconds"
-    )
+    try:
+        merge_shard_manifests(count, video_files)
+    except sqlite3.Error as e:
+        logger.error(f"Failed to merge shard manifests into {MANIFEST_DB}: {str(e)}")
+    if EMBEDDINGS_DIR:
+        merge_shard_embeddings(count, {Path(v).stem for v in video_files})
+    merged = merge_tags_csv(updates, {Path(v).stem for v in video_files})
+    clean_thumbnails(video_files)
+    return merged
+
+def measure_import_time(runs: int = 5) -> float:
+    """Import this module in fresh interpreters and return the fastest import time in seconds."""
+    module_dir = str(Path(__file__).resolve().parent)
+    code = ("import sys, time; sys.path.insert(0, sys.argv[1]); start = time.perf_counter(); "
+            "import tag_media; print(time.perf_counter() - start)")
+    timings = []
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, "-c", code, module_dir], check=True, capture_output=True, text=True)
+        timings.append(float(result.stdout.strip().splitlines()[-1]))
+    return min(timings)
 
 if __name__ == "__main__":
-    process_media()
\ No newline at end of file
+    logger.debug(f"Imported in {time.perf_counter() - IMPORT_STARTED:.3f}s")
+    parser = argparse.ArgumentParser(
+        description="Generate thumbnails, GIFs, and tags for videos.",
+        epilog="Without --thumbs/--tags/--clear-cache the options are asked interactively; "
+               "if any is given, the others default to off.")
+    parser.add_argument("--thumbs", action=argparse.BooleanOptionalAction,
+                        help="generate thumbnails and GIFs for videos")
+    parser.add_argument("--tags", action=argparse.BooleanOptionalAction,
+                        help="generate tags for thumbnails")
+    parser.add_argument("--clear-cache", action=argparse.BooleanOptionalAction,
+                        help="back up and clear the thumbnail, GIF, and tag cache first")
+    parser.add_argument("--watch", action="store_true",
+                        help="after processing, keep running and process videos as they change")
+    parser.add_argument("--poll", action="store_true",
+                        help="in --watch mode, poll VIDEO_DIR even if watchdog is installed")
+    parser.add_argument("--poll-interval", type=float, default=30,
+                        help="seconds between VIDEO_DIR scans when polling (default: 30)")
+    parser.add_argument("--debounce", type=float, default=10,
+                        help="seconds a changed video must stay unchanged before processing (default: 10)")
+    parser.add_argument("--benchmark-batch-sizes", metavar="SIZES",
+                        help="comma-separated CLIP batch sizes to benchmark on existing thumbnails, then exit")
+    parser.add_argument("--benchmark-images", type=int, default=256,
+                        help="number of thumbnails to use for --benchmark-batch-sizes and --compare-engines (default: 256)")
+    parser.add_argument("--compare-engines", metavar="ENGINES",
+                        help=f"comma-separated engines ({', '.join(TAG_ENGINES)}) to compare on existing thumbnails "
+                             "against the first one, then exit")
+    parser.add_argument("--import-time", action="store_true",
+                        help="measure the module import time against IMPORT_TIME_BUDGET, then exit")
+    parser.add_argument("--retag", action="store_true",
+                        help="re-tag videos from stored image embeddings with the current vocabulary, then exit")
+    parser.add_argument("--similar", metavar="VIDEO_ID",
+                        help="list the videos most similar to VIDEO_ID by stored embedding, then exit")
+    parser.add_argument("--limit", type=int, default=SIMILAR_LIMIT,
+                        help=f"number of --similar results (default: {SIMILAR_LIMIT})")
+    parser.add_argument("--near-duplicates", action="store_true",
+                        help="list pairs of videos whose stored embeddings are near-identical, then exit")
+    parser.add_argument("--threshold", type=float, default=DUPLICATE_THRESHOLD,
+                        help=f"cosine similarity of --near-duplicates pairs (default: {DUPLICATE_THRESHOLD})")
+    parser.add_argument("--report", metavar="FILE",
+                        help="also write the --compare-engines or --near-duplicates report to FILE as JSON")
+    parser.add_argument("--snapshot", action="store_true",
+                        help="snapshot previews, tags and manifest (as clear-cache does), then exit")
+    parser.add_argument("--snapshots", action="store_true",
+                        help="list snapshots and the disk space each holds, then exit")
+    parser.add_argument("--restore", metavar="NAME",
+                        help="restore previews, tags and manifest from snapshot NAME (or latest), then exit")
+    parser.add_argument("--shard", metavar="INDEX/COUNT", default=SHARD or None,
+                        help="process only shard INDEX (from 0) of COUNT, into its own tags and manifest files")
+    parser.add_argument("--shard-mode", choices=SHARD_MODES, default=SHARD_MODE,
+                        help="assign videos to shards by a hash of their video id, the file stem (stable), "
+                             "or by position in the sorted video ids (even) (default: hash)")
+    parser.add_argument("--merge-shards", action="store_true",
+                        help="merge every shard's tags and manifest, clean orphaned previews and tags once, then exit")
+    args = parser.parse_args()
+
+    if args.shard:
+        if args.merge_shards or args.snapshot or args.restore or (args.watch and args.shard_mode == "index"):
+            logger.error("--shard cannot be combined with --merge-shards, --snapshot, --restore, "
+                         "or with --watch in index mode")
+            sys.exit(2)
+        try:
+            use_shard(*parse_shard(args.shard), args.shard_mode)
+        except ValueError as e:
+            logger.error(str(e))
+            sys.exit(2)
+
+    if args.import_time:
+        import_time = measure_import_time()
+        if import_time > IMPORT_TIME_BUDGET:
+            logger.error(f"Import took {import_time * 1000:.0f} ms, over the {IMPORT_TIME_BUDGET * 1000:.0f} ms budget")
+            sys.exit(1)
+        logger.log(logging.SUCCESS, f"Import took {import_time * 1000:.0f} ms "
+                                    f"(budget {IMPORT_TIME_BUDGET * 1000:.0f} ms)")
+    elif args.merge_shards:
+        sys.exit(0 if merge_shards() else 1)
+    elif args.snapshot:
+        sys.exit(0 if take_snapshot() else 1)
+    elif args.snapshots:
+        show_snapshots()
+    elif args.restore:
+        sys.exit(0 if restore_snapshot(args.restore) else 1)
+    elif args.retag:
+        sys.exit(0 if retag_from_embeddings() else 1)
+    elif args.similar:
+        find_similar(args.similar, args.limit)
+    elif args.near_duplicates:
+        pairs = find_near_duplicates(args.threshold)
+        if args.report:
+            Path(args.report).write_text(json.dumps({"threshold": args.threshold, "pairs": [
+                {"media_id": first, "duplicate_id": second, "score": round(score, 4)} for first, second, score in pairs
+            ]}, indent=2))
+            logger.log(logging.SUCCESS, f"Wrote near-duplicates to {args.report}")
+    elif args.compare_engines:
+        engines = [engine.strip().lower() for engine in args.compare_engines.split(",") if engine.strip()]
+        thumbs = sorted(str(p) for p in get_path(THUMBS_DIR, "preview").glob("*_thumb.jpg"))[:args.benchmark_images]
+        if not thumbs or len(engines) < 2:
+            logger.error("Engine comparison needs existing thumbnails and at least two engines")
+        else:
+            report = compare_engines(thumbs, load_candidate_tags(), engines)
+            if args.report:
+                Path(args.report).write_text(json.dumps({"images": len(thumbs), "engines": report}, indent=2))
+                logger.log(logging.SUCCESS, f"Wrote engine comparison to {args.report}")
+    elif args.benchmark_batch_sizes:
+        batch_sizes = [int(size) for size in args.benchmark_batch_sizes.split(",") if size.strip()]
+        thumbs = sorted(str(p) for p in get_path(THUMBS_DIR, "preview").glob("*_thumb.jpg"))[:args.benchmark_images]
+        tagger = load_tagger(load_candidate_tags()) if thumbs else None
+        if not thumbs or not tagger:
+            logger.error("Batch size benchmark needs existing thumbnails and a working CLIP model")
+        else:
+            benchmark_tag_batch_sizes(thumbs, tagger, batch_sizes)
+    else:
+        flags = (args.thumbs, args.tags, args.clear_cache)
+        options = tuple(bool(flag) for flag in flags) if any(flag is not None for flag in flags) else prompt_user()
+        if args.watch:
+            watch_media(options, args.poll_interval, args.debounce, args.poll)
+        else:
+            process_media(options)
\ No newline at end of file